@@ -143,6 +143,10 @@ const updateTask = async (taskId, data) => {
 	}
 };
 
+const finishExtraction = (jobId, room, data) => {
+	io.in(room).emit("extraction", jobId, data);
+};
+
 const removeTask = (taskId) => {
 	io.in(taskId).emit("remove", taskId);
 	forEachSocketInRoom(taskId, (socket) => socket.leave(taskId));
@@ -179,6 +183,8 @@ const removeTask = (taskId) => {
 			updateTask(data.taskid, data.data);
 		} else if (type === "remove") {
 			removeTask(data.taskid);
+		} else if (type === "extraction") {
+			finishExtraction(data.jobid, data.room, data.data);
 		}
 	});
 })();
@@ -13,68 +13,23 @@
 
 """Helper functions for working with MediaWiki categories."""
 
-import json
-import subprocess
-
 from typing import Iterable, Set
 
-from ..encode.globals import ffprobe_location
+from ..encode.probecache import probe
 
 
 def has_video_track(source: str) -> bool:
-    """Check if a video has an audio track."""
+    """Check if a video has a video track."""
+    mediaprobe = probe(source)
 
-    result = subprocess.run(
-        [
-            ffprobe_location,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "v",
-            "-show_entries",
-            "stream=index,codec_type",
-            "-of",
-            "json",
-            source,
-        ],
-        capture_output=True,
-        text=True,
-    )
-
-    if result.returncode == 0:
-        for stream in json.loads(result.stdout).get("streams", []):
-            if stream.get("codec_type") == "video":
-                return True
-
-    return False
+    return bool(mediaprobe and mediaprobe.has_video())
 
 
 def has_audio_track(source: str) -> bool:
     """Check if a video has an audio track."""
+    mediaprobe = probe(source)
 
-    result = subprocess.run(
-        [
-            ffprobe_location,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "a",
-            "-show_entries",
-            "stream=index,codec_type",
-            "-of",
-            "json",
-            source,
-        ],
-        capture_output=True,
-        text=True,
-    )
-
-    if result.returncode == 0:
-        for stream in json.loads(result.stdout).get("streams", []):
-            if stream.get("codec_type") == "audio":
-                return True
-
-    return False
+    return bool(mediaprobe and mediaprobe.has_audio())
 
 
 def get_subtitle_categories(source: str, langcodes: Iterable[str]) -> Set[str]:
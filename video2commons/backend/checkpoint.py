@@ -0,0 +1,264 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Checkpoints of the completed stages of tasks, to resume failed tasks."""
+
+import hashlib
+import json
+import os
+import shutil
+
+from video2commons.backend.download.sourcecache import link_file
+
+# Checkpoints of failed tasks are kept for CHECKPOINT_TTL seconds. Encoded
+# files and their subtitles are kept on storage shared by all workers if it is
+# available, since restarted tasks may run on another host. Sources are kept
+# locally, they are cheaper to download again than to copy around.
+CHECKPOINT_TTL = 3 * 24 * 3600
+LOCAL_DIR = "/srv/v2c/checkpoints"
+SHARED_DIR = "/data/scratch/video2commons/checkpoints"
+
+
+def get_fingerprint(url, subtitles, downloadkey, convertkey, username):
+    """Get the key shared by tasks that download and encode the same way."""
+    params = [url, str(subtitles), downloadkey, convertkey, username]
+    return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+
+def get_sha1(path):
+    """Get the hex SHA-1 digest of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+class Checkpoint:
+    """
+    The stage manifest of a task.
+
+    Each completed stage records its artifacts: the downloaded source, its
+    subtitles, the encoded file with its checksum, and the upload stash key.
+    While the task runs they are in its own directory. If it fails, keep()
+    moves them out of the way of the cleanup, and a restart of the task finds
+    them with restore() and skips the stages whose artifacts are still valid.
+    """
+
+    def __init__(self, conn, fingerprint):
+        self.conn = conn
+        self.fingerprint = fingerprint
+        self.key = "checkpoint:" + fingerprint
+
+        try:
+            self.manifest = json.loads(self.conn.get(self.key) or "{}")
+        except Exception as e:
+            print("Unable to load checkpoint:", e)
+            self.manifest = {}
+
+    def save_download(self, download, directory):
+        """
+        Record a completed download.
+
+        @param download dict Download result as returned by download.download
+        @param directory string The task directory holding the files
+        """
+        if download["streaming"]:
+            return  # There is nothing to keep but an expiring URL.
+
+        self.manifest["download"] = {
+            "directory": directory,
+            "target": os.path.basename(download["target"]),
+            "extractor": download["extractor"],
+        }
+        self.manifest["subtitles"] = {
+            "directory": directory,
+            "subtitles": {
+                lang: os.path.basename(path)
+                for lang, path in download["subtitles"].items()
+            },
+        }
+        self._save()
+
+    def save_encode(self, target):
+        """
+        Record a completed encode.
+
+        @param target string Path of the encoded file
+        """
+        self.manifest["encode"] = {
+            "directory": os.path.dirname(target),
+            "target": os.path.basename(target),
+            "size": os.path.getsize(target),
+            "mtime": int(os.stat(target).st_mtime),
+            "sha1": get_sha1(target),
+        }
+        self._save()
+
+    def save_upload(self, **info):
+        """
+        Record the state of an upload, e.g. its stash key.
+
+        @param info Keyword arguments to record
+        """
+        self.manifest.setdefault("upload", {}).update(info)
+        self._save()
+
+    def get_upload(self):
+        """
+        Get the recorded state of the upload.
+
+        @return dict
+        """
+        return self.manifest.get("upload", {})
+
+    def get_sha1(self):
+        """
+        Get the checksum of the encoded file, if it has been recorded.
+
+        @return string or None
+        """
+        return self.manifest.get("encode", {}).get("sha1")
+
+    def source_removed(self, directory):
+        """
+        Record that the source was deleted once it was no longer needed.
+
+        @param directory string The task directory
+        """
+        download = self.manifest.get("download")
+        if download and download["directory"] == directory:
+            download["target"] = None
+            self._save()
+
+    def restore(self, outputdir):
+        """
+        Place the artifacts of the valid stages into a new task directory.
+
+        @param outputdir string The task directory
+        @return dict Stage name to its artifacts, with paths in outputdir
+        """
+        restored = {}
+        try:
+            encode = self.manifest.get("encode")
+            if encode and self._is_valid_encode(encode):
+                restored["encode"] = {
+                    "target": link_file(
+                        encode["directory"], encode["target"], outputdir
+                    )
+                }
+
+            subtitles = self.manifest.get("subtitles")
+            if not subtitles or not self._is_valid(subtitles):
+                return restored
+
+            subtitles = {
+                lang: link_file(subtitles["directory"], name, outputdir)
+                for lang, name in subtitles["subtitles"].items()
+            }
+
+            # The source is only needed if there is no encoded file.
+            download = self.manifest.get("download", {})
+            if download.get("target") and self._is_valid(download):
+                target = link_file(download["directory"], download["target"], outputdir)
+            elif "encode" in restored:
+                target = None
+            else:
+                return restored
+
+            restored["download"] = {
+                "extractor": download.get("extractor"),
+                "subtitles": subtitles,
+                "streaming": False,
+                "http_headers": {},
+                "target": target,
+            }
+        except OSError as e:
+            print("Unable to restore checkpoint:", e)
+            return {}
+
+        return restored
+
+    def keep(self, outputdir):
+        """
+        Move the artifacts in a task directory out of the way of its cleanup.
+
+        @param outputdir string The task directory
+        """
+        if not self.manifest:
+            return
+
+        try:
+            for stage, artifact in self.manifest.items():
+                if artifact.get("directory") != outputdir:
+                    continue  # Not made by this run, or not a file
+
+                if stage in ("encode", "subtitles") and os.path.isdir(
+                    os.path.dirname(SHARED_DIR)
+                ):
+                    directory = os.path.join(SHARED_DIR, self.fingerprint)
+                else:
+                    directory = os.path.join(LOCAL_DIR, self.fingerprint)
+                os.makedirs(directory, exist_ok=True)
+
+                for name in _get_files(artifact):
+                    shutil.move(
+                        os.path.join(outputdir, name), os.path.join(directory, name)
+                    )
+                artifact["directory"] = directory
+
+            self._save()
+        except OSError as e:
+            print("Unable to keep checkpoint:", e)
+
+    def clear(self):
+        """Forget the checkpoint and delete the artifacts kept for it."""
+        try:
+            self.conn.delete(self.key)
+        except Exception as e:
+            print("Unable to clear checkpoint:", e)
+
+        for root in (LOCAL_DIR, SHARED_DIR):
+            shutil.rmtree(os.path.join(root, self.fingerprint), ignore_errors=True)
+        self.manifest = {}
+
+    def _save(self):
+        try:
+            self.conn.setex(self.key, CHECKPOINT_TTL, json.dumps(self.manifest))
+        except Exception as e:
+            print("Unable to save checkpoint:", e)
+
+    def _is_valid(self, artifact):
+        return all(
+            os.path.isfile(os.path.join(artifact["directory"], name))
+            for name in _get_files(artifact)
+        )
+
+    def _is_valid_encode(self, encode):
+        # Hashing large files again would take about as long as reading
+        # them, the size and mtime are enough to tell if they were changed.
+        try:
+            st = os.stat(os.path.join(encode["directory"], encode["target"]))
+        except OSError:
+            return False
+
+        return st.st_size == encode["size"] and int(st.st_mtime) == encode.get("mtime")
+
+
+def _get_files(artifact):
+    files = list(artifact.get("subtitles", {}).values())
+    if artifact.get("target"):
+        files.append(artifact["target"])
+
+    return files
@@ -2,3 +2,4 @@
 
 find /srv/v2c/output/* -type d -ctime +1 -exec rm -rv {} \;
 find /srv/v2c/ssu/* -ctime +60 -exec rm -rv {} \;
+find /srv/v2c/checkpoints/* -maxdepth 0 -type d -ctime +3 -exec rm -rv {} \;
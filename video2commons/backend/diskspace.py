@@ -0,0 +1,216 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Reserve the disk space tasks are going to need on this host."""
+
+import json
+import os
+import time
+import uuid
+
+from video2commons.backend.ledger import Ledger
+from video2commons.shared.telemetry import percentile
+
+LEDGER_PATH = "/tmp/v2c-disk-reservations.json"
+ROOT = "/srv"
+
+# Space that is always kept free for logs, temporary files and the like.
+MIN_FREE = 2 << 30
+
+# Reservation for tasks whose source size isn't known. Along with MIN_FREE,
+# this is the 10 GiB that used to be required for every task.
+DEFAULT_RESERVATION = 8 << 30
+
+# yt-dlp downloads video and audio separately and merges them into a new
+# file, so a download briefly needs about twice the size of the source.
+DOWNLOAD_OVERHEAD = 2
+
+# Output size relative to the source when there is no telemetry for a
+# profile yet, and the number of seconds the observed ratios are cached.
+DEFAULT_OUTPUT_RATIO = 1.0
+OUTPUT_RATIO_TTL = 10 * 60
+
+_output_ratios = {}
+
+
+class DiskReservation:
+    """
+    A reservation of disk space for the files of a task.
+
+    All tasks on a host register their reservation in a ledger file, along
+    with the directory holding their files. A task is only admitted if the
+    free space left after the reservations of the others is enough for its
+    own. Space reserved by others counts only as far as their directories
+    haven't grown into it yet, since that part is already missing from the
+    free space of the filesystem.
+    """
+
+    def __init__(self, size, path=LEDGER_PATH, root=ROOT):
+        self.size = size
+        self.path = path
+        self.root = root
+        self.id = "%d-%s" % (os.getpid(), uuid.uuid4().hex)
+        self.directory = None
+
+    def acquire(self):
+        """
+        Reserve the space if it is available.
+
+        @return bool whether the space has been reserved
+        """
+        with Ledger(self.path) as ledger:
+            st = os.statvfs(self.root)
+            free = st.f_frsize * st.f_bavail
+            for id, reservation in ledger.items():
+                if id != self.id:
+                    free -= _get_unused(reservation)
+
+            if free - self.size < MIN_FREE:
+                return False
+
+            ledger[self.id] = {
+                "pid": os.getpid(),
+                "size": self.size,
+                "directory": self.directory,
+            }
+
+        return True
+
+    def set_directory(self, directory):
+        """
+        Set the directory the files of the task are stored in.
+
+        @param directory string
+        """
+        self.directory = directory
+        self._update()
+
+    def resize(self, size):
+        """
+        Change the reservation, e.g. once files have been deleted.
+
+        The reservation may grow beyond the free space, since the task is
+        already running and would rather fail than wait.
+
+        @param size int bytes, including the files already stored
+        """
+        self.size = size
+        self._update()
+
+    def release(self):
+        """Give the reserved space back to the other tasks."""
+        release(self.id, self.path)
+
+    def _update(self):
+        try:
+            with Ledger(self.path) as ledger:
+                if self.id in ledger:
+                    ledger[self.id].update(size=self.size, directory=self.directory)
+        except OSError as e:
+            print("Unable to update disk reservation:", e)
+
+
+def release(id, path=LEDGER_PATH):
+    """
+    Release a reservation by its ID, e.g. from the task a task was handed to.
+
+    @param id string
+    @param path string
+    """
+    try:
+        with Ledger(path) as ledger:
+            ledger.pop(id, None)
+    except OSError as e:
+        print("Unable to release disk reservation:", e)
+
+
+def _get_unused(reservation):
+    used = 0
+    if reservation.get("directory"):
+        used = get_directory_size(reservation["directory"])
+
+    return max(0, reservation["size"] - used)
+
+
+def get_directory_size(path):
+    """
+    Get the total size of the files in a directory tree.
+
+    @param path string
+    @return int bytes
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass  # The file has been deleted in the meantime
+
+    return size
+
+
+def get_output_ratio(conn, convertkey):
+    """
+    Get the 95th percentile of the output to source size ratio of a profile.
+
+    @param conn Redis connection holding the telemetry
+    @param convertkey string
+    @return float
+    """
+    now = time.monotonic()
+    cached = _output_ratios.get(convertkey)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    ratios = []
+    try:
+        for record in conn.lrange("telemetry:" + convertkey, 0, -1):
+            record = json.loads(record)
+            if record.get("bytes_in") and record.get("bytes_out"):
+                ratios.append(record["bytes_out"] / record["bytes_in"])
+    except Exception as e:
+        print("Unable to read telemetry:", e)
+
+    ratio = percentile(ratios, 95) or DEFAULT_OUTPUT_RATIO
+    _output_ratios[convertkey] = (now + OUTPUT_RATIO_TTL, ratio)
+    return ratio
+
+
+def estimate_output_size(conn, source_size, convertkey):
+    """
+    Estimate the size of the encoded file of a source.
+
+    @param conn Redis connection holding the telemetry
+    @param source_size int bytes
+    @param convertkey string
+    @return int bytes
+    """
+    return int(source_size * get_output_ratio(conn, convertkey))
+
+
+def estimate_task_size(conn, source_size, convertkey):
+    """
+    Estimate the disk space a task needs to download and encode its source.
+
+    @param conn Redis connection holding the telemetry
+    @param source_size int bytes, or None if unknown
+    @param convertkey string
+    @return int bytes
+    """
+    if not source_size:
+        return DEFAULT_RESERVATION
+
+    return int(source_size * DOWNLOAD_OVERHEAD) + estimate_output_size(
+        conn, source_size, convertkey
+    )
@@ -23,9 +23,10 @@ from urllib.parse import urlparse
 from celery.utils.log import get_logger
 from yt_dlp.utils import std_headers, DownloadError
 
+from video2commons.backend.download import sourcecache
 from video2commons.exceptions import TaskError
-from video2commons.shared.ratelimiting import YoutubeDLRateLimited
-from video2commons.shared.yt_dlp import add_youtube_params
+from video2commons.shared.ratelimiting import YoutubeDLRateLimited, is_ratelimited
+from video2commons.shared.yt_dlp import add_youtube_params, get_cached_extraction
 
 DEFAULT_DOWNLOAD_MAXSIZE = 5 * (1 << 30)
 MP4_DOWNLOAD_MAXSIZE = 8 * (1 << 30)
@@ -41,8 +42,18 @@ def download(
     outputdir,
     statuscallback=None,
     errorcallback=None,
+    stream=False,
 ):
-    """Download a video from url to outputdir."""
+    """Download a video from url to outputdir.
+
+    If stream is set and the selected format is a single progressive file
+    served over plain HTTP, only the metadata and subtitles are written to
+    outputdir. The media URL is returned as the target instead so the encoder
+    can read it directly while it is being transferred.
+
+    Downloaded sources are kept in a cache on this host for restarted and
+    duplicate tasks, which then don't need to download them again.
+    """
 
     if url.startswith("uploads:"):
         # FIXME; this should be a configuration variable
@@ -56,6 +67,12 @@ def download(
     outputdir = os.path.abspath(outputdir)
     statuscallback = statuscallback or (lambda text, percent: None)
     errorcallback = errorcallback or (lambda text: None)
+
+    cached = sourcecache.lookup(url, formats, subtitles, outputdir)
+    if cached:
+        statuscallback("Using previously downloaded source", -1)
+        return cached
+
     outtmpl = outputdir + "/dl.%(ext)s"
 
     # Workaround for issue #360 that tweaks the download limits for files that
@@ -80,12 +97,6 @@ def download(
         "subtitlesformat": "srt/ass/vtt/best",
         "cachedir": "/tmp/",
         "noplaylist": True,  # not implemented in video2commons
-        "postprocessors": [
-            {
-                "key": "FFmpegSubtitlesConvertor",
-                "format": "srt",
-            }
-        ],
         "max_filesize": max_filesize,
         "retries": 10,
         "fragment_retries": 10,
@@ -94,6 +105,10 @@ def download(
         "logger": get_logger("celery.task.v2c.main.yt_dlp"),
     }
 
+    # Media from rate limited sites must go through yt-dlp so its sleeps and
+    # limits apply, so never hand those URLs to ffmpeg directly.
+    stream = stream and not is_ratelimited(url)
+
     old_ua = std_headers["User-Agent"]
     if ie_key == "Youtube":
         # HACK: Get equirectangular for 360° videos (ytdl-org/youtube-dl#15267)
@@ -118,23 +133,40 @@ def download(
         elif d["status"] == "error":
             errorcallback("Error raised by YoutubeDL")
 
+    def extract(dl, info=None):
+        dl.add_progress_hook(progresshook)
+        if info is not None:
+            return dl.process_ie_result(info, download=True)
+        if not stream:
+            return dl.extract_info(url, download=True, ie_key=None)
+
+        info = dl.extract_info(url, download=False, ie_key=None)
+        if is_streamable(info, max_filesize):
+            dl.params["skip_download"] = True
+
+        return dl.process_ie_result(info, download=True)
+
+    # Reuse the metadata the frontend extracted when the task was created,
+    # unless the download is streamed, which needs its own format selection.
+    cached_info = None if stream else get_cached_extraction(conn, url)
+
     statuscallback("Creating YoutubeDL instance", -1)
 
     try:
         # Not using provided ie_key because of the existance of extractors that
         # targets another extractor, such as TwitterIE.
         with YoutubeDLRateLimited(conn, "backend", url, params) as dl:
-            dl.add_progress_hook(progresshook)
             statuscallback("Preprocessing...", -1)
-            info = dl.extract_info(url, download=True, ie_key=None)
+            info = extract(dl, cached_info)
     except DownloadError:
+        # Also covers media URLs of the cached metadata that turned out not
+        # to work from this host, which are then extracted again.
         params["cachedir"] = False
         statuscallback(
             "Download failed. creating YoutubeDL instance without local cache", -1
         )
         with YoutubeDLRateLimited(conn, "backend", url, params) as dl:
-            dl.add_progress_hook(progresshook)
-            info = dl.extract_info(url, download=True, ie_key=None)
+            info = extract(dl)
 
     finally:
         std_headers["User-Agent"] = old_ua
@@ -142,30 +174,56 @@ def download(
     if info.get("webpage_url"):
         url_blacklisted(info["webpage_url"])
 
-    filename = outtmpl % {"ext": info["ext"]}
-    if not os.path.isfile(filename):
-        # https://github.com/rg3/youtube-dl/issues/8349
-        filename = outtmpl % {"ext": "mkv"}
-        assert os.path.isfile(filename), (
-            "Failed to determine the path of the downloaded video. "
-            + "Is the video too large?"
-        )
-
     ret = {
         "extractor": ie_key,
         "subtitles": {},
-        "target": filename,
+        "streaming": bool(dl.params.get("skip_download")),
+        "http_headers": {},
     }
 
-    for key in info.get("subtitles", {}):
-        # Postprocesed: converted to srt
-        filename = outtmpl % {"ext": key + ".srt"}
+    if ret["streaming"]:
+        url_blacklisted(info["url"])
+        ret["target"] = info["url"]
+        ret["http_headers"] = info.get("http_headers") or {}
+    else:
+        filename = outtmpl % {"ext": info["ext"]}
+        if not os.path.isfile(filename):
+            # https://github.com/rg3/youtube-dl/issues/8349
+            filename = outtmpl % {"ext": "mkv"}
+            assert os.path.isfile(filename), (
+                "Failed to determine the path of the downloaded video. "
+                + "Is the video too large?"
+            )
+        ret["target"] = filename
+
+    # Subtitles are kept in the format of the site, they are converted to
+    # SubRip in-process when they are uploaded.
+    for key, subtitle in (info.get("requested_subtitles") or {}).items():
+        filename = subtitle.get("filepath") or outtmpl % {
+            "ext": key + "." + subtitle["ext"]
+        }
         if os.path.isfile(filename):
             ret["subtitles"][key] = filename
 
+    sourcecache.store(url, formats, subtitles, ret)
+
     return ret
 
 
+def is_streamable(info, max_filesize=DEFAULT_DOWNLOAD_MAXSIZE):
+    """Check if ffmpeg can read the selected format directly from its URL."""
+    if info.get("_type", "video") != "video" or info.get("requested_formats"):
+        return False  # Playlists and separate video/audio need yt-dlp.
+
+    if info.get("protocol") not in ("http", "https") or not info.get("url"):
+        return False  # Segmented protocols (HLS, DASH) need yt-dlp.
+
+    # Leave oversized files to the regular download so it fails as usual, as
+    # well as files of unknown size, since ffmpeg doesn't enforce the limit.
+    filesize = info.get("filesize") or info.get("filesize_approx")
+    return bool(filesize) and filesize <= max_filesize
+
+
 def url_blacklisted(url):
     """Define download url blacklist."""
     parseresult = urlparse(url)
@@ -0,0 +1,174 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Cache of downloaded sources on the scratch area of this host."""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from video2commons.backend.diskspace import get_directory_size
+from video2commons.shared.yt_dlp import normalize_url
+
+CACHE_DIR = "/srv/v2c/cache"
+
+# The cache is trimmed to MAX_SIZE, least recently used entries first.
+# Sources larger than MAX_ENTRY_SIZE are not worth keeping.
+MAX_SIZE = 20 << 30
+MAX_ENTRY_SIZE = MAX_SIZE // 4
+
+META_FILE = "meta.json"
+
+
+def get_key(url, formats):
+    """Get the cache key of the source of a URL in a download format."""
+    key = normalize_url(url) + "\0" + (formats or "")
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def lookup(url, formats, subtitles, outputdir):
+    """
+    Place a cached source and its subtitles into outputdir.
+
+    The files are hard linked where possible, so the cache doesn't take any
+    extra space while a task uses them. Returns a download result like
+    download.download, or None if there is no usable entry.
+    """
+    entrydir = os.path.join(CACHE_DIR, get_key(url, formats))
+
+    try:
+        with open(os.path.join(entrydir, META_FILE)) as f:
+            meta = json.load(f)
+
+        # An entry downloaded without subtitles can't serve a task that wants
+        # them, but one with subtitles can serve any task.
+        if subtitles and not meta["with_subtitles"]:
+            return None
+
+        ret = {
+            "extractor": meta["extractor"],
+            "subtitles": {},
+            "streaming": False,
+            "http_headers": {},
+            "target": link_file(entrydir, meta["target"], outputdir),
+        }
+        if subtitles:
+            for lang, filename in meta["subtitles"].items():
+                ret["subtitles"][lang] = link_file(entrydir, filename, outputdir)
+
+        # Mark the entry as recently used.
+        os.utime(entrydir)
+    except (OSError, ValueError, KeyError):
+        return None  # Missing, partially evicted or corrupt
+
+    return ret
+
+
+def store(url, formats, subtitles, ret):
+    """
+    Add the files of a finished download to the cache.
+
+    Errors are only logged, since the task itself can go on without the cache.
+    """
+    if ret["streaming"]:
+        return
+
+    try:
+        size = os.path.getsize(ret["target"])
+        if size > MAX_ENTRY_SIZE:
+            return
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        entrydir = os.path.join(CACHE_DIR, get_key(url, formats))
+
+        # Build the entry aside and move it in place in one step, so that
+        # concurrent lookups never see a partial entry.
+        tmpdir = entrydir + ".tmp-%d" % os.getpid()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        os.makedirs(tmpdir)
+
+        meta = {
+            "url": url,
+            "formats": formats,
+            "extractor": ret["extractor"],
+            "target": os.path.basename(ret["target"]),
+            "subtitles": {},
+            "with_subtitles": bool(subtitles),
+            "time": int(time.time()),
+        }
+        link_file(os.path.dirname(ret["target"]), meta["target"], tmpdir)
+        for lang, path in ret["subtitles"].items():
+            meta["subtitles"][lang] = os.path.basename(path)
+            link_file(os.path.dirname(path), meta["subtitles"][lang], tmpdir)
+
+        with open(os.path.join(tmpdir, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(entrydir, ignore_errors=True)
+        os.rename(tmpdir, entrydir)
+    except OSError as e:
+        print("Unable to cache source:", e)
+        return
+
+    evict()
+
+
+def evict(size=0):
+    """
+    Drop the least recently used entries to keep the cache within MAX_SIZE.
+
+    If size is given, at least that many bytes are dropped as well, e.g. to
+    make room for a task that is waiting for disk space. Returns the number of
+    bytes dropped.
+    """
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return 0
+
+    entries = []
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            entries.append((os.stat(path).st_mtime, get_directory_size(path), path))
+        except OSError:
+            pass  # Evicted by another worker in the meantime
+
+    entries.sort()
+    total = sum(entry_size for _, entry_size, _ in entries)
+    dropped = 0
+    for _, entry_size, path in entries:
+        if total - dropped <= MAX_SIZE and dropped >= size:
+            break
+
+        shutil.rmtree(path, ignore_errors=True)
+        dropped += entry_size
+
+    return dropped
+
+
+def link_file(srcdir, filename, dstdir):
+    """Hard link a file into another directory, copying it if that fails."""
+    src = os.path.join(srcdir, filename)
+    dst = os.path.join(dstdir, filename)
+    if src == dst:
+        return dst
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+    return dst
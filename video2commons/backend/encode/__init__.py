@@ -19,22 +19,62 @@
 
 import os
 
-from .globals import ffmpeg_location, ffprobe_location
-from .helpers import get_video
+from .globals import distributed_min_duration
+from .helpers import get_video, is_url
+from .probecache import probe
 from .transcode import WebVideoTranscode
 from .transcodejob import WebVideoTranscodeJob
 
-# https://github.com/senko/python-video-converter
-from converter import Converter
 
+def encode(
+    source,
+    origkey,
+    statuscallback=None,
+    errorcallback=None,
+    concurrency=None,
+    targetbase=None,
+    source_headers=None,
+    telemetry=None,
+    requeue_on_low_memory=False,
+):
+    """Main encode function.
 
-def encode(source, origkey, statuscallback=None, errorcallback=None, concurrency=None):
-    """Main encode function."""
-    source = os.path.abspath(source)
+    The source may also be an HTTP URL, in which case targetbase must be set to
+    the path prefix of the encoded file and source_headers to the HTTP headers
+    needed to fetch it. If a telemetry dict is given, the resource usage of
+    each ffmpeg pass and the peak memory of the encoders are recorded in it. If requeue_on_low_memory is set,
+    InsufficientMemory is raised when the encoder can't fit in the free memory
+    of this host instead of encoding with a single thread.
+    """
+    if not is_url(source):
+        source = os.path.abspath(source)
+
+    info, key, preserve = prepare(source, origkey, source_headers)
+
+    target = (targetbase or source) + "." + key
+    job = WebVideoTranscodeJob(
+        source,
+        target,
+        key,
+        preserve,
+        statuscallback,
+        errorcallback,
+        info,
+        concurrency,
+        source_headers,
+        telemetry=telemetry,
+        requeue_on_low_memory=requeue_on_low_memory,
+    )
+
+    return target if job.run() else None
+
+
+def prepare(source, origkey, source_headers=None):
+    """Probe the source and pick the convert key and the streams to keep."""
     preserve = {"video": False, "audio": False}
 
-    c = Converter(ffmpeg_path=ffmpeg_location, ffprobe_path=ffprobe_location)
-    info = c.probe(source)
+    mediaprobe = probe(source, source_headers)
+    info = mediaprobe.mediainfo if mediaprobe else None
 
     targettype = WebVideoTranscode.settings.get(origkey)
     key = getbestkey(info, targettype, origkey) or origkey
@@ -48,6 +88,27 @@ def encode(source, origkey, statuscallback=None, errorcallback=None, concurrency
         if info.audio and info.audio.codec == targettype.get("audioCodec"):
             preserve["audio"] = True
 
+    return info, key, preserve
+
+
+def split(
+    source,
+    origkey,
+    workdir,
+    statuscallback=None,
+    errorcallback=None,
+    concurrency=None,
+):
+    """Split a long source into segments that other workers can encode.
+
+    The video is split at keyframes into workdir, which must be on storage
+    shared by all workers, and the audio is encoded locally. Returns a plan to
+    pass to encode_segment and join, or None if the source isn't long enough
+    to be worth distributing.
+    """
+    source = os.path.abspath(source)
+    info, key, preserve = prepare(source, origkey)
+
     target = source + "." + key
     job = WebVideoTranscodeJob(
         source,
@@ -60,9 +121,98 @@ def encode(source, origkey, statuscallback=None, errorcallback=None, concurrency
         concurrency,
     )
 
+    options = WebVideoTranscode.settings.get(key)
+    if not options or not job.can_split(options):
+        return None
+    if job.get_duration() < distributed_min_duration:
+        return None
+
+    os.makedirs(workdir, exist_ok=True)
+
+    job.output("Splitting video into segments")
+    status = job.ffmpeg_split(workdir)
+    if status is not True:
+        job.set_error(status, key)
+        return None
+
+    audio = None
+    if "noaudio" not in options:
+        job.output("Encoding audio")
+        audio = source + ".audio.mka"
+        status = job.ffmpeg_encode_audio(options, audio)
+        if status is not True:
+            job.set_error(status, key)
+            return None
+
+    segments = sorted(
+        os.path.join(workdir, file)
+        for file in os.listdir(workdir)
+        if file.startswith("segment") and file.endswith(".mkv")
+    )
+
+    return {
+        "source": source,
+        "target": target,
+        "key": key,
+        "segmentkey": job.get_segment_key(),
+        "workdir": workdir,
+        "segments": segments,
+        "audio": audio,
+    }
+
+
+def encode_segment(
+    segment, key, statuscallback=None, errorcallback=None, concurrency=None
+):
+    """Encode a single segment of a split source."""
+    mediaprobe = probe(segment)
+
+    target = segment + ".webm"
+    job = WebVideoTranscodeJob(
+        segment,
+        target,
+        key,
+        {"video": False, "audio": False},
+        statuscallback,
+        errorcallback,
+        mediaprobe.mediainfo if mediaprobe else None,
+        concurrency,
+    )
+
     return target if job.run() else None
 
 
+def join(plan, segments, statuscallback=None, errorcallback=None):
+    """Join the encoded segments of a split source with its audio."""
+    job = WebVideoTranscodeJob(
+        plan["source"],
+        plan["target"],
+        plan["key"],
+        {},
+        statuscallback,
+        errorcallback,
+    )
+
+    job.output("Joining %d segments" % len(segments))
+    status = job.ffmpeg_concat(segments, plan["audio"], plan["workdir"])
+
+    if status is True and os.path.getsize(job.get_target_path()) > 0:
+        return plan["target"]
+
+    job.set_error(status, plan["key"])
+    return None
+
+
+def supports_streaming(key):
+    """Check if a convert key can encode from a source that is still arriving.
+
+    Two-pass encodes need to read the source twice, so they can't be fed from a
+    stream and need the whole file on disk first.
+    """
+    targettype = WebVideoTranscode.settings.get(key)
+    return bool(targettype) and targettype.get("twopass") != "True"
+
+
 def getbestkey(info, targettype, origkey):
     """Find the best convert key to use."""
 
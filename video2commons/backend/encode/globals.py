@@ -34,12 +34,76 @@ background_time_limit = 3600 * 24 * 2  # 2 days
 # anyway, so there's no point in allowing anything higher than that.
 background_size_limit = 10 * 1024 * 1024
 
+# Encodes are stopped as soon as the output size projected from their progress
+# is clearly above the upload limit, instead of hours later by `ulimit -f`.
+# The projection is trusted after output_size_min_progress percent, and must
+# exceed the limit by a margin that shrinks from output_size_uncertainty to
+# nothing as the encode progresses, since bitrates vary along a video.
+output_size_limit = background_size_limit * 512
+output_size_min_progress = 5
+output_size_uncertainty = 0.5
+
+# Stopped CRF encodes are retried once with a CRF expected to bring the output
+# down to output_size_target of the limit, up to output_size_max_crf.
+output_size_target = 0.9
+output_size_max_crf = 63
+
 # Number of hardware threads available to ffmpeg for transcoding.
 ffmpeg_threads = __import__("multiprocessing").cpu_count()
 
-# The maximum number of threads to use for 4k (and higher) AV1 transcoding.
-# This is required due to limited memory on the workers.
-av1_max_threads_4k = 4
+# Ledger in which the transcode jobs of a host lease their share of the
+# threads above. It must be on local storage shared by all worker processes.
+thread_ledger_path = "/tmp/v2c-thread-leases.json"
+
+# Model of the peak memory of an encoder in bytes: a base cost plus, for each
+# pixel of a frame, a cost per codec and a cost per codec and thread. Jobs
+# lower their thread count until the estimate fits in the free memory.
+encoder_memory_base = 200 << 20
+encoder_memory_per_pixel = {
+    "av1": 150,
+    "vp9": 60,
+    "vp8": 30,
+    "theora": 20,
+    "h264": 40,
+}
+encoder_memory_per_thread = {
+    "av1": 60,
+    "vp9": 12,
+    "vp8": 6,
+    "theora": 0,
+    "h264": 8,
+}
+
+# Memory left free for the system and the worker processes themselves.
+memory_reserve = 512 << 20
+
+# Interval in seconds at which the memory of running encoders is sampled to
+# record their peak in the telemetry of the task.
+memory_sample_interval = 5
+
+# Sources at least this long (in seconds) are split at keyframes and their
+# segments are encoded in parallel, since a single libvpx or SVT-AV1 process
+# can't make use of all the threads available to it.
+segment_min_duration = 20 * 60
+
+# Target length of each segment in seconds. The actual cut is made at the first
+# keyframe after this, so segments are usually slightly longer.
+segment_duration = 5 * 60
+
+# Number of threads given to each ffmpeg process encoding a segment.
+segment_threads = 2
+
+# Sources at least this long (in seconds) have their segments encoded by
+# separate tasks, so they can be spread over all workers instead of one host.
+distributed_min_duration = 2 * 3600
+
+# Storage mounted by every worker where the segments of distributed encodes are
+# exchanged. Distributed encoding is disabled if it isn't mounted.
+shared_segment_dir = "/data/scratch/video2commons/segments"
+
+# Number of ffprobe results kept in memory by each worker process. Every task
+# probes its source, its output and any subtitle files several times.
+probe_cache_size = 64
 
 # Location of the avconv/ffmpeg binary (used to encode WebM and for thumbnails)
 ffmpeg_location = "/mnt/nfs/labstore-secondary-project/gentoo-prefix/usr/bin/ffmpeg"
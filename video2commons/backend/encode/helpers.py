@@ -13,6 +13,8 @@
 
 """Helper function for the encode module."""
 
+from urllib.parse import urlparse
+
 
 def get_video(info):
     """Returns the first video stream from a MediaInfo object.
@@ -28,3 +30,13 @@ def get_video(info):
             return stream
 
     return None
+
+
+def is_url(source):
+    """Check if a source is a remote URL that is read by ffmpeg directly."""
+    return urlparse(source).scheme in ("http", "https")
+
+
+def format_headers(headers):
+    """Format HTTP headers as the value of the ffmpeg -headers option."""
+    return "".join("%s: %s\r\n" % (name, value) for name, value in headers.items())
@@ -0,0 +1,144 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Estimate and track the memory used by encoders on this host."""
+
+import os
+
+from .globals import (
+    encoder_memory_base,
+    encoder_memory_per_pixel,
+    encoder_memory_per_thread,
+    memory_reserve,
+)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def estimate_encoder_memory(video, options, threads):
+    """
+    Estimate the peak RSS of an ffmpeg process encoding a video stream.
+
+    @param video MediaStreamInfo of the source video
+    @param options array Transcode settings
+    @param threads int
+    @return int bytes
+    """
+    pixels = (video.video_width or 0) * (video.video_height or 0)
+    return estimate_memory(pixels, options, threads)
+
+
+def estimate_memory(pixels, options, threads):
+    """
+    Estimate the peak RSS of an ffmpeg process encoding frames of a size.
+
+    Encoders keep a number of frames in flight that grows with the number of
+    threads working on them, and SVT-AV1 keeps more of them at slower presets.
+
+    @param pixels int Pixels in a frame, 0 if there is no video
+    @param options array Transcode settings
+    @param threads int
+    @return int bytes
+    """
+    codec = options.get("videoCodec")
+    per_pixel = encoder_memory_per_pixel.get(codec, 0)
+    per_pixel += encoder_memory_per_thread.get(codec, 0) * threads
+
+    if codec == "av1" and "preset" in options:
+        per_pixel *= 1 + max(0, 8 - int(options["preset"])) * 0.1
+
+    return int(encoder_memory_base + pixels * per_pixel)
+
+
+def get_available_memory():
+    """
+    Get the memory that can be used without swapping, from /proc/meminfo.
+
+    @return int bytes, or None if it is unknown
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def get_process_group_rss(pgid):
+    """
+    Get the total RSS of the processes of a process group.
+
+    @param pgid int
+    @return int bytes
+    """
+    return get_process_groups_rss([pgid])
+
+
+def get_process_groups_rss(pgids):
+    """
+    Get the total RSS of the processes of several process groups.
+
+    @param pgids list of int
+    @return int bytes
+    """
+    if not pgids:
+        return 0
+
+    pgids = set(pgids)
+    rss = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                stat = f.read()
+        except OSError:
+            continue  # The process has exited in the meantime
+
+        # The command name may contain spaces, the other fields can't.
+        fields = stat[stat.rindex(")") + 2 :].split()
+        if int(fields[2]) in pgids:
+            rss += int(fields[21]) * PAGE_SIZE
+
+    return rss
+
+
+def get_memory_headroom(lease=None):
+    """
+    Get the memory a new encoder may use on this host.
+
+    Memory that other jobs reserved for their encoders but don't use yet is
+    not available, since those encoders are still growing towards their peak.
+
+    @param lease ThreadLease of the asking job, if any
+    @return int bytes, or None if it is unknown
+    """
+    available = get_available_memory()
+    if available is None:
+        return None
+
+    if lease:
+        try:
+            reservations = lease.get_other_reservations()
+        except OSError:
+            reservations = []
+
+        for reserved, pgid in reservations:
+            used = get_process_group_rss(pgid) if pgid else 0
+            available -= max(0, reserved - used)
+
+    return available - memory_reserve
@@ -0,0 +1,133 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Cached ffprobe results shared by the backend modules."""
+
+import json
+import os
+import subprocess
+import threading
+
+from collections import OrderedDict
+from functools import cached_property
+
+from converter.ffmpeg import MediaInfo, MediaStreamInfo
+
+from .globals import ffprobe_location, probe_cache_size
+from .helpers import format_headers, is_url
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class MediaProbe:
+    """The streams and format of a media file as reported by ffprobe."""
+
+    def __init__(self, data):
+        self.streams = data.get("streams", [])
+        self.format = data.get("format", {})
+
+    def get_streams(self, codec_type):
+        """Returns all streams of a type (video, audio, subtitle, ...)."""
+        return [s for s in self.streams if s.get("codec_type") == codec_type]
+
+    def has_video(self):
+        """Check if the file has a video track."""
+        return bool(self.get_streams("video"))
+
+    def has_audio(self):
+        """Check if the file has an audio track."""
+        return bool(self.get_streams("audio"))
+
+    @cached_property
+    def mediainfo(self):
+        """
+        The probe as a MediaInfo object of the Converter library.
+
+        This is None for files that are not media files, as with
+        Converter.probe().
+        """
+        info = MediaInfo()
+
+        for stream in self.streams:
+            current = MediaStreamInfo()
+            for key, value in _flatten(stream):
+                current.parse_ffprobe(key, value)
+            if current.type:
+                info.streams.append(current)
+
+        for key, value in _flatten(self.format):
+            info.format.parse_ffprobe(key, value)
+
+        if not info.format.format and not info.streams:
+            return None
+
+        return info
+
+
+def _flatten(section):
+    """Convert a JSON ffprobe section to the keys of its default output."""
+    for key, value in section.items():
+        if key == "tags":
+            for tag, tagvalue in value.items():
+                yield "TAG:" + tag, str(tagvalue)
+        elif key == "disposition":
+            for name, flag in value.items():
+                yield "DISPOSITION:" + name, str(flag)
+        elif not isinstance(value, (dict, list)):
+            yield key, str(value)
+
+
+def probe(source, headers=None):
+    """
+    Probe a media file or URL, reusing an earlier probe when possible.
+
+    Local files are cached by path, size and modification time, so a file
+    that is rewritten (e.g. by an encode to the same path) is probed again.
+    Returns None if ffprobe fails to read the source.
+    """
+    if is_url(source):
+        key = (source, tuple(sorted((headers or {}).items())))
+    else:
+        source = os.path.abspath(source)
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        key = (source, st.st_size, st.st_mtime_ns)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    cmd = [ffprobe_location, "-loglevel", "error"]
+    if headers and is_url(source):
+        cmd += ["-headers", format_headers(headers)]
+    cmd += ["-show_streams", "-show_format", "-of", "json", source]
+
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+
+    try:
+        mediaprobe = MediaProbe(json.loads(result.stdout))
+    except ValueError:
+        return None
+
+    with _cache_lock:
+        _cache[key] = mediaprobe
+        while len(_cache) > probe_cache_size:
+            _cache.popitem(last=False)
+
+    return mediaprobe
@@ -0,0 +1,108 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Share the threads and memory of a host between the jobs running on it."""
+
+import os
+import uuid
+
+from video2commons.backend.ledger import Ledger
+
+from .globals import ffmpeg_threads, thread_ledger_path
+
+
+class ThreadLease:
+    """
+    A lease on a share of the hardware threads of this host.
+
+    All transcode jobs on a host register their lease in a ledger file. The
+    threads are split evenly between the leases every time a job asks for its
+    thread count, so a job running alone gets every thread while jobs that
+    start later shrink the share of the others from their next ffmpeg command
+    on. Leases of processes that died without releasing are discarded.
+
+    Leases also hold the memory reserved for the running encoder of their job
+    and its process group, so that jobs can tell how much memory others are
+    still going to need.
+    """
+
+    def __init__(self, path=thread_ledger_path, total=ffmpeg_threads):
+        self.path = path
+        self.total = total
+        self.id = "%d-%s" % (os.getpid(), uuid.uuid4().hex)
+        self.threads = None
+
+        with self._ledger() as ledger:
+            ledger[self.id] = {"pid": os.getpid(), "threads": 0}
+
+    def get_threads(self):
+        """
+        Get the number of threads this lease may use right now.
+
+        @return int
+        """
+        with self._ledger() as ledger:
+            if self.id not in ledger:
+                ledger[self.id] = {"pid": os.getpid(), "threads": 0}
+
+            self.threads = max(1, self.total // len(ledger))
+            ledger[self.id]["threads"] = self.threads
+
+        return self.threads
+
+    def reserve_memory(self, memory):
+        """
+        Reserve memory for the encoder this job is about to start.
+
+        @param memory int bytes
+        """
+        with self._ledger() as ledger:
+            ledger.setdefault(self.id, {"pid": os.getpid(), "threads": 0})
+            ledger[self.id].update({"memory": memory, "pgid": None})
+
+    def set_process_group(self, pgid):
+        """
+        Record the process group of the running encoder of this job.
+
+        @param pgid int
+        """
+        with self._ledger() as ledger:
+            if self.id in ledger:
+                ledger[self.id]["pgid"] = pgid
+
+    def get_other_reservations(self):
+        """
+        Get the memory reserved by the other jobs and their process groups.
+
+        @return list of (int bytes, int pgid or None) tuples
+        """
+        with self._ledger() as ledger:
+            return [
+                (lease.get("memory", 0), lease.get("pgid"))
+                for id, lease in ledger.items()
+                if id != self.id
+            ]
+
+    def release(self):
+        """Give the threads of this lease back to the other jobs."""
+        with self._ledger() as ledger:
+            ledger.pop(self.id, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _ledger(self):
+        return Ledger(self.path)
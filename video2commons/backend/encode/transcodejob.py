@@ -28,26 +28,47 @@ WebVideoTranscode/WebVideoTranscodeJob.php under GPLv2
 """
 
 import os
-import re
 import math
-import time
+import shutil
+import collections
 import subprocess
 import signal
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from .transcode import WebVideoTranscode
 from .globals import (
     background_priority,
     background_time_limit,
     background_size_limit,
+    output_size_limit,
+    output_size_max_crf,
+    output_size_min_progress,
+    output_size_target,
+    output_size_uncertainty,
     ffmpeg_threads,
     ffmpeg_location,
     escape_shellarg,
-    time_to_seconds,
-    av1_max_threads_4k,
+    format_size,
+    format_time,
+    segment_min_duration,
+    segment_duration,
+    segment_threads,
+    memory_sample_interval,
+)
+from .helpers import format_headers, get_video, is_url
+from .probecache import probe
+from .memory import (
+    estimate_encoder_memory,
+    get_memory_headroom,
+    get_process_groups_rss,
 )
-from .helpers import get_video
+from .threadlease import ThreadLease
 
-from video2commons.exceptions import TaskAbort
+from video2commons.exceptions import InsufficientMemory, TaskAbort
+from video2commons.shared.telemetry import measure_stage
 
 
 class WebVideoTranscodeJob(object):
@@ -63,9 +84,16 @@ class WebVideoTranscodeJob(object):
         errorcallback=None,
         source_info=None,
         concurrency=None,
+        source_headers=None,
+        threads=None,
+        telemetry=None,
+        requeue_on_low_memory=False,
+        options=None,
     ):
         """Initialize the instance."""
-        self.source = os.path.abspath(source)
+        self.streaming = is_url(source)
+        self.source = source if self.streaming else os.path.abspath(source)
+        self.source_headers = source_headers or {}
         self.target = os.path.abspath(target)
         self.key = key
         self.preserve = {"video": False, "audio": False}
@@ -74,6 +102,15 @@ class WebVideoTranscodeJob(object):
         self.errorcallback = errorcallback or (lambda text: None)
         self.removeDuplicates = True
         self.source_info = source_info
+        self.threads = threads
+        self.lease = None
+        self.telemetry = telemetry
+        self.requeue_on_low_memory = requeue_on_low_memory
+        self.options = options
+        self.output_too_large = None
+        self.pgid = None
+        self.maxrss = 0
+        self.next_memory_sample = 0
 
         if concurrency:
             self.concurrency = min(max(concurrency, 1), ffmpeg_threads)
@@ -121,7 +158,10 @@ class WebVideoTranscodeJob(object):
         @return string|bool
         """
         if not hasattr(self, "sourceFilePath"):
-            self.sourceFilePath = self.get_file().name
+            if self.streaming:
+                self.sourceFilePath = self.source
+            else:
+                self.sourceFilePath = self.get_file().name
 
         return self.sourceFilePath
 
@@ -141,12 +181,13 @@ class WebVideoTranscodeJob(object):
         @return boolean success
         """
         # get a local pointer to the file
-        file = self.get_file()
+        if not self.streaming:
+            file = self.get_file()
 
-        # Validate the file exists:
-        if not file:
-            self.set_error(self.source + ": File not found ")
-            return False
+            # Validate the file exists:
+            if not file:
+                self.set_error(self.source + ": File not found ")
+                return False
 
         # Validate the transcode key param:
         transcode_key = self.key
@@ -157,50 +198,144 @@ class WebVideoTranscodeJob(object):
             return False
 
         # Validate the source exists:
-        if not self.get_source_path() or not os.path.isfile(self.get_source_path()):
+        if not self.source_exists():
             status = self.source + ": Source not found"
             self.set_error(status, transcode_key)
             return False
 
-        options = WebVideoTranscode.settings[transcode_key]
+        # Options may be overridden, e.g. for segments of a smaller encode.
+        options = self.options or WebVideoTranscode.settings[transcode_key]
 
         if "novideo" in options:
             self.output("Encoding to audio codec: " + options["audioCodec"])
         else:
             self.output("Encoding to codec: " + options["videoCodec"])
 
+        # Share the threads of the host with the other jobs running on it,
+        # unless a fixed thread count was given (e.g. for segment encodes).
+        if not self.threads:
+            try:
+                self.lease = ThreadLease()
+            except OSError as e:
+                print("Unable to lease threads:", e)
+
+        try:
+            status = self.ffmpeg_encode_with_options(options)
+
+            # Encodes stopped because their output would be too large to
+            # upload get one more try at a quality that should fit.
+            smaller = self.get_smaller_options(options)
+            if isinstance(status, str) and smaller:
+                self.output(
+                    "Output would be too large, retrying with CRF %d" % smaller["crf"]
+                )
+                status = self.ffmpeg_encode_with_options(smaller)
+        finally:
+            if self.lease:
+                self.lease.release()
+                self.lease = None
+
+        if self.telemetry is not None and self.maxrss:
+            self.telemetry["maxrss"] = self.maxrss
+
+        self.remove_ffmpeg_log_files()
+
+        # If status is oky and target does not exist, reset status
+        if status is True and not os.path.isfile(self.get_target_path()):
+            status = "Target does not exist: " + self.get_target_path()
+
+        # If status is ok and target is larger than 0 bytes
+        if status is True and os.path.getsize(self.get_target_path()) > 0:
+            pass  # Done
+        else:
+            # Update the transcode table with failure time and error
+            self.set_error(status, transcode_key)
+
+        return status is True
+
+    def ffmpeg_encode_with_options(self, options):
+        """
+        Run the encode method for a set of options.
+
+        @param options array
+        @return bool|string
+        """
         # Check the codec see which encode method to call
         if "novideo" in options or self.preserve["video"]:
-            status = self.ffmpeg_encode(options)
+            return self.ffmpeg_encode(options)
         elif options["videoCodec"] in ["vp8", "vp9", "h264", "av1"] or (
             options["videoCodec"] == "theora"
         ):
+            # Check for long sources that are worth encoding in parallel:
+            if self.use_segments(options):
+                return self.ffmpeg_encode_segmented(options)
             # Check for twopass:
-            if "twopass" in options and options["twopass"] == "True":
+            elif "twopass" in options and options["twopass"] == "True":
                 # ffmpeg requires manual two pass
                 status = self.ffmpeg_encode(options, 1)
                 if status and not isinstance(status, str):
                     status = self.ffmpeg_encode(options, 2)
+                return status
             else:
-                status = self.ffmpeg_encode(options)
+                return self.ffmpeg_encode(options)
         else:
             self.output("Error unknown codec:" + options["videoCodec"])
-            status = "Error unknown target codec:" + options["videoCodec"]
+            return "Error unknown target codec:" + options["videoCodec"]
 
-        self.remove_ffmpeg_log_files()
+    def get_smaller_options(self, options):
+        """
+        Get options for a smaller output after an encode was too large.
 
-        # If status is oky and target does not exist, reset status
-        if status is True and not os.path.isfile(self.get_target_path()):
-            status = "Target does not exist: " + self.get_target_path()
+        @param options array
+        @return array, or None if the output can't be made smaller
+        """
+        projected_size = self.output_too_large
+        self.output_too_large = None
 
-        # If status is ok and target is larger than 0 bytes
-        if status is True and os.path.getsize(self.get_target_path()) > 0:
-            pass  # Done
-        else:
-            # Update the transcode table with failure time and error
-            self.set_error(status, transcode_key)
+        if not projected_size or "crf" not in options:
+            return None
+        if "novideo" in options or self.preserve["video"]:
+            return None
 
-        return status is True
+        # Every 6 steps of CRF roughly halve the bitrate.
+        ratio = projected_size / (output_size_limit * output_size_target)
+        crf = int(options["crf"]) + max(1, math.ceil(6 * math.log2(ratio)))
+        crf = min(crf, output_size_max_crf)
+        if crf <= int(options["crf"]):
+            return None
+
+        return dict(options, crf=crf)
+
+    def is_output_too_large(self, progress):
+        """
+        Check if the output of an encode is going to exceed the upload limit.
+
+        @param progress dict As returned by parse_progress
+        @return bool
+        """
+        if progress["size"] and progress["size"] > output_size_limit:
+            return True
+
+        percent = progress["percent"]
+        if not progress["projected_size"] or not percent:
+            return False
+        if percent < output_size_min_progress:
+            return False
+
+        margin = 1 + output_size_uncertainty * (1 - percent / 100)
+        return progress["projected_size"] > output_size_limit * margin
+
+    def source_exists(self):
+        """
+        Check if the source is available to be read.
+
+        @return bool
+        """
+        if self.streaming:
+            return True  # Remote sources are only checked once ffmpeg runs.
+
+        source = self.get_source_path()
+        return bool(source) and os.path.isfile(source)
 
     def remove_ffmpeg_log_files(self):
         """Remove any log files."""
@@ -221,7 +356,7 @@ class WebVideoTranscodeJob(object):
         @param p int
         @return bool|string
         """
-        if not os.path.isfile(self.get_source_path()):
+        if not self.source_exists():
             return (
                 "source file is missing, "
                 + self.get_source_path()
@@ -229,11 +364,12 @@ class WebVideoTranscodeJob(object):
             )
 
         # Set up the base command
-        cmd = (
-            escape_shellarg(ffmpeg_location)
-            + " -y -i "
-            + escape_shellarg(self.get_source_path())
-        )
+        cmd = self.ffmpeg_get_command()
+
+        if self.streaming:
+            cmd += self.ffmpeg_add_input_options()
+
+        cmd += " -i " + escape_shellarg(self.get_source_path())
 
         cmd += " -max_muxing_queue_size 4096"
 
@@ -290,13 +426,344 @@ class WebVideoTranscodeJob(object):
         self.output("Running cmd: " + cmd + "\n")
 
         # Right before we output remove the old file
-        retval, shellOutput = self.run_shell_exec(cmd, track=p != 1)
+        with measure_stage(self.telemetry, "encode-pass%d" % p):
+            retval, shellOutput = self.run_shell_exec(cmd, track=p != 1)
+
+        if int(retval) != 0:
+            return cmd + "\n" + shellOutput + "Exitcode: " + str(retval)
+
+        return True
+
+    def can_split(self, options):
+        """
+        Check if the video can be split into segments encoded separately.
+
+        @param options array
+        @return bool
+        """
+        if self.streaming or self.preserve["video"] or "novideo" in options:
+            return False
+
+        # Segments are concatenated into a WebM container afterwards.
+        if options["videoCodec"] not in ["vp8", "vp9", "av1"]:
+            return False
+
+        return self.get_segment_key() in WebVideoTranscode.settings
+
+    def use_segments(self, options):
+        """
+        Check if the video should be split and encoded in parallel segments.
+
+        @param options array
+        @return bool
+        """
+        if not self.can_split(options):
+            return False
+
+        if self.get_duration() < segment_min_duration:
+            return False
+
+        # There is no point in splitting if only one segment runs at a time.
+        return self.ffmpeg_get_thread_count() >= 2 * segment_threads
+
+    def get_duration(self):
+        """
+        Get the duration of the source in seconds, or 0 if it is unknown.
+
+        @return float
+        """
+        if not self.source_info or not self.source_info.format.duration:
+            return 0
+
+        return self.source_info.format.duration
+
+    def get_segment_key(self):
+        """
+        Get the transcode key used for the video-only segments.
+
+        @return string
+        """
+        return self.key if self.key.startswith("an.") else "an." + self.key
+
+    def ffmpeg_encode_segmented(self, options):
+        """
+        Encode the video in keyframe-aligned segments in parallel.
+
+        The video stream is split at keyframes without re-encoding, every
+        segment is encoded by its own job (honouring two-pass and the other
+        settings of the profile), and the results are concatenated with the
+        audio without re-encoding either of them.
+
+        @param options array
+        @return bool|string
+        """
+        workdir = self.get_target_path() + ".segments"
+        os.makedirs(workdir, exist_ok=True)
+
+        try:
+            self.output("Splitting video into segments")
+            status = self.ffmpeg_split(workdir)
+            if status is not True:
+                return status
+
+            segments = sorted(
+                os.path.join(workdir, file)
+                for file in os.listdir(workdir)
+                if file.startswith("segment") and file.endswith(".mkv")
+            )
+            if not segments:
+                return "No segments were created from " + self.get_source_path()
+
+            audio = None
+            if "noaudio" not in options:
+                self.output("Encoding audio")
+                audio = os.path.join(workdir, "audio.mka")
+                status = self.ffmpeg_encode_audio(options, audio)
+                if status is not True:
+                    return status
+
+            status = self.ffmpeg_encode_segments(segments, options)
+            if status is not True:
+                return status
+
+            self.output("Joining %d segments" % len(segments))
+            return self.ffmpeg_concat(
+                [segment + ".webm" for segment in segments], audio, workdir
+            )
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def ffmpeg_split(self, workdir):
+        """
+        Split the video stream of the source at keyframes.
+
+        @param workdir string
+        @return bool|string
+        """
+        cmd = self.ffmpeg_get_command()
+        cmd += " -i " + escape_shellarg(self.get_source_path())
+        cmd += " -map 0:v:0 -c copy -f segment"
+        cmd += " -segment_time " + escape_shellarg(segment_duration)
+        cmd += " -reset_timestamps 1"
+        cmd += " " + escape_shellarg(os.path.join(workdir, "segment%05d.mkv"))
+
+        self.output("Running cmd: " + cmd + "\n")
+        retval, shellOutput = self.run_shell_exec(cmd, track=False)
+
+        if int(retval) != 0:
+            return cmd + "\n" + shellOutput + "Exitcode: " + str(retval)
+
+        return True
+
+    def ffmpeg_encode_audio(self, options, target):
+        """
+        Encode the audio of the source on its own.
+
+        @param options array
+        @param target string
+        @return bool|string
+        """
+        cmd = self.ffmpeg_get_command()
+        cmd += " -i " + escape_shellarg(self.get_source_path())
+        cmd += " -max_muxing_queue_size 4096 -map_metadata 0 -vn"
+
+        if self.preserve["audio"]:
+            cmd += " -acodec copy"
+        else:
+            cmd += self.ffmpeg_add_audio_options(options, 0)
+
+        cmd += " -f matroska " + escape_shellarg(target)
+
+        self.output("Running cmd: " + cmd + "\n")
+        retval, shellOutput = self.run_shell_exec(cmd, track=False)
+
+        if int(retval) != 0:
+            return cmd + "\n" + shellOutput + "Exitcode: " + str(retval)
+
+        return True
+
+    def ffmpeg_encode_segments(self, segments, options):
+        """
+        Encode video segments in parallel with separate jobs.
+
+        The output size is projected from all segments together, so encodes
+        that would be too large are stopped as early as unsegmented ones.
+
+        @param segments list
+        @param options array Transcode settings of the whole video
+        @return bool|string
+        """
+        workers = max(1, self.ffmpeg_get_thread_count() // segment_threads)
+
+        # Segments are encoded with the video settings of the whole video,
+        # which may have been changed for a smaller output.
+        segment_options = WebVideoTranscode.settings[self.get_segment_key()]
+        if "crf" in options:
+            segment_options = dict(segment_options, crf=options["crf"])
+
+        # Only run as many encoders in parallel as there is memory for.
+        video = get_video(self.source_info)
+        headroom = get_memory_headroom(self.lease) if video else None
+        if headroom is not None:
+            memory = estimate_encoder_memory(video, segment_options, segment_threads)
+            workers = max(1, min(workers, headroom // memory))
+            self.reserve_memory(memory * workers)
+        self.output(
+            "Encoding %d segments with %d parallel encoders" % (len(segments), workers)
+        )
+
+        lock = threading.Lock()
+        progress = [0] * len(segments)
+        sizes = [0] * len(segments)
+        jobs = [None] * len(segments)
+        errors = []
+        failed = threading.Event()
+
+        def statuscallback(index):
+            def callback(text, percent):
+                # Stop the other encoders as soon as one of them fails.
+                if failed.is_set():
+                    raise TaskAbort
+
+                with lock:
+                    if percent is not None and percent >= 0:
+                        progress[index] = percent
+                        sizes[index] = jobs[index].progress["size"] or sizes[index]
+                    total = sum(progress) / len(progress)
+
+                    # The encoders run at the same time, so their memory adds up.
+                    self.sample_memory([job.pgid for job in jobs if job and job.pgid])
+
+                    # Segments are of about the same duration, so the output
+                    # grows with the progress of all of them.
+                    size = sum(sizes)
+                    projected = {
+                        "size": size,
+                        "percent": total,
+                        "projected_size": size * 100 / total if total else None,
+                    }
+                    if self.is_output_too_large(projected):
+                        self.output_too_large = projected["projected_size"] or size
+                        failed.set()
+                        raise TaskAbort
+
+                self.statuscallback(None, int(total))
+
+            return callback
+
+        def encode(index):
+            if failed.is_set():
+                return  # Don't start encoders that would be stopped anyway
+
+            errors_segment = []
+            # Progress is tracked against the duration of the segment.
+            mediaprobe = probe(segments[index])
+            job = WebVideoTranscodeJob(
+                segments[index],
+                segments[index] + ".webm",
+                self.get_segment_key(),
+                {"video": False, "audio": False},
+                statuscallback(index),
+                errors_segment.append,
+                (mediaprobe and mediaprobe.mediainfo) or self.source_info,
+                threads=segment_threads,
+                options=segment_options,
+            )
+            jobs[index] = job
+            try:
+                if not job.run():
+                    errors.extend(errors_segment)
+                    failed.set()
+            except BaseException:
+                failed.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(encode, i) for i in range(len(segments))]
+
+            aborted = None
+            for future in futures:
+                try:
+                    future.result()
+                except TaskAbort as e:
+                    # Sibling failures are also reported with TaskAbort, so
+                    # prefer reporting the original error if there was one.
+                    aborted = aborted or e
+
+        if errors:
+            return "\n".join(str(error) for error in errors)
+
+        if self.output_too_large:
+            return (
+                "Output too large: projected size of %s exceeds the upload limit "
+                "of %s"
+                % (format_size(self.output_too_large), format_size(output_size_limit))
+            )
+
+        if aborted:
+            raise aborted
+
+        return True
+
+    def ffmpeg_concat(self, segments, audio, workdir):
+        """
+        Join encoded segments and audio into the target without re-encoding.
+
+        @param segments list
+        @param audio string|None
+        @param workdir string
+        @return bool|string
+        """
+        listfile = os.path.join(workdir, "segments.txt")
+        with open(listfile, "w") as f:
+            for segment in segments:
+                f.write("file '%s'\n" % segment.replace("'", "'\\''"))
+
+        cmd = self.ffmpeg_get_command()
+        cmd += " -f concat -safe 0 -i " + escape_shellarg(listfile)
+
+        if audio:
+            cmd += " -i " + escape_shellarg(audio)
+            cmd += " -map 0:v -map 1:a -map_metadata 1"
+        else:
+            cmd += " -map 0:v -map_metadata 0"
+
+        cmd += " -c copy -f webm " + escape_shellarg(self.get_target_path())
+
+        self.output("Running cmd: " + cmd + "\n")
+        retval, shellOutput = self.run_shell_exec(cmd, track=False)
 
         if int(retval) != 0:
-            return cmd + "\nExitcode: " + str(retval)
+            return cmd + "\n" + shellOutput + "Exitcode: " + str(retval)
 
         return True
 
+    def ffmpeg_get_command(self):
+        """
+        Get the base ffmpeg command, reporting progress on stdout.
+
+        @return string
+        """
+        return (
+            escape_shellarg(ffmpeg_location)
+            + " -y -nostdin -nostats -loglevel error -progress pipe:1"
+        )
+
+    def ffmpeg_add_input_options(self):
+        """
+        Add ffmpeg shell options for reading the source over HTTP.
+
+        @return string
+        """
+        # Reconnect when the server drops the connection, which is common for
+        # multi-GB transfers that take as long as the encode to complete.
+        cmd = " -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 30"
+
+        if self.source_headers:
+            cmd += " -headers " + escape_shellarg(format_headers(self.source_headers))
+
+        return cmd
+
     def ffmpeg_add_h264_video_options(self, options, p):
         """
         Add ffmpeg shell options for h264.
@@ -306,7 +773,8 @@ class WebVideoTranscodeJob(object):
         @return string
         """
         # Set the codec:
-        cmd = " -threads " + str(self.ffmpeg_get_thread_count()) + " -vcodec libx264"
+        threads = self.ffmpeg_get_video_thread_count(options)
+        cmd = " -threads " + str(threads) + " -vcodec libx264"
 
         if "videoBitrate" in options:
             cmd += " -b " + escape_shellarg(options["videoBitrate"])
@@ -323,14 +791,7 @@ class WebVideoTranscodeJob(object):
         @param p
         @return string
         """
-        threads = self.ffmpeg_get_thread_count()
-
-        # Workaround: Limit the number of threads for 4k (and higher) video for
-        # AV1 transcoding due to limited memory on the workers.
-        video = get_video(self.source_info)
-        if video:
-            if video.video_width >= 3840 or video.video_height >= 2160:
-                threads = min(threads, av1_max_threads_4k)
+        threads = self.ffmpeg_get_video_thread_count(options)
 
         cmd = " -threads " + str(threads)
 
@@ -365,7 +826,9 @@ class WebVideoTranscodeJob(object):
         @param p
         @return string
         """
-        cmd = " -threads " + str(self.ffmpeg_get_thread_count())
+        threads = self.ffmpeg_get_video_thread_count(options)
+
+        cmd = " -threads " + str(threads)
         if options["videoCodec"] == "vp9":
             cmd += " -row-mt 1"
 
@@ -399,7 +862,12 @@ class WebVideoTranscodeJob(object):
         if options["videoCodec"] == "vp9":
             cmd += " -vcodec libvpx-vp9"
             if "tileColumns" in options:
-                cmd += " -tile-columns " + escape_shellarg(options["tileColumns"])
+                # Tile columns (log2) beyond what the threads can encode in
+                # parallel only cost quality.
+                tile_columns = min(
+                    int(options["tileColumns"]), math.ceil(math.log2(threads))
+                )
+                cmd += " -tile-columns " + escape_shellarg(tile_columns)
         else:
             cmd += " -vcodec libvpx"
 
@@ -440,7 +908,7 @@ class WebVideoTranscodeJob(object):
         @param p
         @return string
         """
-        cmd = " -threads " + str(self.ffmpeg_get_thread_count())
+        cmd = " -threads " + str(self.ffmpeg_get_video_thread_count(options))
 
         # Check for video quality:
         if "videoQuality" in options and int(options["videoQuality"]) >= 0:
@@ -518,13 +986,75 @@ class WebVideoTranscodeJob(object):
 
         @return int
         """
+        if self.threads:
+            return self.threads
+
+        if self.lease:
+            try:
+                return self.lease.get_threads()
+            except OSError as e:
+                print("Unable to lease threads:", e)
+
         return math.floor(ffmpeg_threads / self.concurrency)
 
+    def ffmpeg_get_video_thread_count(self, options):
+        """
+        Get the thread count for a video encoder that fits in free memory.
+
+        Threads are dropped until the estimated peak memory of the encoder
+        fits. If it doesn't fit even with a single thread, InsufficientMemory
+        is raised when the task can be requeued on a bigger host.
+
+        @param options array
+        @return int
+        """
+        threads = self.ffmpeg_get_thread_count()
+        if self.threads:
+            return threads  # Fixed by the parent job, which checked memory
+
+        video = get_video(self.source_info)
+        headroom = get_memory_headroom(self.lease) if video else None
+        if headroom is None:
+            return threads
+
+        memory = estimate_encoder_memory(video, options, threads)
+        while threads > 1 and memory > headroom:
+            threads -= 1
+            memory = estimate_encoder_memory(video, options, threads)
+
+        if memory > headroom:
+            if self.requeue_on_low_memory:
+                raise InsufficientMemory(
+                    "Encoding needs about %s of memory but only %s is free"
+                    % (format_size(memory), format_size(max(0, headroom)))
+                )
+            self.output("Warning: encoding may run out of memory")
+
+        self.reserve_memory(memory)
+
+        return threads
+
+    def reserve_memory(self, memory):
+        """
+        Reserve memory for the next encoders in the lease of this job.
+
+        @param memory int bytes
+        """
+        if self.lease:
+            try:
+                self.lease.reserve_memory(memory)
+            except OSError as e:
+                print("Unable to update thread lease:", e)
+
     def run_shell_exec(self, cmd, track=True):
         """
         Run the shell exec command.
 
+        The command must report its progress with -progress pipe:1, as all
+        commands built on ffmpeg_get_command do, for it to be tracked.
+
         @param cmd String Command to be run
+        @param track bool Report the progress of the command
         @return int, string
         """
         cmd = (
@@ -538,58 +1068,164 @@ class WebVideoTranscodeJob(object):
             + escape_shellarg(background_time_limit)
             + " "
             + cmd
-            + " 2>&1"
         )
 
-        # Adapted from https://gist.github.com/marazmiki/3015621
         process = subprocess.Popen(
             cmd,
-            stdin=None,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
-            stderr=None,
+            stderr=subprocess.PIPE,
             universal_newlines=True,
             shell=True,
             preexec_fn=os.setsid,
         )
 
-        re_duration = re.compile(r"Duration: (\d{2}:\d{2}:\d{2})")
-        re_position = re.compile(r"time=(\d{2}:\d{2}:\d{2})", re.I)
+        # The encoder runs in its own process group, which tracks its memory.
+        self.pgid = process.pid
+        if self.lease:
+            try:
+                self.lease.set_process_group(process.pid)
+            except OSError as e:
+                print("Unable to update thread lease:", e)
+
+        # Drain errors in the background so ffmpeg can never block on a full
+        # pipe, keeping only the last lines since they explain the failure.
+        errors = collections.deque(maxlen=50)
+        reader = threading.Thread(target=errors.extend, args=(process.stderr,))
+        reader.start()
+
+        duration = self.get_duration()
+        stats = {}
+        too_large = False
+
+        try:
+            # Each block of key=value pairs ends with progress=continue, or
+            # progress=end once ffmpeg is done.
+            for line in process.stdout:
+                key, sep, value = line.strip().partition("=")
+                if not sep:
+                    continue
+
+                stats[key] = value
+                if key != "progress":
+                    continue
+
+                self.sample_memory([self.pgid])
+                if not track:
+                    continue
+
+                self.progress = self.parse_progress(stats, duration)
+                if self.progress["percent"] is not None:
+                    self.statuscallback(
+                        self.format_progress(self.progress, duration),
+                        int(self.progress["percent"]),
+                    )
+
+                # Don't spend hours on an output that can't be uploaded.
+                if self.is_output_too_large(self.progress):
+                    too_large = True
+                    self.output_too_large = self.progress["projected_size"]
+                    os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+                    break
+        except TaskAbort:
+            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+            raise
+        finally:
+            self.pgid = None
+            process.wait()
+            reader.join()
+            process.stdout.close()
+            process.stderr.close()
+
+        if too_large:
+            errors.append(
+                "Output too large: projected size of %s exceeds the upload limit "
+                "of %s\n"
+                % (
+                    format_size(self.output_too_large or self.progress["size"]),
+                    format_size(output_size_limit),
+                )
+            )
 
-        duration = None
-        position = None
-        newpercentage = percentage = -1
+        return process.returncode, "".join(errors)
 
-        while process.poll() is None:
-            # for line in process.stdout.readlines():
-            # http://bugs.python.org/issue3907
-            while True:
-                line = process.stdout.readline()
-                if not line:
-                    break
+    def sample_memory(self, pgids):
+        """
+        Sample the memory of the running encoders to record its peak.
 
-                if track:
-                    if duration is None:
-                        duration_match = re_duration.search(line)
-                        if duration_match:
-                            duration = time_to_seconds(duration_match.group(1))
-                    else:
-                        position_match = re_position.search(line)
-                        if position_match:
-                            position = time_to_seconds(position_match.group(1))
-                            if duration and position:
-                                newpercentage = min(
-                                    int(math.floor(100 * position / duration)), 100
-                                )
-
-                    if newpercentage != percentage:
-                        percentage = newpercentage
-                        try:
-                            self.statuscallback(None, percentage)
-                        except TaskAbort:
-                            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                            raise
-
-            time.sleep(2)
-
-        process.stdout.close()
-        return process.returncode, ""
+        The kernel only tracks the peak RSS of each process, and that of the
+        children of the worker process as a whole, which includes the encoders
+        of earlier tasks.
+
+        @param pgids list Process groups of the encoders
+        """
+        now = time.monotonic()
+        if now < self.next_memory_sample:
+            return
+
+        self.next_memory_sample = now + memory_sample_interval
+        self.maxrss = max(self.maxrss, get_process_groups_rss(pgids))
+
+    def parse_progress(self, stats, duration):
+        """
+        Parse a block of ffmpeg -progress output.
+
+        @param stats dict key=value pairs reported by ffmpeg
+        @param duration float Duration of the source in seconds, or 0
+        @return dict
+        """
+
+        def number(key, unit=""):
+            try:
+                return float(stats.get(key, "").strip().removesuffix(unit))
+            except ValueError:
+                return None  # ffmpeg reports N/A until a value is known
+
+        position = number("out_time_us")
+        progress = {
+            "fps": number("fps"),
+            "speed": number("speed", "x"),
+            "position": position / 1e6 if position and position > 0 else None,
+            "bitrate": number("bitrate", "kbits/s"),
+            "size": number("total_size"),
+            "percent": None,
+            "eta": None,
+            "projected_size": None,
+        }
+
+        position = progress["position"]
+        if duration and position:
+            progress["percent"] = min(100 * position / duration, 100)
+            if progress["size"]:
+                progress["projected_size"] = progress["size"] * duration / position
+            if progress["speed"]:
+                progress["eta"] = max(0, duration - position) / progress["speed"]
+        elif stats.get("progress") == "end":
+            progress["percent"] = 100
+
+        return progress
+
+    def format_progress(self, progress, duration):
+        """
+        Describe the progress of an encode to the user.
+
+        @param progress dict As returned by parse_progress
+        @param duration float Duration of the source in seconds, or 0
+        @return string
+        """
+        text = "Encoding"
+        if progress["position"] is not None and duration:
+            text += " %s of %s" % (
+                format_time(progress["position"]),
+                format_time(duration),
+            )
+        if progress["speed"]:
+            text += " at %.2fx speed" % progress["speed"]
+        if progress["fps"]:
+            text += " (%d fps)" % progress["fps"]
+        if progress["eta"] is not None:
+            text += ", about %s left" % format_time(progress["eta"])
+        if progress["projected_size"]:
+            text += ", estimated size %s" % format_size(progress["projected_size"])
+
+        return text
@@ -0,0 +1,70 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Per-host ledgers of the resources held by the jobs running on a host."""
+
+import fcntl
+import json
+import os
+
+
+class Ledger:
+    """
+    A JSON ledger file, locked for exclusive access while in use.
+
+    Entries are dicts keyed by an ID, with the "pid" of the process holding
+    them. Entries of processes that are gone are dropped on every access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+        self.file.seek(0)
+        try:
+            self.entries = json.loads(self.file.read() or "{}")
+        except ValueError:
+            self.entries = {}
+
+        # Drop entries of processes that are gone, e.g. killed by the OOM
+        # killer or a restart of the worker.
+        for id, entry in list(self.entries.items()):
+            if not is_alive(entry["pid"]):
+                del self.entries[id]
+
+        return self.entries
+
+    def __exit__(self, *args):
+        try:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(json.dumps(self.entries))
+            self.file.flush()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+
+
+def is_alive(pid):
+    """Check if a process exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # The process exists but belongs to another user.
+
+    return True
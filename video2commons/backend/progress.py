@@ -0,0 +1,211 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Coalesced progress reporting for running tasks."""
+
+import json
+import threading
+import time
+
+from celery import states
+
+from video2commons.exceptions import TaskAbort
+from video2commons.shared.tasks import (
+    get_progress_status,
+    get_task_hostname,
+    get_task_title,
+)
+
+# Minimum number of seconds between two progress writes for the same task.
+# Updates that arrive in between replace each other and only the latest one
+# is written once the interval has passed.
+progress_interval = 2
+
+# Number of seconds after which the state of a task is checked for an abort
+# even if no progress has been reported in the meantime.
+abort_check_interval = 5
+
+
+class ProgressReporter:
+    """
+    Report the progress of a task from a background thread.
+
+    Calling the reporter only records the latest status text and percentage;
+    the state and the update notification are written to Redis by a background
+    thread at most once every progress_interval seconds, in a single pipelined
+    round trip. Encoders and downloads thus never wait on Redis.
+
+    The abort state of the task is read in the same round trip and raised as
+    TaskAbort on the next call after it has been observed.
+    """
+
+    def __init__(self, backend, conn, task_id, segment=None):
+        """
+        Initialize the reporter and start its background thread.
+
+        @param backend: Celery result backend the task state is stored in.
+        @param conn: Redis connection holding task metadata.
+        @param task_id: ID of the task the progress is reported for.
+        @param segment: Optional (index, count) tuple when reporting the
+            progress of one segment of a distributed encode. The combined
+            progress of all segments is then reported on the task.
+        """
+        self.backend = backend
+        self.conn = conn
+        self.task_id = task_id
+        self.segment = segment
+        self.key = backend.get_key_for_task(task_id)
+
+        # These don't change while the task runs, so look them up only once.
+        self.title = get_task_title(conn, task_id)
+        self.hostname = get_task_hostname(conn, task_id)
+
+        self.text = ""
+        self.percent = 0
+        self.aborted = False
+
+        self._pending = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, text, percent):
+        """Record a status update, to be written in the background."""
+        if self.aborted:
+            raise TaskAbort
+
+        with self._cond:
+            if text is not None:
+                self.text = text
+            if percent is not None:
+                self.percent = percent
+            self._pending = True
+            self._cond.notify()
+
+    def close(self):
+        """Write any pending status and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+        with self._cond:
+            pending, self._pending = self._pending, False
+        if pending:
+            try:
+                self._write(self.text, self.percent)
+            except Exception as e:
+                print("Unable to report progress:", e)
+
+    def _run(self):
+        last = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or self._pending, abort_check_interval
+                )
+                if self._closed:
+                    return
+                pending, self._pending = self._pending, False
+                text, percent = self.text, self.percent
+
+            try:
+                if pending:
+                    self._write(text, percent)
+                else:
+                    self._check_abort()
+            except Exception as e:
+                # Progress is informational; never let Redis trouble kill the
+                # task, the next update will simply try again.
+                print("Unable to report progress:", e)
+
+            last = time.monotonic() if pending else last
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed,
+                    max(0, last + progress_interval - time.monotonic()),
+                )
+
+    def _combine(self, percent):
+        """Combine the progress of this segment with the others."""
+        index, count = self.segment
+        progresskey = "segmentprogress:" + self.task_id
+
+        pipe = self.conn.pipeline()
+        pipe.hset(progresskey, index, max(0, int(percent)))
+        pipe.expire(progresskey, 7 * 24 * 3600)
+        pipe.hvals(progresskey)
+        progress = pipe.execute()[-1]
+
+        return int(sum(int(p) for p in progress) / count)
+
+    def _write(self, text, percent):
+        # Concurrent writes from close() and the background thread must not
+        # interleave, or an older status could overwrite a newer one.
+        with self._lock:
+            print("%d: %s" % (percent, text))
+
+            if self.segment:
+                if percent is None or percent < 0:
+                    return self._check_abort()
+                text = "Encoding segments on workers..."
+                percent = self._combine(percent)
+
+            meta = self.backend._get_result_meta(
+                result={"text": text, "percent": percent},
+                state="PROGRESS",
+                traceback=None,
+                request=None,
+            )
+            meta["task_id"] = self.task_id
+            value = self.backend.encode(meta)
+            # Forgotten tasks have no title and no status to show anymore.
+            status = None
+            if self.title:
+                status = get_progress_status(
+                    self.task_id, self.title, self.hostname, text, percent
+                )
+            notification = json.dumps({"taskid": self.task_id, "data": status})
+
+            # Pub/sub channels are shared between all Redis databases, so the
+            # notification can be sent over the result backend connection.
+            pipe = self.backend.client.pipeline(transaction=True)
+            pipe.get(self.key)
+            self._set(pipe, value)
+            pipe.publish(self.key, value)
+            pipe.publish("v2cnotif:update", notification)
+            current = pipe.execute()[0]
+
+            # Never let a progress update replace the abort request or final
+            # state that was stored before it.
+            if current and self._is_final(current):
+                self._set(self.backend.client, current)
+
+    def _set(self, client, value):
+        if self.backend.expires:
+            client.setex(self.key, self.backend.expires, value)
+        else:
+            client.set(self.key, value)
+
+    def _check_abort(self):
+        current = self.backend.client.get(self.key)
+        if current:
+            self._is_final(current)
+
+    def _is_final(self, value):
+        status = self.backend.decode(value).get("status")
+        if status == "ABORTED":
+            self.aborted = True
+        return status == "ABORTED" or status in states.READY_STATES
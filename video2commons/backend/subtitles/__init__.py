@@ -20,17 +20,24 @@
 import os
 import traceback
 import subprocess
-import json
 import pywikibot
 import langcodes
-from converter import Converter
-import chardet
 
-from ..encode.globals import ffmpeg_location, ffprobe_location
+from . import formats
+from ..encode.globals import ffmpeg_location
+from ..encode.probecache import probe
 from video2commons.exceptions import TaskAbort
 from langcodes import Language
 from langcodes.tag_parser import LanguageTagError
 
+# Subtitle codecs that are images rather than text, which SRT can't hold.
+BITMAP_SUBTITLE_CODECS = {
+    "dvb_subtitle",
+    "dvd_subtitle",
+    "hdmv_pgs_subtitle",
+    "xsub",
+}
+
 
 def upload(site, filename, text, langcode, langname):
     """Upload subtitles to Wikimedia Commons."""
@@ -46,27 +53,11 @@ def get_container_subtitle_languages(filepath):
     """Returns subtitle languages contained in a video container."""
     languages = set()
 
-    result = subprocess.run(
-        [
-            ffprobe_location,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "s",
-            "-show_entries",
-            "stream=index:stream_tags=language",
-            "-of",
-            "json",
-            filepath,
-        ],
-        capture_output=True,
-        text=True,
-    )
-
-    if result.returncode != 0:
+    mediaprobe = probe(filepath)
+    if not mediaprobe:
         return set()
 
-    for stream in json.loads(result.stdout).get("streams", []):
+    for stream in mediaprobe.get_streams("subtitle"):
         has_language = "tags" in stream and "language" in stream["tags"]
         has_index = "index" in stream
 
@@ -109,32 +100,14 @@ def upload_container_subtitles(
 
     percent = 0
 
-    result = subprocess.run(
-        [
-            ffprobe_location,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "s",
-            "-show_entries",
-            "stream=index:stream_tags=language",
-            "-of",
-            "json",
-            filepath,
-        ],
-        capture_output=True,
-        text=True,
-    )
-
-    if result.returncode != 0:
-        statuscallback(
-            f"Failed to extract subtitles: {result.stderr or result.returncode}", None
-        )
+    mediaprobe = probe(filepath)
+    if not mediaprobe:
+        statuscallback("Failed to extract subtitles: unable to probe source", None)
         return
 
     subtitles = []
     languages = set()
-    streams = json.loads(result.stdout).get("streams", [])
+    streams = mediaprobe.get_streams("subtitle")
 
     if not streams:
         statuscallback("No subtitles found in container", 100)
@@ -142,30 +115,34 @@ def upload_container_subtitles(
 
     statuscallback(f"Extracting subtitles for {len(streams)} language(s)...", -1)
 
-    # Extract all subtitles from the video container (0-50%).
+    # Select the subtitles to extract from the video container.
     for stream in streams:
         has_language = "tags" in stream and "language" in stream["tags"]
         has_index = "index" in stream
 
         # Skip unlabelled subtitles that have no language tag.
         if not has_language or not has_index:
-            percent += 50.0 / len(streams)
             statuscallback("Skipping subtitles missing required tags", None)
             continue
 
         try:
             langcode = langcodes.standardize_tag(stream["tags"]["language"])
         except LanguageTagError:
-            percent += 50.0 / len(streams)
             statuscallback(
-                f"Skipping subtitles with invalid language tag: {langcode}", None
+                "Skipping subtitles with invalid language tag: "
+                + stream["tags"]["language"],
+                None,
             )
             continue  # Skip subtitles with invalid language tags.
 
+        # Bitmap subtitles can't be converted to text.
+        if stream.get("codec_name") in BITMAP_SUBTITLE_CODECS:
+            statuscallback(f"Skipping bitmap subtitles: {langcode}", None)
+            continue
+
         # Skip subtitles with the same language as previous subtitles since
         # this isn't supported by Mediawiki.
         if langcode in languages:
-            percent += 50.0 / len(streams)
             statuscallback(
                 f"Skipping duplicate subtitles with language: {langcode}", None
             )
@@ -174,73 +151,58 @@ def upload_container_subtitles(
             languages.add(langcode)
 
         langname = Language.make(language=langcode).display_name()
-        statuscallback(f"Extracting {langname} subtitles...", int(percent))
-
         srt_filepath = os.path.join(outputdir, f"{filename}.{langcode.lower()}.srt")
+        subtitles.append((langcode, langname, srt_filepath, stream["index"]))
 
-        # Write the subtitles to the output directory of the job.
-        result = subprocess.run(
-            [
-                ffmpeg_location,
-                "-nostdin",
-                "-hide_banner",
-                "-loglevel",
-                "quiet",
-                "-i",
-                filepath,
-                "-map",
-                f"0:{stream['index']}",
-                srt_filepath,
-            ],
-            capture_output=True,
-            text=True,
-        )
+    if not subtitles:
+        statuscallback("No subtitles extracted successfully", 100)
+        return
 
-        percent += 50.0 / len(streams)
+    # Extract all subtitles in a single pass over the source (0-50%), so that
+    # large containers are only read once whatever their number of tracks.
+    statuscallback(f"Extracting {len(subtitles)} subtitle track(s)...", int(percent))
+    result = extract_subtitles(
+        filepath, [(index, path) for _, _, path, index in subtitles]
+    )
 
-        if result.returncode != 0:
-            statuscallback(
-                f"Failed to extract '{langcode.lower()}' subtitles: {result.stderr or result.returncode}",
-                int(percent),
-            )
-            continue
+    # If any track failed, the whole pass failed. Extract the tracks one by
+    # one then, to keep the others.
+    if result.returncode != 0:
+        extracted = []
+        for langcode, langname, srt_filepath, index in subtitles:
+            statuscallback(f"Extracting {langname} subtitles...", int(percent))
+            result = extract_subtitles(filepath, [(index, srt_filepath)])
+            percent += 50.0 / len(subtitles)
+
+            if result.returncode != 0:
+                statuscallback(
+                    f"Failed to extract '{langcode.lower()}' subtitles: {result.stderr or result.returncode}",
+                    int(percent),
+                )
+                continue
 
-        subtitles.append((langcode, langname, srt_filepath))
+            extracted.append((langcode, langname, srt_filepath, index))
+        subtitles = extracted
+
+    percent = 50
 
     if not subtitles:
         statuscallback("No subtitles extracted successfully", 100)
         return
 
     # Attempt uploads only after successful extraction of all subtitles (50-100%).
-    for langcode, langname, srt_filepath in subtitles:
+    for langcode, langname, srt_filepath, _ in subtitles:
         try:
             statuscallback(f"Uploading {langname} subtitles...", int(percent))
 
             with open(srt_filepath, "rb") as f:
-                text = f.read()
-
-            # Try to first decode the subtitles as UTF-8 if possible rather
-            # than relying entirely on chardet as it detects encodings
-            # using a statistical method that is prone to error.
-            decoded_text = parse_utf8(text)
-            if decoded_text is not None:
-                text = decoded_text
-            else:
-                # It's not UTF-8, so try to detect the encoding.
-                encoding = chardet.detect(text)["encoding"]
-                if not encoding:
-                    statuscallback(
-                        f"Skipping subtitles with invalid encoding: {langcode}", None
-                    )
-                    continue
-
-                try:
-                    text = text.decode(encoding)
-                except Exception:
-                    statuscallback(
-                        f"Skipping subtitles with invalid encoding: {langcode}", None
-                    )
-                    continue
+                text = formats.decode(f.read())
+
+            if text is None:
+                statuscallback(
+                    f"Skipping subtitles with invalid encoding: {langcode}", None
+                )
+                continue
 
             upload(
                 site=pywikibot.Site("commons", "commons", user=username),
@@ -261,6 +223,26 @@ def upload_container_subtitles(
             )
 
 
+def extract_subtitles(filepath, outputs):
+    """Extract subtitle streams of a video container to SRT files at once."""
+    # Outputs are overwritten, since a failed pass leaves partial files behind
+    # for the tracks that are extracted again one by one.
+    cmd = [
+        ffmpeg_location,
+        "-y",
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        filepath,
+    ]
+    for index, srt_filepath in outputs:
+        cmd += ["-map", f"0:{index}", srt_filepath]
+
+    return subprocess.run(cmd, capture_output=True, text=True)
+
+
 def upload_subtitles(
     subtitles, wikifilename, username, statuscallback=None, errorcallback=None
 ):
@@ -271,7 +253,6 @@ def upload_subtitles(
     statuscallback("Uploading subtitles...", -1)
 
     percent = 0
-    c = Converter(ffmpeg_path=ffmpeg_location, ffprobe_path=ffprobe_location)
 
     for langcode, filename in list(subtitles.items()):
         try:
@@ -285,28 +266,15 @@ def upload_subtitles(
                 langname += " (%s)" % ", ".join(list(langdesc.values()))
 
             statuscallback("Loading subtitles in " + langname, int(percent))
-            subtitletext = ""
-
-            info = c.probe(filename)
-            if not info:
-                continue
-            if len(info.streams) != 1:
-                continue
-            if info.streams[0].type != "subtitle":
-                continue
-            format = info.streams[0].codec
-
-            if format.lower() != "subrip":
-                target = filename + ".srt"
-                cmd = [ffmpeg_location, "-i", filename, "-f", "srt", target]
-                statuscallback("Running cmd: %s" % cmd, None)
-                subprocess.check_call(cmd, stderr=None)
-                filename = target
 
             with open(filename, "rb") as f:
-                subtitletext = f.read()
+                subtitletext = formats.to_srt(f.read())
 
-            subtitletext = subtitletext.decode(chardet.detect(subtitletext)["encoding"])
+            # Formats that can't be converted in-process are left to ffmpeg.
+            if subtitletext is None:
+                subtitletext = convert_subtitles(filename, statuscallback)
+            if subtitletext is None:
+                continue
 
             percent += 50.0 / len(subtitles)
             statuscallback("Uploading subtitles in " + langname, int(percent))
@@ -333,9 +301,24 @@ def upload_subtitles(
             pass
 
 
-def parse_utf8(bytestring):
-    """Try to decode a bytestring as UTF-8, returning None on failure."""
-    try:
-        return bytestring.decode("utf-8")
-    except UnicodeDecodeError:
+def convert_subtitles(filename, statuscallback):
+    """Convert subtitles to SubRip with ffmpeg, returning None on failure."""
+    mediaprobe = probe(filename)
+    info = mediaprobe.mediainfo if mediaprobe else None
+    if not info:
         return None
+    if len(info.streams) != 1:
+        return None
+    if info.streams[0].type != "subtitle":
+        return None
+    format = info.streams[0].codec
+
+    if format.lower() != "subrip":
+        target = filename + ".srt"
+        cmd = [ffmpeg_location, "-i", filename, "-f", "srt", target]
+        statuscallback("Running cmd: %s" % cmd, None)
+        subprocess.check_call(cmd, stderr=None)
+        filename = target
+
+    with open(filename, "rb") as f:
+        return formats.decode(f.read())
@@ -0,0 +1,275 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""
+Convert text subtitles to SubRip without spawning ffmpeg.
+
+Handles the formats yt-dlp downloads in practice: SubRip, WebVTT and
+SubStation Alpha. Anything else is left to ffmpeg by the caller.
+"""
+
+import codecs
+import html
+import re
+
+from chardet import UniversalDetector
+
+# The encoding of non UTF-8 subtitles is detected on at most DETECT_SIZE bytes,
+# fed to the detector DETECT_CHUNK bytes at a time until it is confident.
+DETECT_SIZE = 64 << 10
+DETECT_CHUNK = 4 << 10
+
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+TIMESTAMP = r"(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{1,3})"
+TIMING_RE = re.compile(r"^\s*%s\s*-->\s*%s" % (TIMESTAMP, TIMESTAMP))
+ASS_TIME_RE = re.compile(r"^(\d+):(\d{2}):(\d{2})[.:](\d{1,3})$")
+ASS_OVERRIDE_RE = re.compile(r"\{[^}]*\}")
+VTT_TAG_RE = re.compile(r"</?(?:c|v|lang|ruby|rt)(?:[.\s][^>]*)?>|<\d[^>]*>")
+
+
+def decode(data):
+    """
+    Decode subtitles of unknown encoding.
+
+    UTF-8 is tried first, since it is what nearly all subtitles are in and
+    statistical detection is prone to error.
+
+    @param data bytes
+    @return string, or None if the encoding can't be determined
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            try:
+                return data[len(bom) :].decode(encoding)
+            except UnicodeDecodeError:
+                return None
+
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+
+    detector = UniversalDetector()
+    for offset in range(0, min(len(data), DETECT_SIZE), DETECT_CHUNK):
+        detector.feed(data[offset : offset + DETECT_CHUNK])
+        if detector.done:
+            break
+    encoding = detector.close()["encoding"]
+    if not encoding:
+        return None
+
+    try:
+        return data.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return None
+
+
+def sniff(text):
+    """
+    Identify the format of subtitles.
+
+    @param text string
+    @return string "srt", "vtt" or "ass", or None if unknown
+    """
+    head = text.lstrip("\ufeff \t\r\n")
+    if head.startswith("WEBVTT"):
+        return "vtt"
+    if head.startswith("[Script Info]") or "\n[Events]" in text:
+        return "ass"
+
+    for line in head.splitlines()[:3]:
+        if TIMING_RE.match(line):
+            return "srt"
+
+    return None
+
+
+def to_srt(data):
+    """
+    Convert subtitles to SubRip.
+
+    @param data bytes
+    @return string, or None if the encoding or format isn't supported
+    """
+    text = decode(data)
+    if text is None:
+        return None
+
+    format = sniff(text)
+    if format is None:
+        return None
+
+    cues = PARSERS[format](text.replace("\r\n", "\n").replace("\r", "\n"))
+    if not cues:
+        return None
+
+    return serialize_srt(cues)
+
+
+def parse_srt(text):
+    """
+    Parse SubRip subtitles.
+
+    @param text string
+    @return list of (start, end, text) with times in milliseconds
+    """
+    cues = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = block.strip("\n").split("\n")
+        for i, line in enumerate(lines):
+            match = TIMING_RE.match(line)
+            if match:
+                start, end = _get_times(match)
+                cues.append((start, end, "\n".join(lines[i + 1 :]).strip()))
+                break
+
+    return cues
+
+
+def parse_vtt(text):
+    """
+    Parse WebVTT subtitles.
+
+    Markup SubRip can't hold, like voices and classes, is dropped.
+
+    @param text string
+    @return list of (start, end, text) with times in milliseconds
+    """
+    cues = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = block.strip("\n").split("\n")
+        for i, line in enumerate(lines):
+            # Header, NOTE, STYLE and REGION blocks have no timing line.
+            match = TIMING_RE.match(line)
+            if match:
+                start, end = _get_times(match)
+                payload = VTT_TAG_RE.sub("", "\n".join(lines[i + 1 :]))
+                cues.append((start, end, html.unescape(payload).strip()))
+                break
+
+    return cues
+
+
+def parse_ass(text):
+    """
+    Parse SubStation Alpha subtitles.
+
+    Style overrides are dropped, except for italics and bold.
+
+    @param text string
+    @return list of (start, end, text) with times in milliseconds
+    """
+    cues = []
+    fields = None
+    in_events = False
+    for line in text.split("\n"):
+        line = line.strip()
+        if line.startswith("["):
+            in_events = line.lower() == "[events]"
+            continue
+        if not in_events or ":" not in line:
+            continue
+
+        kind, value = line.split(":", 1)
+        if kind == "Format":
+            fields = [field.strip().lower() for field in value.split(",")]
+            continue
+        if kind != "Dialogue" or not fields or "text" not in fields:
+            continue
+
+        values = value.split(",", len(fields) - 1)
+        if len(values) != len(fields):
+            continue
+        event = dict(zip(fields, (v.strip() for v in values)))
+
+        try:
+            start = _get_ass_time(event["start"])
+            end = _get_ass_time(event["end"])
+        except (KeyError, ValueError):
+            continue
+
+        cues.append((start, end, _get_ass_text(values[-1])))
+
+    # Events may be stored in any order, but SubRip is read in sequence.
+    cues.sort(key=lambda cue: (cue[0], cue[1]))
+    return cues
+
+
+def serialize_srt(cues):
+    """
+    Serialize cues to SubRip.
+
+    @param cues list of (start, end, text) with times in milliseconds
+    @return string
+    """
+    blocks = []
+    for start, end, text in cues:
+        if not text:
+            continue
+        blocks.append(
+            "%d\n%s --> %s\n%s\n"
+            % (len(blocks) + 1, _format_time(start), _format_time(end), text)
+        )
+
+    return "\n".join(blocks)
+
+
+PARSERS = {
+    "srt": parse_srt,
+    "vtt": parse_vtt,
+    "ass": parse_ass,
+}
+
+
+def _get_times(match):
+    start = _get_time(*match.groups()[:4])
+    end = _get_time(*match.groups()[4:])
+    return start, end
+
+
+def _get_time(hours, minutes, seconds, fraction):
+    return (int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)) * 1000 + int(
+        fraction.ljust(3, "0")
+    )
+
+
+def _get_ass_time(value):
+    match = ASS_TIME_RE.match(value)
+    if not match:
+        raise ValueError("Invalid time: " + value)
+
+    return _get_time(*match.groups())
+
+
+def _get_ass_text(text):
+    text = text.replace("{\\i1}", "<i>").replace("{\\i0}", "</i>")
+    text = text.replace("{\\b1}", "<b>").replace("{\\b0}", "</b>")
+    text = ASS_OVERRIDE_RE.sub("", text)
+    text = text.replace("\\N", "\n").replace("\\n", "\n").replace("\\h", " ")
+    return text.strip()
+
+
+def _format_time(ms):
+    return "%02d:%02d:%02d,%03d" % (
+        ms // 3600000,
+        ms // 60000 % 60,
+        ms // 1000 % 60,
+        ms % 1000,
+    )
@@ -19,7 +19,8 @@
 Upload a file to Wikimedia Commons.
 
 The upload function in this module acts as a wrapper around pywikibot's upload
-method. It adds additional validation and retry handling for uploads.
+method. It adds additional validation and retry handling for uploads. Large
+files are sent in chunks that are resumed after failures, see chunked.py.
 """
 
 import time
@@ -33,6 +34,8 @@ from pywikibot.exceptions import (
     APIError,
 )
 
+from video2commons.backend.checkpoint import get_sha1
+from video2commons.backend.upload.chunked import ChunkedUpload
 from video2commons.exceptions import TaskError
 
 MAX_RETRIES = 5
@@ -43,9 +46,6 @@ UPLOAD_LIMIT_BYTES = 5 * 1024 * 1024 * 1024
 # Unchunked are limited to 100 MiB.
 UNCHUNKED_LIMIT_BYTES = 100 * 1024 * 1024
 
-# Limit chunk size to 16 MiB for chunked uploads exceeding 100 MiB.
-CHUNK_SIZE = 16 * 1024 * 1024
-
 IGNORED_WARNINGS = ["exists-normalized"]
 
 
@@ -57,8 +57,13 @@ def upload(
     username,
     statuscallback,
     errorcallback,
+    checkpoint=None,
 ):
-    """Upload files to Commons using pywikibot."""
+    """Upload files to Commons using pywikibot.
+
+    If a task checkpoint is given, the stash of a chunked upload is recorded
+    in it so that a restart of the task can continue the upload.
+    """
     size = os.path.getsize(filename)
 
     if size >= UPLOAD_LIMIT_BYTES:
@@ -75,8 +80,35 @@ def upload(
     if page.exists():
         errorcallback("File already exists. Please choose another name.")
 
+    # Commons rejects exact duplicates, which is better found out before
+    # sending gigabytes. The checksum is taken when the encode is saved.
+    statuscallback("Checking for duplicates...", -1)
+    sha1 = (checkpoint and checkpoint.get_sha1()) or get_sha1(filename)
+    duplicates = get_duplicates(site, sha1)
+    if duplicates:
+        errorcallback(
+            "This file is an exact duplicate of "
+            + ", ".join("[[%s]]" % title for title in duplicates)
+            + " on Commons and cannot be uploaded again."
+        )
+
     comment = "Imported media from " + sourceurl
-    chunk_size = CHUNK_SIZE if size >= UNCHUNKED_LIMIT_BYTES else 0
+
+    if size >= UNCHUNKED_LIMIT_BYTES:
+        ChunkedUpload(
+            site,
+            page,
+            filename,
+            comment,
+            filedesc,
+            statuscallback,
+            checkpoint,
+            IGNORED_WARNINGS,
+        ).run()
+
+        statuscallback("Upload success!", 100)
+        return page.title(with_ns=False), page.full_url()
+
     remaining_tries = MAX_RETRIES
 
     while True:
@@ -108,8 +140,6 @@ def upload(
                 source_filename=filename,
                 comment=comment,
                 text=filedesc,
-                chunk_size=chunk_size,
-                asynchronous=bool(chunk_size),
                 ignore_warnings=ignore_warnings,
             )
 
@@ -151,6 +181,59 @@ def upload(
     return page.title(with_ns=False), page.full_url()
 
 
+def preflight(wikifilename, username, errorcallback):
+    """Check that the user may upload a file to a title, before any work.
+
+    The title, the rights and blocks of the user and the title blacklist are
+    checked in one API request. Returns the normalized title.
+    """
+    site = pywikibot.Site("commons", "commons", user=username)
+    page = pywikibot.FilePage(site, wikifilename)
+
+    query = site.simple_request(
+        action="query",
+        titles=page.title(),
+        prop="info",
+        intestactions="upload",
+        intestactionsdetail="full",
+        meta="userinfo",
+        uiprop=["rights", "blockinfo"],
+    ).submit()["query"]
+
+    userinfo = query["userinfo"]
+    if "blockid" in userinfo:
+        errorcallback("Upload not allowed: You are blocked from uploading files.")
+    if "upload" not in userinfo.get("rights", []):
+        errorcallback("Upload not allowed: You don't have the right to upload.")
+
+    pages = query.get("pages", {})
+    for info in pages.values() if isinstance(pages, dict) else pages:
+        if "invalid" in info:
+            errorcallback(
+                "Upload not allowed: Invalid file name: %s"
+                % info.get("invalidreason", page.title())
+            )
+        if "missing" not in info:
+            errorcallback("File already exists. Please choose another name.")
+
+        # E.g. titleblacklist-forbidden if the title blacklist matches.
+        for error in info.get("actions", {}).get("upload", []):
+            errorcallback(
+                "Upload not allowed: %s: %s"
+                % (error.get("code"), error.get("text") or error.get("info", ""))
+            )
+
+    return page.title()
+
+
+def get_duplicates(site, sha1):
+    """Get the titles of the files on a wiki with the given SHA-1 checksum."""
+    request = site.simple_request(
+        action="query", list="allimages", aisha1=sha1, ailimit=10
+    )
+    return [image["title"] for image in request.submit()["query"]["allimages"]]
+
+
 def exponential_backoff(tries, max_tries=MAX_RETRIES, delay=20):
     """Exponential backoff doubling for every retry."""
     time.sleep(delay * (2 ** (max_tries - tries - 1)))
@@ -0,0 +1,291 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""
+Resumable chunked uploads through the upload stash of MediaWiki.
+
+pywikibot starts chunked uploads over from the first byte whenever they fail,
+and doesn't expose the stash file key to continue them later. Here every
+acknowledged chunk is recorded, so failed chunks are resent from the last
+offset the server confirmed, and restarted tasks can continue (or publish)
+the stash of an earlier run.
+"""
+
+import os
+import time
+
+from pywikibot.data.api import Request
+from pywikibot.exceptions import (
+    APIError,
+    FatalServerError,
+    UploadError,
+)
+from pywikibot.tools import compute_file_hash
+
+from video2commons.exceptions import TaskAbort, TaskError
+
+# Chunks are sized to take about TARGET_CHUNK_SECONDS to send at the measured
+# throughput, within these bounds and in steps of CHUNK_ALIGNMENT.
+INITIAL_CHUNK_SIZE = 16 << 20
+MIN_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 64 << 20
+CHUNK_ALIGNMENT = 1 << 20
+TARGET_CHUNK_SECONDS = 10
+
+# Consecutive failures before giving up, and the delay before the first retry
+# which doubles with every retry.
+MAX_FAILURES = 5
+RETRY_DELAY = 20
+
+POLL_INTERVAL = 5
+
+
+class ChunkedUpload:
+    """A chunked upload of a file that can be resumed from its stash."""
+
+    def __init__(
+        self,
+        site,
+        page,
+        filename,
+        comment,
+        text,
+        statuscallback,
+        checkpoint=None,
+        ignored_warnings=(),
+    ):
+        self.site = site
+        self.page = page
+        self.filename = filename
+        self.comment = comment
+        self.text = text
+        self.statuscallback = statuscallback
+        self.checkpoint = checkpoint
+        self.ignored_warnings = ignored_warnings
+
+        self.size = os.path.getsize(filename)
+        self.sha1 = checkpoint.get_sha1() if checkpoint else None
+        self.file_key = None
+        self.offset = 0
+        self.chunk_size = INITIAL_CHUNK_SIZE
+
+    def run(self):
+        """Send the remaining chunks and publish the stashed file."""
+        self.resume()
+
+        failures = 0
+        with open(self.filename, "rb") as f:
+            while self.offset < self.size:
+                try:
+                    self.send_chunk(f)
+                    failures = 0
+                except (FatalServerError, TaskError, TaskAbort):
+                    raise
+                except APIError as e:
+                    # The server expects another offset, e.g. because the
+                    # response to a chunk it got was lost.
+                    if e.code != "stashfailed" or "offset" not in e.other:
+                        raise
+                    self.offset = int(e.other["offset"])
+                    failures = self.fail(failures, e)
+                except Exception as e:
+                    failures = self.fail(failures, e)
+                    self.chunk_size = self.align(self.chunk_size // 2)
+                    self.sync_offset()
+
+        self.publish()
+
+    def resume(self):
+        """Continue the stash of an earlier run if it matches the file."""
+        state = self.checkpoint.get_upload() if self.checkpoint else {}
+        if not state.get("filekey") or not self.sha1:
+            return
+        if state.get("sha1") != self.sha1:
+            return  # The stash is of another encode
+
+        try:
+            info = self.site.stash_info(state["filekey"], ["size", "sha1"])
+        except Exception as e:
+            print("Unable to resume upload:", e)
+            return  # E.g. the stash has expired
+
+        size = info.get("size", 0)
+        if size > self.size:
+            return
+        if compute_file_hash(self.filename, bytes_to_read=size) != info.get("sha1"):
+            return
+
+        self.file_key = state["filekey"]
+        self.offset = size
+        self.statuscallback(
+            "Resuming upload at %d%%..." % (100 * self.offset // self.size), -1
+        )
+
+    def send_chunk(self, f):
+        """Send the chunk at the current offset to the stash."""
+        f.seek(self.offset)
+        chunk = f.read(self.chunk_size)
+        final = self.offset + len(chunk) >= self.size
+
+        # Workaround for T132676, as in pywikibot: the payload loses its last
+        # '\r' to the newline of the MIME encoding.
+        if final or chunk[-1:] == b"\r":
+            chunk += b"\r"
+
+        request = Request(
+            site=self.site,
+            mime={
+                "chunk": (
+                    chunk,
+                    ("application", "octet-stream"),
+                    {"filename": "FAKE-NAME"},
+                )
+            },
+            parameters={
+                "action": "upload",
+                "token": self.site.tokens["csrf"],
+                "stash": True,
+                "filesize": self.size,
+                "offset": self.offset,
+                "filename": self.page.title(with_ns=False),
+                "async": True,
+                "ignorewarnings": True,  # Warnings are checked on publishing
+            },
+        )
+        if self.file_key:
+            request["filekey"] = self.file_key
+
+        start = time.monotonic()
+        data = request.submit()["upload"]
+        elapsed = time.monotonic() - start
+
+        self.file_key = data.get("filekey", self.file_key)
+        if data["result"] == "Continue":
+            self.offset = int(data.get("offset", self.offset + len(chunk)))
+        elif data["result"] in ("Poll", "Success"):
+            self.offset = self.size
+        else:
+            raise TaskError("Unrecognized upload result: %s" % data["result"])
+
+        if self.checkpoint:
+            self.checkpoint.save_upload(
+                filekey=self.file_key, offset=self.offset, sha1=self.sha1
+            )
+
+        if data["result"] == "Poll":
+            self.poll("Assembling uploaded chunks...")
+
+        # Aim for chunks that take about the same time whatever the link.
+        if elapsed > 0:
+            self.chunk_size = self.align(len(chunk) / elapsed * TARGET_CHUNK_SECONDS)
+
+        self.statuscallback(
+            "Uploading... (%d%%)" % (100 * self.offset // self.size),
+            100 * self.offset // self.size,
+        )
+
+    def sync_offset(self):
+        """Continue after the last chunk the server has confirmed."""
+        if not self.file_key:
+            self.offset = 0
+            return
+
+        try:
+            self.offset = self.site.stash_info(self.file_key, ["size"])["size"]
+        except Exception as e:
+            print("Unable to get upload offset:", e)
+
+    def publish(self):
+        """Publish the stashed file to its page."""
+        ignore_warnings = False
+        request = self.site.simple_request(
+            action="upload",
+            token=self.site.tokens["csrf"],
+            filename=self.page.title(with_ns=False),
+            filekey=self.file_key,
+            comment=self.comment,
+            text=self.text,
+            ignorewarnings=ignore_warnings,
+        )
+        request["async"] = True
+
+        while True:
+            try:
+                data = request.submit()["upload"]
+            except APIError:
+                # Recheck in case the error didn't prevent the upload.
+                self.site.loadpageinfo(self.page)
+                if self.page.exists():
+                    return
+                raise
+
+            if data["result"] == "Warning" and not ignore_warnings:
+                warnings = [
+                    UploadError(code, "%s: %s" % (code, message), self.file_key)
+                    for code, message in data.get("warnings", {}).items()
+                    if code not in self.ignored_warnings
+                ]
+                if len(warnings) == 1:
+                    raise warnings[0]
+                elif len(warnings) > 1:
+                    messages = ", ".join(str(w) for w in warnings)
+                    raise TaskError(f"Upload failed due to multiple errors: {messages}")
+
+                ignore_warnings = True
+                request["ignorewarnings"] = True
+                continue
+
+            if data["result"] == "Poll":
+                self.poll("Publishing upload...")
+            elif data["result"] != "Success":
+                raise TaskError("Unrecognized upload result: %s" % data["result"])
+
+            return
+
+    def poll(self, text):
+        """Wait for the server to finish processing the stashed file."""
+        while True:
+            self.statuscallback(text, -1)
+            time.sleep(POLL_INTERVAL)
+            data = self.site.simple_request(
+                action="upload",
+                token=self.site.tokens["csrf"],
+                filekey=self.file_key,
+                checkstatus=True,
+            ).submit()["upload"]
+
+            if data["result"] == "Success":
+                return
+            if data["result"] != "Poll":
+                raise TaskError(
+                    "Upload failed while processing: %s"
+                    % data.get("details", data["result"])
+                )
+
+    def fail(self, failures, error):
+        """Count a failed chunk and wait before retrying it."""
+        failures += 1
+        if failures >= MAX_FAILURES:
+            raise error
+
+        self.statuscallback(
+            "Retrying upload... (%d tries remaining)" % (MAX_FAILURES - failures), -1
+        )
+        time.sleep(RETRY_DELAY * 2 ** (failures - 1))
+        return failures
+
+    @staticmethod
+    def align(size):
+        """Round a chunk size to the alignment and clamp it to the bounds."""
+        size = int(size) // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT
+        return min(max(size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
@@ -17,6 +17,7 @@
 
 """video2commons backend worker."""
 
+import functools
 import logging
 import os
 import sys
@@ -26,6 +27,8 @@ import re
 import celery
 import pywikibot
 
+from celery import chord, group
+from celery.signals import task_postrun, worker_ready
 from celery.contrib.abortable import AbortableTask
 from celery.exceptions import Ignore
 from http.cookiejar import DefaultCookiePolicy
@@ -33,19 +36,35 @@ from kombu import Queue
 from pywikibot.comms.http import session
 from redis import Redis
 
-from video2commons.exceptions import TaskError, TaskAbort
+from video2commons.exceptions import InsufficientMemory, TaskError, TaskAbort
+from video2commons.backend import diskspace
 from video2commons.backend import download
 from video2commons.backend import categories
+from video2commons.backend import checkpoint as checkpoints
 from video2commons.backend import encode
 from video2commons.backend import upload
 from video2commons.backend import subtitles as subtitleuploader
+from video2commons.backend.download import sourcecache
+from video2commons.backend.encode.globals import shared_segment_dir
+from video2commons.backend.encode.helpers import get_video
+from video2commons.backend.encode.memory import get_memory_headroom
+from video2commons.backend.encode.probecache import probe
+from video2commons.backend.progress import ProgressReporter
 from video2commons.config import (
     redis_pw,
     redis_host,
     consumer_key,
     consumer_secret,
 )
+from video2commons.shared import scheduler
 from video2commons.shared.stats import update_task_stats
+from video2commons.shared.costmodel import (
+    HEAVY_QUEUE,
+    estimate_calibrated_cost,
+    get_media_summary,
+    summarize_ffprobe,
+)
+from video2commons.shared.telemetry import measure_stage, record_telemetry
 from video2commons.shared.tasks import get_task_status, publish_notification
 
 logging.basicConfig(level=logging.INFO)
@@ -69,19 +88,65 @@ app.conf.result_expires = 30 * 24 * 3600  # 1 month
 
 app.conf.accept_content = ["json"]
 app.conf.worker_prefetch_multiplier = 1
+# Each worker also consumes its own queue so that the last step of distributed
+# encodes can be sent back to the worker holding the task's files.
+app.conf.worker_direct = True
 app.conf.task_queues = [
     Queue("celery"),
     Queue("heavy"),
 ]
 
 redisconnection = Redis(host=redis_host, db=3, password=redis_pw)
+brokerconnection = Redis(host=redis_host, db=2, password=redis_pw)
+
+# Stages of the main task measured for telemetry. Encode passes are measured
+# within the encode stage and must not be counted twice.
+TASK_STAGES = ("download", "encode", "upload")
+
+# Target titles are reserved for the task uploading to them, so that tasks
+# with the same file name don't find out at upload time. The reservation is
+# refreshed before encoding and expires if the task dies.
+TITLE_RESERVATION_TTL = 6 * 3600
+
 
+def submit_task(task_id, params, queue, user, cost=None):
+    """Queue a task to be released to the broker in fair-share order."""
+    scheduler.submit(brokerconnection, queue, user, task_id, params, cost)
+    dispatch_tasks([queue])
 
-class Stats:
-    """Storage for task status."""
 
-    text = ""
-    percent = 0
+def dispatch_tasks(queues=None):
+    """Release tasks waiting in the fair-share queues to the broker."""
+    for queue in queues or [queue.name for queue in app.conf.task_queues]:
+        scheduler.dispatch(
+            brokerconnection,
+            queue,
+            send_task,
+            functools.partial(brokerconnection.llen, queue),
+        )
+
+
+def send_task(task_id, params, queue):
+    """Send a task released by the fair-share scheduler to the broker."""
+    main.apply_async(args=params, queue=queue, task_id=task_id)
+
+
+@worker_ready.connect
+def dispatch_on_worker_ready(**kwargs):
+    """Fill the broker queues once a worker is ready to take tasks."""
+    try:
+        dispatch_tasks()
+    except Exception as e:
+        print("Unable to dispatch tasks:", e)
+
+
+@task_postrun.connect
+def dispatch_on_task_postrun(**kwargs):
+    """Release the next tasks since a worker slot has become free."""
+    try:
+        dispatch_tasks()
+    except Exception as e:
+        print("Unable to dispatch tasks:", e)
 
 
 def get_worker_concurrency():
@@ -131,8 +196,6 @@ def main(
     oauth,
 ):
     """Main worker code."""
-    task_id = self.request.id
-
     # Get a lock to prevent double-running with same task ID
     lockkey = "tasklock:" + self.request.id
     if redisconnection.exists(lockkey):
@@ -145,12 +208,29 @@ def main(
     except Exception:
         pass  # We don't want to fail the task if we can't update stats.
 
-    # Check for 10G of disk space, refuse to run if it is unavailable
-    st = os.statvfs("/srv")
-    if st.f_frsize * st.f_bavail < 10 << 30:
-        self.retry(max_retries=20, countdown=5 * 60)
+    summary = get_task_media_summary(url)
+
+    # Tasks that won't fit in the memory of this host are better off on a
+    # heavy worker than encoding with a single thread or being OOM-killed.
+    queue = (self.request.delivery_info or {}).get("routing_key")
+    requeue_on_low_memory = queue != HEAVY_QUEUE
+    if requeue_on_low_memory and not fits_in_memory(summary, convertkey):
+        self.retry(queue=HEAVY_QUEUE, countdown=0)
         assert False  # should never reach here
 
+    # Reserve the disk space for the source and the output, refuse to run
+    # while it is taken by the other tasks on this host.
+    reservation = diskspace.DiskReservation(
+        diskspace.estimate_task_size(
+            redisconnection, summary and summary.get("filesize"), convertkey
+        )
+    )
+    if not reservation.acquire():
+        # Cached sources of earlier tasks make way before waiting for others.
+        if not (sourcecache.evict(reservation.size) and reservation.acquire()):
+            self.retry(max_retries=20, countdown=5 * 60)
+            assert False  # should never reach here
+
     redisconnection.setex(lockkey, 7 * 24 * 3600, self.request.hostname)
 
     # Generate temporary directory for task
@@ -161,49 +241,78 @@ def main(
             os.makedirs(outputdir)
             break
     else:
+        reservation.release()
         raise TaskError("Too many retries to generate a task id")
 
-    s = Stats()
+    reservation.set_directory(outputdir)
 
-    def statuscallback(text, percent):
-        if self.is_aborted():
-            raise TaskAbort
-        if text is not None:
-            s.text = text
-        if percent is not None:
-            s.percent = percent
-        print("%d: %s" % (s.percent, s.text))
-
-        self.update_state(state="PROGRESS", meta={"text": s.text, "percent": s.percent})
-
-        publish_notification(
-            redisconnection,
-            "update",
-            {"taskid": task_id, "data": get_task_status(redisconnection, task_id)},
-        )
+    statuscallback = get_statuscallback(self)
 
     def errorcallback(text):
         raise TaskError(text)
 
+    handed_off = False
+    restartable = True
+    title = None
+    telemetry = {}
+    segmentdir = os.path.join(shared_segment_dir, os.path.basename(outputdir))
+
+    # Stages completed by an earlier run of the same task are skipped.
+    checkpoint = checkpoints.Checkpoint(
+        redisconnection,
+        checkpoints.get_fingerprint(url, subtitles, downloadkey, convertkey, username),
+    )
+
     try:
-        statuscallback("Downloading...", -1)
-        d = download.download(
-            redisconnection,
-            url,
-            ie_key,
-            downloadkey,
-            subtitles,
-            outputdir,
-            statuscallback,
+        statuscallback("Checking file name...", -1)
+        title = check_title(
+            self.request.id,
+            filename + "." + convertkey.split(".")[-1],
+            username,
+            oauth,
             errorcallback,
         )
-        if not d:
-            errorcallback("Download failed!")
-        file = d["target"]
-        if not file:
-            errorcallback("Download failed!")
 
-        source = file
+        restored = checkpoint.restore(outputdir)
+
+        # Restored encodes don't need their source, only its subtitles.
+        d = restored.get("download")
+        if d:
+            if d["target"]:
+                statuscallback("Resuming with the previously downloaded source", -1)
+        else:
+            statuscallback("Downloading...", -1)
+            with measure_stage(telemetry, "download"):
+                d = download.download(
+                    redisconnection,
+                    url,
+                    ie_key,
+                    downloadkey,
+                    subtitles,
+                    outputdir,
+                    statuscallback,
+                    errorcallback,
+                    stream=encode.supports_streaming(convertkey),
+                )
+            if not d:
+                errorcallback("Download failed!")
+            if not d["target"]:
+                errorcallback("Download failed!")
+            checkpoint.save_download(d, outputdir)
+
+        # The source of a restored download is gone if it was encoded.
+        file = source = d["target"]
+
+        # Now that the source is here, only the output is left to reserve.
+        source_size = None if d["streaming"] or not source else os.path.getsize(source)
+        source_size = source_size or (summary and summary.get("filesize"))
+        if source_size:
+            reservation.resize(
+                diskspace.get_directory_size(outputdir)
+                + diskspace.estimate_output_size(
+                    redisconnection, source_size, convertkey
+                )
+            )
 
         # Remember intent with subtitles so categories can be added
         # appropriately later. These can be strings, so convert to bool.
@@ -213,82 +322,202 @@ def main(
 
         subtitles = subtitles and d["subtitles"]
 
-        statuscallback("Converting...", -1)
-        concurrency = get_worker_concurrency()
-        file = encode.encode(
-            file, convertkey, statuscallback, errorcallback, concurrency
+        context = {
+            "source": source,
+            "outputdir": outputdir,
+            "url": url,
+            "subtitles": subtitles,
+            "subtitles_requested": subtitles_requested,
+            "filename": filename,
+            "filedesc": filedesc,
+            "username": username,
+            "oauth": oauth,
+        }
+
+        if "encode" in restored:
+            statuscallback("Resuming with the previously encoded file", -1)
+            file = restored["encode"]["target"]
+        else:
+            # Check again now that the source decides the actual format.
+            key = encode.prepare(file, convertkey, d["http_headers"])[1]
+            checked = check_title(
+                self.request.id,
+                filename + "." + key.split(".")[-1],
+                username,
+                oauth,
+                errorcallback,
+            )
+            if checked != title:
+                release_title(title, self.request.id)
+                title = checked
+
+            # Very long videos are split so their segments can be encoded by
+            # every worker in the cluster instead of tying up this one for
+            # days.
+            concurrency = get_worker_concurrency()
+            plan = None
+            if not d["streaming"] and os.path.isdir(shared_segment_dir):
+                statuscallback("Checking if encoding can be distributed...", -1)
+                plan = encode.split(
+                    file,
+                    convertkey,
+                    segmentdir,
+                    statuscallback,
+                    errorcallback,
+                    concurrency,
+                )
+
+            if plan:
+                statuscallback(
+                    "Distributing %d segments to workers..." % len(plan["segments"]),
+                    0,
+                )
+                # The title, the checkpoint and the disk space are handed to
+                # the chord, which releases them once the task ends.
+                context.update(
+                    title=title,
+                    fingerprint=checkpoint.fingerprint,
+                    reservation=reservation.id,
+                )
+                handed_off = True
+                return self.replace(distribute(self, plan, context))
+
+            # When streaming, the source is a URL that ffmpeg downloads while
+            # it encodes, so the output has to be placed in the task directory.
+            if d["streaming"]:
+                statuscallback("Converting while downloading...", -1)
+                targetbase = os.path.join(outputdir, "dl")
+            else:
+                statuscallback("Converting...", -1)
+                targetbase = None
+
+            with measure_stage(telemetry, "encode"):
+                file = encode.encode(
+                    file,
+                    convertkey,
+                    statuscallback,
+                    errorcallback,
+                    concurrency,
+                    targetbase=targetbase,
+                    source_headers=d["http_headers"],
+                    telemetry=telemetry,
+                    requeue_on_low_memory=requeue_on_low_memory,
+                )
+            if not file:
+                errorcallback("Convert failed!")
+
+            statuscallback("Saving checkpoint...", -1)
+            checkpoint.save_encode(file)
+
+        telemetry.update(describe_task_media(source, file, d))
+
+        # Free the space of the source before uploading, unless its embedded
+        # subtitles are still to be extracted.
+        if (
+            not d["streaming"]
+            and source
+            and source != file
+            and not (subtitles_requested and not subtitles)
+        ):
+            # Sources linked from the source cache keep their space.
+            shared = os.stat(source).st_nlink > 1
+            os.remove(source)
+            checkpoint.source_removed(outputdir)
+            if not shared:
+                reservation.resize(diskspace.get_directory_size(outputdir))
+
+        with measure_stage(telemetry, "upload"):
+            filename, wikifileurl = publish(
+                file, context, statuscallback, errorcallback, checkpoint
+            )
+
+        record_task_telemetry(convertkey, telemetry)
+    except TaskAbort:
+        restartable = False
+        raise
+    except InsufficientMemory as e:
+        # Release the lock so the retry isn't ignored as a duplicate.
+        redisconnection.delete(lockkey)
+        raise self.retry(queue=HEAVY_QUEUE, countdown=0, exc=e)
+    except pywikibot.exceptions.Error:
+        exc_info = sys.exc_info()
+        raise TaskError(
+            ("pywikibot.Error: %s: %s" % (exc_info[0].__name__, exc_info[1])).encode(
+                "utf-8"
+            )
+        ).with_traceback(exc_info[2])
+    else:
+        restartable = False
+        checkpoint.clear()
+        statuscallback("Done!", 100)
+        return {"type": "done", "filename": filename, "url": wikifileurl}
+    finally:
+        try:
+            # The task continues in the chord once it has been handed off.
+            if not handed_off:
+                # Keep what failed tasks have done so far for their restart.
+                if restartable:
+                    checkpoint.keep(outputdir)
+                shutil.rmtree(segmentdir, ignore_errors=True)
+                if title:
+                    release_title(title, self.request.id)
+                reservation.release()
+                cleanup(self, outputdir, statuscallback)
+        finally:
+            # The reporter's thread would otherwise write for the life of
+            # the worker process.
+            statuscallback.close()
+            record_task_usage(username, telemetry)
+
+
+@app.task(bind=True, track_started=False)
+def encode_segment(self, task_id, index, count, segment, key):
+    """Encode one segment of a distributed encode for the main task."""
+    statuscallback = ProgressReporter(
+        main.backend, redisconnection, task_id, segment=(index, count)
+    )
+
+    def errorcallback(text):
+        raise TaskError(text)
+
+    try:
+        target = encode.encode_segment(
+            segment, key, statuscallback, errorcallback, get_worker_concurrency()
         )
+        if not target:
+            errorcallback("Convert failed!")
+    finally:
+        statuscallback.close()
+
+    return target
+
+
+@app.task(bind=True, track_started=False, base=EncodingTask)
+def join_segments(self, segments, plan, context):
+    """Join the segments of a distributed encode and publish the result."""
+    statuscallback = get_statuscallback(self)
+
+    def errorcallback(text):
+        raise TaskError(text)
+
+    restartable = True
+    checkpoint = checkpoints.Checkpoint(redisconnection, context["fingerprint"])
+
+    try:
+        statuscallback("Joining segments...", -1)
+        file = encode.join(plan, segments, statuscallback, errorcallback)
         if not file:
             errorcallback("Convert failed!")
-        ext = file.split(".")[-1]
-
-        statuscallback("Configuring Pywikibot...", -1)
-        pywikibot.config.authenticate["commons.wikimedia.org"] = (
-            consumer_key,
-            consumer_secret,
-        ) + tuple(oauth)
-        pywikibot.config.usernames["commons"]["commons"] = username
-        pywikibot.Site("commons", "commons", user=username).login()
-
-        # Identify the language codes of all present subtitles. Fallback to
-        # checking the container ONLY IF yt-dlp was unable to find subtitles.
-        found_langcodes = set()
-        if subtitles:
-            found_langcodes.update(subtitleuploader.get_subtitle_languages(subtitles))
-        elif subtitles_requested:
-            found_langcodes.update(
-                subtitleuploader.get_container_subtitle_languages(source)
-            )
 
-        # Add additional inferable meta-categories to the file description.
-        found_categories = set()
-        found_categories.update(categories.get_inferable_categories(file))
-        found_categories.update(
-            categories.get_subtitle_categories(file, found_langcodes)
-        )
-        filedesc = categories.append_categories(filedesc, found_categories)
-
-        statuscallback("Uploading...", -1)
-        filename += "." + ext
-        filename, wikifileurl = upload.upload(
-            file,
-            filename,
-            url,
-            filedesc,
-            username,
-            statuscallback,
-            errorcallback,
-        )
-        if not wikifileurl:
-            errorcallback("Upload failed!")
+        statuscallback("Saving checkpoint...", -1)
+        checkpoint.save_encode(file)
 
-        if subtitles:
-            try:
-                subtitleuploader.upload_subtitles(
-                    subtitles, filename, username, statuscallback, errorcallback
-                )
-            except TaskAbort:
-                raise
-            except Exception as e:
-                statuscallback(type(e).__name__ + ": " + str(e), None)
-                print(e)
-        elif subtitles_requested:
-            # Fallback to extracting subtitles from the container if yt-dlp was
-            # unable to find subtitles. This happens with manual mkv uploads
-            # that contain embedded subtitles.
-            try:
-                subtitleuploader.upload_container_subtitles(
-                    filepath=source,
-                    filename=filename,
-                    outputdir=outputdir,
-                    username=username,
-                    statuscallback=statuscallback,
-                )
-            except TaskAbort:
-                raise
-            except Exception as e:
-                statuscallback(type(e).__name__ + ": " + str(e), None)
-                print(e)
+        filename, wikifileurl = publish(
+            file, context, statuscallback, errorcallback, checkpoint
+        )
+    except TaskAbort:
+        restartable = False
+        raise
     except pywikibot.exceptions.Error:
         exc_info = sys.exc_info()
         raise TaskError(
@@ -297,18 +526,278 @@ def main(
             )
         ).with_traceback(exc_info[2])
     else:
+        restartable = False
+        checkpoint.clear()
         statuscallback("Done!", 100)
         return {"type": "done", "filename": filename, "url": wikifileurl}
     finally:
-        statuscallback("Cleaning up...", -1)
-        pywikibot.stopme()
-        pywikibot.config.authenticate.clear()
-        pywikibot.config.usernames["commons"].clear()
-        pywikibot._sites.clear()
+        try:
+            if restartable:
+                checkpoint.keep(context["outputdir"])
+            shutil.rmtree(plan["workdir"], ignore_errors=True)
+            redisconnection.delete("segmentprogress:" + self.request.id)
+            if context["title"]:
+                release_title(context["title"], self.request.id)
+            diskspace.release(context["reservation"])
+            cleanup(self, context["outputdir"], statuscallback)
+        finally:
+            statuscallback.close()
+
+
+@app.task(track_started=False)
+def abandon_segments(task_id, workdir, context):
+    """Clean up after a distributed encode where a segment failed."""
+    shutil.rmtree(workdir, ignore_errors=True)
+    redisconnection.delete("segmentprogress:" + task_id)
+
+    # Nothing is left to do if the join ran and failed itself, it has already
+    # cleaned up the same way.
+    checkpoints.Checkpoint(redisconnection, context["fingerprint"]).keep(
+        context["outputdir"]
+    )
+    shutil.rmtree(context["outputdir"], ignore_errors=True)
+    if context["title"]:
+        release_title(context["title"], task_id)
+    diskspace.release(context["reservation"])
+
+    try:
+        update_task_stats(redisconnection, task_id, remove=True)
+    except Exception:
+        pass  # We don't want to fail the task if we can't update stats.
 
-        shutil.rmtree(outputdir)
+    publish_notification(
+        redisconnection,
+        "update",
+        {"taskid": task_id, "data": get_task_status(redisconnection, task_id)},
+    )
 
+
+def get_task_media_summary(url):
+    """Get the media summary of a task stored at extraction time, if any."""
+    try:
+        return get_media_summary(redisconnection, url)
+    except Exception as e:
+        print("Unable to get media summary:", e)
+        return None
+
+
+def fits_in_memory(summary, convertkey):
+    """Check if the estimated peak memory of a task fits on this host."""
+    try:
+        cost = summary and estimate_calibrated_cost(
+            redisconnection, summary, convertkey
+        )
+    except Exception:
+        return True  # Without an estimate, let the encoder find out.
+
+    headroom = get_memory_headroom()
+    return not cost or headroom is None or cost[1] <= headroom
+
+
+def distribute(task, plan, context):
+    """Build the chord that encodes the segments of a split source."""
+    task_id = task.request.id
+    queue = (task.request.delivery_info or {}).get("routing_key") or "celery"
+
+    segments = group(
+        encode_segment.si(
+            task_id, i, len(plan["segments"]), segment, plan["segmentkey"]
+        ).set(queue=queue)
+        for i, segment in enumerate(plan["segments"])
+    )
+
+    # The segments are joined on this worker since the audio and subtitles are
+    # only available in its local output directory, which is also where the
+    # task is cleaned up if a segment fails.
+    callback = join_segments.s(plan, context).set(
+        exchange="C.dq2", routing_key=task.request.hostname
+    )
+    callback.link_error(
+        abandon_segments.si(task_id, plan["workdir"], context).set(
+            exchange="C.dq2", routing_key=task.request.hostname
+        )
+    )
+
+    return chord(segments, callback)
+
+
+def describe_task_media(source, file, download):
+    """Describe the source and output of a task for its telemetry."""
+    try:
+        headers = download["http_headers"] if download["streaming"] else None
+        mediaprobe = probe(source, headers)
+        info = mediaprobe.mediainfo if mediaprobe else None
+        video = get_video(info)
+
+        return {
+            "resolution": ([video.video_width, video.video_height] if video else None),
+            "duration": info.format.duration if info else None,
+            "bytes_in": getattr(info.format, "size", None) if info else None,
+            "bytes_out": os.path.getsize(file),
+            "media": (
+                summarize_ffprobe(mediaprobe.streams, mediaprobe.format)
+                if mediaprobe
+                else None
+            ),
+        }
+    except Exception as e:
+        print("Unable to describe media:", e)
+        return {}
+
+
+def record_task_telemetry(convertkey, telemetry):
+    """Store the resource usage of a finished task along with its media."""
+    try:
+        record_telemetry(redisconnection, convertkey, telemetry)
+    except Exception as e:
+        print("Unable to record telemetry:", e)
+
+
+def record_task_usage(username, telemetry):
+    """Charge the CPU time used by a task to its user for fair-share."""
+    stages = telemetry.get("stages", {})
+    cpu = sum(stages[stage]["cpu"] for stage in TASK_STAGES if stage in stages)
+
+    try:
+        scheduler.record_usage(brokerconnection, username, cpu)
+    except Exception as e:
+        print("Unable to record usage:", e)
+
+
+def get_statuscallback(task):
+    """Get a callback that reports the progress of a task to its users."""
+    return ProgressReporter(task.backend, redisconnection, task.request.id)
+
+
+def publish(file, context, statuscallback, errorcallback, checkpoint=None):
+    """Upload an encoded file and its subtitles to Commons."""
+    source = context["source"]
+    filename = context["filename"]
+    filedesc = context["filedesc"]
+    username = context["username"]
+    subtitles = context["subtitles"]
+    subtitles_requested = context["subtitles_requested"]
+    ext = file.split(".")[-1]
+
+    statuscallback("Configuring Pywikibot...", -1)
+    configure_pywikibot(username, context["oauth"])
+
+    # Identify the language codes of all present subtitles. Fallback to
+    # checking the container ONLY IF yt-dlp was unable to find subtitles.
+    found_langcodes = set()
+    if subtitles:
+        found_langcodes.update(subtitleuploader.get_subtitle_languages(subtitles))
+    elif subtitles_requested and source:
+        found_langcodes.update(
+            subtitleuploader.get_container_subtitle_languages(source)
+        )
+
+    # Add additional inferable meta-categories to the file description.
+    found_categories = set()
+    found_categories.update(categories.get_inferable_categories(file))
+    found_categories.update(categories.get_subtitle_categories(file, found_langcodes))
+    filedesc = categories.append_categories(filedesc, found_categories)
+
+    statuscallback("Uploading...", -1)
+    filename += "." + ext
+    filename, wikifileurl = upload.upload(
+        file,
+        filename,
+        context["url"],
+        filedesc,
+        username,
+        statuscallback,
+        errorcallback,
+        checkpoint,
+    )
+    if not wikifileurl:
+        errorcallback("Upload failed!")
+
+    if subtitles:
         try:
-            update_task_stats(redisconnection, self.request.id, remove=True)
-        except Exception:
-            pass  # We don't want to fail the task if we can't update stats.
+            subtitleuploader.upload_subtitles(
+                subtitles, filename, username, statuscallback, errorcallback
+            )
+        except TaskAbort:
+            raise
+        except Exception as e:
+            statuscallback(type(e).__name__ + ": " + str(e), None)
+            print(e)
+    elif subtitles_requested and source:
+        # Fallback to extracting subtitles from the container if yt-dlp was
+        # unable to find subtitles. This happens with manual mkv uploads
+        # that contain embedded subtitles. The source is gone if the task
+        # resumed with an encoded file.
+        try:
+            subtitleuploader.upload_container_subtitles(
+                filepath=source,
+                filename=filename,
+                outputdir=context["outputdir"],
+                username=username,
+                statuscallback=statuscallback,
+            )
+        except TaskAbort:
+            raise
+        except Exception as e:
+            statuscallback(type(e).__name__ + ": " + str(e), None)
+            print(e)
+
+    return filename, wikifileurl
+
+
+def configure_pywikibot(username, oauth):
+    """Log in to Commons as the user of a task."""
+    pywikibot.config.authenticate["commons.wikimedia.org"] = (
+        consumer_key,
+        consumer_secret,
+    ) + tuple(oauth)
+    pywikibot.config.usernames["commons"]["commons"] = username
+    pywikibot.Site("commons", "commons", user=username).login()
+
+
+def check_title(task_id, wikifilename, username, oauth, errorcallback):
+    """Check that a task can upload to its title and reserve it for the task."""
+    configure_pywikibot(username, oauth)
+    title = upload.preflight(wikifilename, username, errorcallback)
+
+    key = "titlereservation:" + title
+    if not redisconnection.set(key, task_id, nx=True, ex=TITLE_RESERVATION_TTL):
+        owner = redisconnection.get(key)
+        if owner and owner.decode() != task_id:
+            errorcallback(
+                "Another task is already uploading a file with this name. "
+                "Please choose another name."
+            )
+        redisconnection.expire(key, TITLE_RESERVATION_TTL)
+
+    return title
+
+
+def release_title(title, task_id):
+    """Release the reservation of a title if it is held by a task."""
+    try:
+        key = "titlereservation:" + title
+        owner = redisconnection.get(key)
+        if owner and owner.decode() == task_id:
+            redisconnection.delete(key)
+    except Exception as e:
+        print("Unable to release title:", e)
+
+
+def cleanup(task, outputdir, statuscallback):
+    """Clean up after a task has finished, whether it succeeded or not."""
+    try:
+        statuscallback("Cleaning up...", -1)
+    except TaskAbort:
+        pass  # Aborted tasks are cleaned up all the same.
+    pywikibot.stopme()
+    pywikibot.config.authenticate.clear()
+    pywikibot.config.usernames["commons"].clear()
+    pywikibot._sites.clear()
+
+    shutil.rmtree(outputdir)
+
+    try:
+        update_task_stats(redisconnection, task.request.id, remove=True)
+    except Exception:
+        pass  # We don't want to fail the task if we can't update stats.
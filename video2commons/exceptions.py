@@ -46,3 +46,7 @@ class TaskAbort(TaskError):
     def __init__(self):
         """Initialize."""
         super().__init__("The task has been aborted.")
+
+
+class InsufficientMemory(TaskError):
+    """The host doesn't have enough memory to run the task right now."""
@@ -26,7 +26,15 @@ import re
 
 from uuid import uuid4
 
-from flask import Blueprint, request, session, jsonify, current_app
+from flask import (
+    Blueprint,
+    Response,
+    request,
+    session,
+    jsonify,
+    current_app,
+    stream_with_context,
+)
 
 from video2commons.config import session_key
 
@@ -39,18 +47,28 @@ from video2commons.frontend.shared import (
 )
 from video2commons.frontend.urlextract import (
     do_extract_url,
+    iter_extract_url,
     do_validate_filename_unique,
     do_validate_youtube_id,
     make_dummy_desc,
     do_validate_filename,
     do_validate_filedesc,
     sanitize,
-    DEFAULT_QUEUE,
-    HEAVY_QUEUE,
 )
+from video2commons.frontend import extractjobs
 from video2commons.frontend.upload import upload as _upload, status as _uploadstatus
 from video2commons.shared import stats
+from video2commons.shared.costmodel import (
+    DEFAULT_QUEUE,
+    HEAVY_QUEUE,
+    QUEUE_CLASSES,
+    choose_queue,
+    estimate_calibrated_cost,
+    get_media_summary,
+)
+from video2commons.shared.ratelimiting import get_limiter_stats
 from video2commons.shared.tasks import publish_notification, get_task_status
+from video2commons.shared.telemetry import get_telemetry_summary
 
 # Adapted from: https://stackoverflow.com/a/19161373
 YOUTUBE_REGEX = (
@@ -67,7 +85,7 @@ UPLOADS_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "static/uploads"
 )
 
-VALID_QUEUES = {DEFAULT_QUEUE, HEAVY_QUEUE}
+VALID_QUEUES = {queue for queue, _, _ in QUEUE_CLASSES}
 
 api = Blueprint("api", __name__)
 
@@ -143,6 +161,9 @@ def status():
 
     values = [_f for _f in values if _f]
     rooms = [t["id"] for t in values] + [key]
+    # Maintainers watch all tasks, but their extractions are still their own.
+    if key != "tasks:" + session["username"]:
+        rooms.append("tasks:" + session["username"])
     return jsonify(
         values=values, rooms=rooms, username=session["username"], stats=get_stats()
     )
@@ -178,6 +199,22 @@ def get_stats():
     return json.loads(stats) if stats else None
 
 
+@api.route("/telemetry")
+def telemetry():
+    """Get the resource usage of finished tasks per encoding profile."""
+    assert session.get("is_maintainer"), "Only maintainers may view telemetry."
+
+    return jsonify(telemetry=get_telemetry_summary(redisconnection))
+
+
+@api.route("/ratelimits")
+def ratelimits():
+    """Get the wait and hold times of the yt-dlp rate limiters."""
+    assert session.get("is_maintainer"), "Only maintainers may view rate limits."
+
+    return jsonify(stats=get_stats(), ratelimits=get_limiter_stats(redisconnection))
+
+
 @api.route("/extracturl", methods=["POST"])
 def extract_url():
     """Extract a video url."""
@@ -186,6 +223,54 @@ def extract_url():
     return jsonify(**do_extract_url(url))
 
 
+@api.route("/extracturl/async", methods=["POST"])
+def extract_url_async():
+    """
+    Start extracting a video url in the background.
+
+    The result is sent with an "extraction" socket.io event once it is done,
+    and can also be polled from /api/extracturl/job.
+    """
+    url = request.form["url"]
+    room = "tasks:" + session["username"]
+
+    return jsonify(jobid=extractjobs.submit(url, session["username"], room))
+
+
+@api.route("/extracturl/job")
+def extract_url_job():
+    """Get the state of a background url extraction."""
+    job = extractjobs.get(request.args["id"], session["username"])
+    assert job, "This extraction does not exist or has expired."
+
+    return jsonify(**job)
+
+
+@api.route("/extracturl/stream", methods=["POST"])
+def extract_url_stream():
+    """
+    Extract a video url, streaming the results as newline-delimited JSON.
+
+    Playlists start with a line of type "playlist" with their entry count,
+    followed by a "video" or "error" line for each entry once it has been
+    extracted. Single videos are a single line of type "single".
+    """
+    url = request.form["url"]
+
+    def generate():
+        try:
+            for result in iter_extract_url(url):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "error": format_exception(e)}) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},  # Don't let proxies hold lines back
+    )
+
+
 @api.route("/makedesc", methods=["POST"])
 def make_desc():
     """Create a (mostly-empty) description."""
@@ -324,16 +409,25 @@ def run_task():
     oauth = (session["access_token_key"], session["access_token_secret"])
     queue = request.form.get("queue")
 
+    if url.startswith("uploads:"):
+        filekey = url.split(":", 1)[1]
+        if not FILEKEY_REGEX.match(filekey):
+            return jsonify(error="Invalid file key format"), 400
+
+    # Now that the format is known, pick the queue from the estimated cost of
+    # converting the media that was summarized when the URL was extracted.
+    summary = get_media_summary(redisconnection, url)
+    cost = None
+    if summary:
+        cost = estimate_calibrated_cost(redisconnection, summary, convertkey)
+        queue = choose_queue(cost, summary)
+
     # If no queue is specified, such is the case with manually uploaded files
     # due to yt-dlp not being used and extracturl not being called, determine
     # which queue to process the file on based on file metadata such as bitrate
     # and resolution. We do this to avoid OOM errors with heavy files.
     if not queue:
         if url.startswith("uploads:"):
-            filekey = url.split(":", 1)[1]
-            if not FILEKEY_REGEX.match(filekey):
-                return jsonify(error="Invalid file key format"), 400
-
             # Hotfix: Temporarily default to DEFAULT_QUEUE until the ffprobe
             # issue is properly fixed.
             queue = DEFAULT_QUEUE
@@ -357,13 +451,21 @@ def run_task():
             oauth,
         ),
         queue,
+        cost[0] if cost else None,
     )
 
     return jsonify(id=taskid, step="success")
 
 
-def run_task_internal(filename, params, queue):
-    """Internal run task function to accept whatever params given."""
+def run_task_internal(filename, params, queue, cost=None, user=None):
+    """Internal run task function to accept whatever params given.
+
+    The task is queued per user and released to the workers in fair-share
+    order, weighted by its estimated cost in CPU-seconds if known. It belongs
+    to the given user, or to the user of the session by default.
+    """
+    user = user or session["username"]
+
     banned = check_banned()
     assert not banned, "You are banned from using this tool! Reason: " + banned
 
@@ -372,27 +474,26 @@ def run_task_internal(filename, params, queue):
     if queue not in VALID_QUEUES:
         queue = DEFAULT_QUEUE
 
-    res = worker.main.apply_async(args=params, queue=queue)
-    taskid = res.id
+    taskid = str(uuid4())
 
     expire = 14 * 24 * 3600  # 2 weeks
     redisconnection.lpush("alltasks", taskid)
     redisconnection.expire("alltasks", expire)
-    redisconnection.lpush("tasks:" + session["username"], taskid)
-    redisconnection.expire("tasks:" + session["username"], expire)
+    redisconnection.lpush("tasks:" + user, taskid)
+    redisconnection.expire("tasks:" + user, expire)
     redisconnection.set("titles:" + taskid, filename)
     redisconnection.expire("titles:" + taskid, expire)
     redisconnection.set("params:" + taskid, json.dumps(params))
     redisconnection.expire("params:" + taskid, expire)
 
+    worker.submit_task(taskid, params, queue, user, cost)
+
     try:
         stats.increment_queue_counter(redisconnection)
     except Exception:
         pass  # We don't want to fail the API call if we can't update stats.
 
-    publish_notification(
-        redisconnection, "add", {"taskid": taskid, "user": session["username"]}
-    )
+    publish_notification(redisconnection, "add", {"taskid": taskid, "user": user})
     publish_notification(
         redisconnection,
         "update",
@@ -418,10 +519,12 @@ def restart_task():
     assert not restarted, "Task has already been restarted with id " + restarted
     params = redisconnection.get("params:" + id)
     assert params, "Could not extract the task parameters."
+    params = json.loads(params)
 
     # Always restart failed tasks on the heavy queue as a failsafe in case the
-    # task failed earlier due to being misprioritized.
-    newid = run_task_internal(filename, json.loads(params), HEAVY_QUEUE)
+    # task failed earlier due to being misprioritized. Tasks restarted by
+    # maintainers still belong to, and are charged to, the user who uploads.
+    newid = run_task_internal(filename, params, HEAVY_QUEUE, user=params[7])
     redisconnection.set("restarted:" + id, newid)
 
     publish_notification(
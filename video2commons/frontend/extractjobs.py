@@ -0,0 +1,101 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+#
+
+"""video2commons background URL extractions."""
+
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from video2commons.frontend.shared import redisconnection
+from video2commons.frontend.urlextract import do_extract_url
+from video2commons.shared.errors import format_exception
+from video2commons.shared.tasks import publish_notification
+
+# Extractions run on a small pool of threads of each web worker, so that
+# requests waiting on rate limited sites don't hold up the web workers.
+# Extractions beyond MAX_PENDING per web worker are refused.
+MAX_WORKERS = 4
+MAX_PENDING = 32
+
+# Jobs and their results are kept for JOB_TTL seconds, which is also how long
+# a job may take before it is considered lost, e.g. to a web worker restart.
+JOB_TTL = 10 * 60
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="extract")
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def submit(url, username, room):
+    """
+    Start extracting a url in the background and return the job ID.
+
+    The result is announced to the socket.io room of the user's tasks.
+    """
+    acquired = _pending.acquire(blocking=False)
+    assert acquired, (
+        "Too many URLs are being extracted right now, please try again later."
+    )
+
+    jobid = str(uuid4())
+    try:
+        _save(jobid, {"status": "pending", "user": username})
+        _executor.submit(_run, jobid, url, username, room)
+    except Exception:
+        _pending.release()
+        raise
+
+    return jobid
+
+
+def get(jobid, username):
+    """Get the state of a job of a user, or None if it doesn't exist."""
+    job = redisconnection.get("extractjob:" + jobid)
+    if not job:
+        return None
+
+    job = json.loads(job)
+    if job.pop("user") != username:
+        return None
+
+    return job
+
+
+def _run(jobid, url, username, room):
+    try:
+        job = {"status": "done", "result": do_extract_url(url)}
+    except Exception as e:
+        job = {
+            "status": "error",
+            "error": format_exception(e),
+            "traceback": traceback.format_exc(),
+        }
+    finally:
+        _pending.release()
+
+    _save(jobid, dict(job, user=username))
+    publish_notification(
+        redisconnection,
+        "extraction",
+        {"jobid": jobid, "room": room, "data": job},
+    )
+
+
+def _save(jobid, job):
+    redisconnection.setex("extractjob:" + jobid, JOB_TTL, json.dumps(job))
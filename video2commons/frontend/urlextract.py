@@ -31,8 +31,20 @@ import guess_language
 import pywikibot
 import yt_dlp
 
+from video2commons.shared.costmodel import (
+    DEFAULT_CONVERTKEY,
+    DEFAULT_QUEUE,
+    predict_queue,
+    store_media_summary,
+    summarize_ffprobe,
+    summarize_ytdlp,
+)
 from video2commons.shared.ratelimiting import YoutubeDLRateLimited
-from video2commons.shared.yt_dlp import add_youtube_params
+from video2commons.shared.yt_dlp import (
+    add_youtube_params,
+    cache_extraction,
+    get_cached_extraction,
+)
 from video2commons.frontend.wcqs import WcqsSession
 from video2commons.frontend.shared import redisconnection
 
@@ -70,16 +82,9 @@ NAMESPACE_FILE = 6
 # size supported by MediaWiki for uploads.
 MAX_FILENAME_SIZE = 228
 
-# Task queue routing thresholds for the default and heavy queues. Both 4k and
-# 20 Mbps (in kbps) videos get routed to the heavy queue to avoid OOM errors.
-HEAVY_RESOLUTION_THRESHOLD = 3840
-HEAVY_BITRATE_THRESHOLD = 20000
-DEFAULT_QUEUE = "celery"
-HEAVY_QUEUE = "heavy"
-
 # The frontend has a shorter timeout for ratelimiting because it only fetches
-# metadata. Metadata should always be returnable within a minute, so the lock
-# shouldn't be held for too long so URL extractions don't hang for too long.
+# metadata. Metadata should always be returnable within a minute, so the slot
+# shouldn't be waited for too long so URL extractions don't hang for too long.
 RATELIMIT_LOCK_TIMEOUT = 60
 
 # The frontend only extracts metadata (download=False), so extraction request
@@ -90,30 +95,13 @@ REDIS_PREFIX_BLACKLIST_KEY = "commons:filename-prefix-blacklist"
 REDIS_PREFIX_BLACKLIST_TTL = 24 * 3600  # 1 day
 
 
-def predict_task_type(metadata):
-    """Predict how resource-intensive a task is based on yt-dlp metadata."""
-    # Check if the resolution exceed the threshold for the standard queue.
-    width = metadata.get("width") or 0
-    height = metadata.get("height") or 0
-    if width >= HEAVY_RESOLUTION_THRESHOLD or height >= HEAVY_RESOLUTION_THRESHOLD:
-        return HEAVY_QUEUE
-
-    # Check the bitrate. TBR is total, VBR is video only (both in kbps).
-    bitrate = metadata.get("tbr") or metadata.get("vbr") or 0
-    if bitrate >= HEAVY_BITRATE_THRESHOLD:
-        return HEAVY_QUEUE
-
-    # Default to heavy if no bitrate is available. This is a fallback for video
-    # sources that don't have yt-dlp extractors such as NASA Scientific
-    # Visualization Studio, which typically has large files.
-    if metadata.get("tbr") is None and metadata.get("vbr") is None:
-        return HEAVY_QUEUE
+def predict_task_type(metadata, convertkey=DEFAULT_CONVERTKEY):
+    """Predict which queue a task should run on from yt-dlp metadata."""
+    return predict_queue(redisconnection, summarize_ytdlp(metadata), convertkey)
 
-    return DEFAULT_QUEUE
 
-
-def predict_task_type_ffprobe(filepath):
-    """Predict how resource-intensive a task is based on ffprobe metadata."""
+def predict_task_type_ffprobe(filepath, convertkey=DEFAULT_CONVERTKEY):
+    """Predict which queue a task should run on from ffprobe metadata."""
     result = subprocess.run(
         [
             "ffprobe",
@@ -133,26 +121,9 @@ def predict_task_type_ffprobe(filepath):
         return DEFAULT_QUEUE
 
     probe = json.loads(result.stdout)
+    summary = summarize_ffprobe(probe.get("streams", []), probe.get("format", {}))
 
-    # Check video streams for resolution.
-    for stream in probe.get("streams", []):
-        if stream.get("codec_type") == "video":
-            width = stream.get("width") or 0
-            height = stream.get("height") or 0
-            if (
-                width >= HEAVY_RESOLUTION_THRESHOLD
-                or height >= HEAVY_RESOLUTION_THRESHOLD
-            ):
-                return HEAVY_QUEUE
-
-    # Check bitrate from format (in bits/sec, convert to kbps).
-    format_info = probe.get("format", {})
-    bitrate_bps = int(format_info.get("bit_rate") or 0)
-    bitrate_kbps = bitrate_bps / 1000
-    if bitrate_kbps >= HEAVY_BITRATE_THRESHOLD:
-        return HEAVY_QUEUE
-
-    return DEFAULT_QUEUE
+    return predict_queue(redisconnection, summary, convertkey)
 
 
 def make_dummy_desc(filename):
@@ -180,6 +151,83 @@ def make_dummy_desc(filename):
 
 def do_extract_url(url):
     """Extract a video url."""
+    # Reuse metadata extracted recently, e.g. when the form is opened again.
+    info = get_cached_extraction(redisconnection, url)
+    if info is None:
+        info = _extract(url, _get_extract_params(url))
+
+        # Tasks submitted for the video can then skip the extraction.
+        cache_extraction(redisconnection, url, info)
+
+    # Extract playlist entries if this is a playlist.
+    if info and "entries" in info:
+        videos = []
+        for entry in info["entries"]:
+            if entry is None:
+                continue  # Skip over videos that are unavailable.
+
+            video_info = _extract_info(entry)
+            videos.append(video_info)
+
+        return {
+            "type": "playlist",
+            "id": info.get("id", ""),
+            "title": info.get("title", ""),
+            "url": url,
+            "videos": videos,
+        }
+
+    video_info = _extract_info(info)
+
+    return {"type": "single", **video_info}
+
+
+def iter_extract_url(url):
+    """
+    Extract a video url, yielding the videos of playlists one at a time.
+
+    Playlists are first listed without resolving their entries, which are
+    then extracted one by one, so that results can be sent as soon as they
+    are known and no single extraction has to cover the whole playlist.
+    """
+    info = get_cached_extraction(redisconnection, url)
+    if info is None:
+        params = _get_extract_params(url)
+        params["extract_flat"] = "in_playlist"
+        info = _extract(url, params)
+
+        if not info or "entries" not in info:
+            cache_extraction(redisconnection, url, info)
+
+    if not info or "entries" not in info:
+        yield {"type": "single", **_extract_info(info)}
+        return
+
+    entries = [entry for entry in info["entries"] if entry]
+    yield {
+        "type": "playlist",
+        "id": info.get("id", ""),
+        "title": info.get("title", ""),
+        "url": url,
+        "count": len(entries),
+    }
+
+    for entry in entries:
+        entry_url = entry.get("webpage_url") or entry.get("url")
+        try:
+            entry_info = get_cached_extraction(redisconnection, entry_url)
+            if entry_info is None:
+                entry_info = _extract(entry_url, _get_extract_params(entry_url))
+                cache_extraction(redisconnection, entry_url, entry_info)
+
+            yield {"type": "video", **_extract_info(entry_info)}
+        except Exception as e:
+            # Unavailable videos are skipped, like in full extractions.
+            yield {"type": "error", "url": entry_url, "error": str(e)}
+
+
+def _get_extract_params(url):
+    """Get the yt-dlp parameters to extract the metadata of a url."""
     params = {
         "format": "bestvideo+bestaudio/best",
         "outtmpl": "/dev/null",
@@ -203,6 +251,11 @@ def do_extract_url(url):
         if "/playlist" in url or re.search(r"[?&]list=", url):
             params["ignoreerrors"] = True
 
+    return params
+
+
+def _extract(url, params):
+    """Extract the metadata of a url with the frontend's rate limits."""
     with YoutubeDLRateLimited(
         conn=redisconnection,
         source="frontend",
@@ -211,29 +264,7 @@ def do_extract_url(url):
         timeout=RATELIMIT_LOCK_TIMEOUT,
         blocking_timeout=RATELIMIT_LOCK_TIMEOUT,
     ) as dl:
-        info = dl.extract_info(url, download=False)
-
-    # Extract playlist entries if this is a playlist.
-    if info and "entries" in info:
-        videos = []
-        for entry in info["entries"]:
-            if entry is None:
-                continue  # Skip over videos that are unavailable.
-
-            video_info = _extract_info(entry)
-            videos.append(video_info)
-
-        return {
-            "type": "playlist",
-            "id": info.get("id", ""),
-            "title": info.get("title", ""),
-            "url": url,
-            "videos": videos,
-        }
-
-    video_info = _extract_info(info)
-
-    return {"type": "single", **video_info}
+        return dl.extract_info(url, download=False)
 
 
 def _extract_info(info):
@@ -254,6 +285,11 @@ def _extract_info(info):
         "license": _license(url, ie_key, title, info),
     }
 
+    # The queue is picked again once the format is known when the task is
+    # submitted, which needs the media summary since metadata isn't kept.
+    if url:
+        store_media_summary(redisconnection, url, summarize_ytdlp(info))
+
     return {
         "url": url,
         "extractor": ie_key,
@@ -0,0 +1,275 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Estimate the resources a task needs to pick the queue it runs on."""
+
+import json
+import statistics
+import time
+
+DEFAULT_QUEUE = "celery"
+HEAVY_QUEUE = "heavy"
+
+# Queue classes from the cheapest to the most capable. A task is routed to the
+# first queue whose workers can take its estimated CPU time (in CPU-seconds)
+# and peak memory (in bytes); None means there is no limit. Workers of the
+# default queue run two tasks on small instances, so the limits amount to about
+# half a day on four cores and half of the memory of such an instance. The
+# heavy queue has hosts with a single worker.
+QUEUE_CLASSES = [
+    (DEFAULT_QUEUE, 48 * 3600, 3 << 30),
+    (HEAVY_QUEUE, None, None),
+]
+
+# Convert key used to estimate costs before the user has picked a format. This
+# is the format preselected by the frontend, and the most expensive one.
+DEFAULT_CONVERTKEY = "av1.webm"
+
+# CPU-seconds needed to encode one million pixels with each video codec. Two
+# pass encodes cost an extra TWOPASS_COST times as much for the first pass.
+ENCODE_COST = {
+    "av1": 0.12,
+    "vp9": 0.1,
+    "vp8": 0.05,
+    "theora": 0.03,
+    "h264": 0.03,
+}
+TWOPASS_COST = 0.4
+
+# CPU-seconds needed to decode one million pixels of each source codec.
+DECODE_COST = {
+    "av1": 0.012,
+    "hevc": 0.01,
+    "vp9": 0.008,
+    "h264": 0.004,
+}
+DEFAULT_DECODE_COST = 0.006
+
+# CPU-seconds needed to encode one second of audio.
+AUDIO_COST = 0.02
+
+# Threads of an encoder the peak memory is estimated for, which is about what
+# each task of the default queue gets.
+ENCODER_THREADS = 4
+
+# Frame rate assumed when the source doesn't report one.
+DEFAULT_FPS = 30
+
+# Observed costs recorded in the telemetry of finished tasks are used to
+# correct the estimates of each profile once enough of them are available.
+# Calibrations are refreshed every CALIBRATION_TTL seconds.
+CALIBRATION_MIN_RECORDS = 10
+CALIBRATION_TTL = 10 * 60
+
+MEDIA_SUMMARY_TTL = 24 * 3600
+
+_calibrations = {}
+
+
+def summarize_ytdlp(info):
+    """Summarize the media of a video from its yt-dlp metadata."""
+    return {
+        "duration": info.get("duration"),
+        "width": info.get("width"),
+        "height": info.get("height"),
+        "fps": info.get("fps"),
+        "vcodec": _normalize_codec(info.get("vcodec")),
+        "filesize": info.get("filesize") or info.get("filesize_approx"),
+    }
+
+
+def summarize_ffprobe(streams, format):
+    """Summarize the media of a file from its ffprobe streams and format."""
+    summary = {
+        "duration": _number(format.get("duration")),
+        "width": None,
+        "height": None,
+        "fps": None,
+        "vcodec": None,
+        "filesize": _number(format.get("size")),
+    }
+
+    for stream in streams:
+        if stream.get("codec_type") != "video":
+            continue
+        if (stream.get("disposition") or {}).get("attached_pic"):
+            continue  # Cover art isn't encoded as a video
+
+        num, _, den = (stream.get("avg_frame_rate") or "").partition("/")
+        summary.update(
+            {
+                "width": stream.get("width"),
+                "height": stream.get("height"),
+                "fps": _number(num) / _number(den) if _number(den) else None,
+                "vcodec": _normalize_codec(stream.get("codec_name")),
+            }
+        )
+        break
+
+    return summary
+
+
+def estimate_cost(summary, convertkey, calibrate=None):
+    """
+    Estimate the CPU-seconds and peak memory needed to convert some media.
+
+    Returns a (cpu, memory) tuple, or None if the duration of the media isn't
+    known. calibrate is an optional function returning (cpu, memory) factors
+    for a convert key, see get_calibration.
+    """
+    # The transcode settings and the memory model of the encoders need to be
+    # imported dynamically to prevent a cyclic reference, since the worker
+    # module imports this one.
+    from video2commons.backend.encode.memory import estimate_memory
+    from video2commons.backend.encode.transcode import WebVideoTranscode
+
+    options = WebVideoTranscode.settings.get(convertkey, {})
+    duration = summary.get("duration")
+    if not duration:
+        return None
+
+    cpu = duration * AUDIO_COST
+    pixels = 0
+
+    codec = options.get("videoCodec")
+    if codec and "novideo" not in options and summary.get("width"):
+        fps = summary.get("fps") or DEFAULT_FPS
+        pixels = summary["width"] * (summary.get("height") or summary["width"])
+        megapixels = pixels * fps * duration / 1e6
+
+        encode = ENCODE_COST.get(codec, max(ENCODE_COST.values()))
+        if options.get("twopass") == "True":
+            encode *= 1 + TWOPASS_COST
+        decode = DECODE_COST.get(summary.get("vcodec"), DEFAULT_DECODE_COST)
+
+        cpu += megapixels * (encode + decode)
+
+    memory = estimate_memory(pixels, options, ENCODER_THREADS)
+
+    if calibrate:
+        cpu_factor, memory_factor = calibrate(convertkey)
+        cpu *= cpu_factor
+        memory *= memory_factor
+
+    return cpu, memory
+
+
+def choose_queue(cost, summary=None):
+    """Pick the cheapest queue class that can handle an estimated cost."""
+    if cost is None:
+        # Without a duration the only hint left is the size of the source.
+        # Small files such as short clips without metadata are cheap anyway.
+        filesize = (summary or {}).get("filesize")
+        if filesize and filesize > 2 << 30:
+            return QUEUE_CLASSES[-1][0]
+        return QUEUE_CLASSES[0][0]
+
+    cpu, memory = cost
+    for queue, max_cpu, max_memory in QUEUE_CLASSES:
+        if max_cpu is not None and cpu > max_cpu:
+            continue
+        if max_memory is not None and memory > max_memory:
+            continue
+        return queue
+
+    return QUEUE_CLASSES[-1][0]
+
+
+def get_calibration(conn, convertkey):
+    """
+    Get correction factors for the estimates of a profile from telemetry.
+
+    The CPU factor is the median ratio of observed to estimated CPU time of
+    the encode stage, and the memory factor the 95th percentile of observed to
+    estimated peak memory, so memory is rather overestimated than not.
+    """
+    now = time.monotonic()
+    cached = _calibrations.get(convertkey)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    cpu_ratios = []
+    memory_ratios = []
+    for record in conn.lrange("telemetry:" + convertkey, 0, -1):
+        record = json.loads(record)
+        encode = record.get("stages", {}).get("encode")
+        cost = estimate_cost(record.get("media") or {}, convertkey)
+        if not encode or not cost:
+            continue
+
+        cpu_ratios.append(encode["cpu"] / cost[0])
+        # Older records and encodes that weren't sampled have no peak memory.
+        if record.get("maxrss"):
+            memory_ratios.append(record["maxrss"] / cost[1])
+
+    cpu_factor = memory_factor = 1
+    if len(cpu_ratios) >= CALIBRATION_MIN_RECORDS:
+        cpu_factor = _clamp(statistics.median(cpu_ratios))
+    if len(memory_ratios) >= CALIBRATION_MIN_RECORDS:
+        memory_ratios.sort()
+        memory_factor = _clamp(memory_ratios[int(0.95 * (len(memory_ratios) - 1))])
+    factors = (cpu_factor, memory_factor)
+
+    _calibrations[convertkey] = (now + CALIBRATION_TTL, factors)
+    return factors
+
+
+def estimate_calibrated_cost(conn, summary, convertkey):
+    """Estimate the cost of a conversion, corrected with telemetry."""
+    return estimate_cost(summary, convertkey, lambda key: get_calibration(conn, key))
+
+
+def predict_queue(conn, summary, convertkey):
+    """Pick the queue for converting some media to a profile."""
+    return choose_queue(estimate_calibrated_cost(conn, summary, convertkey), summary)
+
+
+def store_media_summary(conn, url, summary):
+    """Remember the media summary of a URL until its task is submitted."""
+    conn.setex("mediasummary:" + url, MEDIA_SUMMARY_TTL, json.dumps(summary))
+
+
+def get_media_summary(conn, url):
+    """Get the media summary of a URL stored at extraction time, if any."""
+    summary = conn.get("mediasummary:" + url)
+
+    return json.loads(summary) if summary else None
+
+
+def _normalize_codec(codec):
+    """Map codec names of yt-dlp and ffprobe to the same family names."""
+    if not codec or codec == "none":
+        return None
+
+    codec = codec.lower().split(".")[0]
+    return {
+        "avc1": "h264",
+        "avc3": "h264",
+        "hev1": "hevc",
+        "hvc1": "hevc",
+        "h265": "hevc",
+        "vp09": "vp9",
+        "av01": "av1",
+    }.get(codec, codec)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _clamp(factor):
+    # Keep a few outliers from making the estimates absurd.
+    return min(max(factor, 0.1), 10)
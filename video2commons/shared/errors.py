@@ -57,9 +57,10 @@ KNOWN_ERRORS = [
     },
     {
         # This happens if the titleblacklist regex finds a match in the file's
-        # title. The error message returned by pywikibot is confusing and
-        # doesn't give the user any useful information to act on.
-        "pattern": r"pywikibot\.Error: APIError: titleblacklist-forbidden",
+        # title, either when uploading or in the preflight check of tasks. The
+        # error message returned by pywikibot is confusing and doesn't give
+        # the user any useful information to act on.
+        "pattern": r"(pywikibot\.Error: APIError: |Upload not allowed: )titleblacklist-forbidden",
         "i18n_key": "title-forbidden-error",
         "urls": ["https://commons.wikimedia.org/wiki/Commons:File_naming"],
     },
@@ -95,6 +96,13 @@ KNOWN_ERRORS = [
         "i18n_key": "output-too-large-error",
         "urls": ["https://commons.wikimedia.org/wiki/Commons:Maximum_file_size"],
     },
+    {
+        # Encodes are also stopped early once their projected size is above
+        # the Commons upload limit.
+        "pattern": r"Output too large: projected size",
+        "i18n_key": "output-too-large-error",
+        "urls": ["https://commons.wikimedia.org/wiki/Commons:Maximum_file_size"],
+    },
 ]
 
 
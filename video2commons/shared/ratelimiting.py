@@ -14,6 +14,9 @@
 """Helpers for distributed rate limiting of yt-dlp requests."""
 
 import logging
+import math
+import time
+import uuid
 
 from contextlib import contextmanager
 from urllib.parse import urlparse
@@ -21,19 +24,24 @@ from urllib.parse import urlparse
 import yt_dlp
 
 from redis import Redis
-from redis.lock import Lock
-from redis.exceptions import LockError, LockNotOwnedError
 
 logger = logging.getLogger(__name__)
 
-# Redis key prefix for rate limit locks.
-LOCK_KEY_PREFIX = "yt_dlp_lock"
+# Redis key prefix for rate limiter state.
+KEY_PREFIX = "yt_dlp_limit"
 
-# Default lock timeout in seconds. 20 minutes was chosen to accommodate the
-# cumulative sleep delays from rate limiting (e.g. 10s per media segment, 3s
-# per extraction request), while still expiring in a reasonable time if a
-# worker dies without releasing the lock.
-DEFAULT_LOCK_TIMEOUT = 20 * 60
+# Default lifetime of a concurrency slot in seconds. Slots are renewed on
+# every request made while holding them, so this only needs to cover the
+# longest pause between requests, and reclaims the slots of dead workers.
+DEFAULT_LEASE_TIMEOUT = 5 * 60
+
+# Default time in seconds to wait for a concurrency slot before giving up.
+DEFAULT_WAIT_TIMEOUT = 20 * 60
+
+# Seconds between attempts to take a concurrency slot while waiting. Waiters
+# that stop polling for WAITER_TIMEOUT seconds lose their place in line.
+POLL_INTERVAL = 1
+WAITER_TIMEOUT = 30
 
 # Domains where rate limiting logic should be applied, grouped by site.
 RATE_LIMITED_DOMAINS = {
@@ -46,15 +54,279 @@ RATE_LIMITED_DOMAINS = {
     },
 }
 
+# Limits for each group, shared by all workers of a source (e.g. the backend):
+# - concurrency: how many downloaders may be in their request phase (metadata,
+#   pages, subtitles) at once. Media transfers don't hold a slot.
+# - rate: how many requests per second they may make together on average.
+# - burst: how many requests may be made at once after being idle.
+GROUP_POLICIES = {
+    "youtube": {
+        "concurrency": 4,
+        "rate": 1.0,
+        "burst": 3,
+    },
+}
+
+# Limits for groups without a policy of their own, which are as strict as the
+# single lock per group that used to be taken.
+DEFAULT_POLICY = {
+    "concurrency": 1,
+    "rate": 1 / 3,
+    "burst": 1,
+}
+
 # Rate limiting parameters for each type of request being made to YouTube.
 # These are tweaked to work best with anonymous calls to YouTube that are made
-# without session cookies.
+# without session cookies. Extraction requests are paced by the token buckets
+# of GROUP_POLICIES instead, since those apply across workers.
 SLEEP_PARAMS = {
     "sleep_interval": 10,  # Media file downloads (video/audio).
-    "sleep_interval_requests": 3,  # Extraction requests (metadata, pages).
     "sleep_interval_subtitles": 6,  # Subtitle downloads.
 }
 
+# Upper bounds in seconds of the buckets of the wait and hold time histograms
+# of each limiter, kept for tuning the policies and sleeps.
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, math.inf]
+HISTOGRAMS = ["wait", "token_wait", "hold"]
+COUNTERS = ["acquired", "contended", "timeouts"]
+
+# Set of the "<source>:<group>" limiters that have recorded statistics.
+STATS_KEY = KEY_PREFIX + ":stats"
+
+# Takes a concurrency slot if one is free and the caller is first in line for
+# it. Waiters are served in the order they started waiting.
+#
+# KEYS: slots (id -> lease expiry), queue (id -> ticket),
+#       waiters (id -> waiter expiry), ticket counter
+# ARGV: id, lease timeout, waiter timeout, concurrency
+ACQUIRE_SCRIPT = """
+local slots, queue, waiters, counter = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local id = ARGV[1]
+local lease, patience = tonumber(ARGV[2]), tonumber(ARGV[3])
+local limit = tonumber(ARGV[4])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+redis.call("ZREMRANGEBYSCORE", slots, "-inf", now)
+for _, waiter in ipairs(redis.call("ZRANGEBYSCORE", waiters, "-inf", now)) do
+    redis.call("ZREM", queue, waiter)
+end
+redis.call("ZREMRANGEBYSCORE", waiters, "-inf", now)
+
+if not redis.call("ZSCORE", queue, id) then
+    redis.call("ZADD", queue, redis.call("INCR", counter), id)
+end
+
+local free = limit - redis.call("ZCARD", slots)
+if redis.call("ZRANK", queue, id) < free then
+    redis.call("ZREM", queue, id)
+    redis.call("ZREM", waiters, id)
+    redis.call("ZADD", slots, now + lease, id)
+    if redis.call("TTL", slots) < lease then
+        redis.call("EXPIRE", slots, math.ceil(lease))
+    end
+    return 1
+end
+
+redis.call("ZADD", waiters, now + patience, id)
+for _, key in ipairs({queue, waiters, counter}) do
+    redis.call("EXPIRE", key, math.ceil(patience))
+end
+return 0
+"""
+
+# Extends the lease of a held concurrency slot.
+#
+# KEYS: slots
+# ARGV: id, lease timeout
+RENEW_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local lease = tonumber(ARGV[2])
+redis.call("ZADD", KEYS[1], "XX", now + lease, ARGV[1])
+if redis.call("TTL", KEYS[1]) < lease then
+    redis.call("EXPIRE", KEYS[1], math.ceil(lease))
+end
+return 0
+"""
+
+# Takes a token from a token bucket, going into debt if it is empty, and
+# returns how long to wait until that token has been earned. Debts are paid
+# off in order, which keeps requests first come, first served.
+#
+# KEYS: bucket
+# ARGV: rate, burst
+TAKE_TOKEN_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "time")
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - last) * rate) - 1
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "time", now)
+redis.call("EXPIRE", KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return tostring(math.max(0, -tokens / rate))
+"""
+
+
+class RateLimiter:
+    """
+    A distributed limiter of the requests made to a group of sites.
+
+    Downloaders take one of a limited number of concurrency slots before
+    making requests, in the order they asked for them, and each request takes
+    a token from a bucket shared by all of them. The slot is given back once
+    the media transfer starts, which is throttled by yt-dlp's own sleeps.
+    """
+
+    def __init__(
+        self,
+        conn: Redis,
+        source: str,
+        group: str,
+        timeout=DEFAULT_LEASE_TIMEOUT,
+        blocking_timeout=DEFAULT_WAIT_TIMEOUT,
+    ):
+        self.conn = conn
+        self.group = group
+        self.policy = GROUP_POLICIES.get(group, DEFAULT_POLICY)
+        self.timeout = timeout
+        self.blocking_timeout = blocking_timeout
+        self.id = uuid.uuid4().hex
+        self.held = False
+        self.acquired_at = None
+        self.stats_prefix = f"{STATS_KEY}:{source}:{group}"
+        self.stats_member = f"{source}:{group}"
+
+        prefix = _key(source, group)
+        self.slots_key = prefix + ":slots"
+        self.queue_key = prefix + ":queue"
+        self.waiters_key = prefix + ":waiters"
+        self.counter_key = prefix + ":counter"
+        self.bucket_key = prefix + ":bucket"
+
+        self._acquire = conn.register_script(ACQUIRE_SCRIPT)
+        self._renew = conn.register_script(RENEW_SCRIPT)
+        self._take_token = conn.register_script(TAKE_TOKEN_SCRIPT)
+
+    def acquire(self):
+        """Wait for a concurrency slot, raising RuntimeError on timeout."""
+        start = time.monotonic()
+        deadline = start + self.blocking_timeout
+        contended = False
+        while True:
+            acquired = self._acquire(
+                keys=[
+                    self.slots_key,
+                    self.queue_key,
+                    self.waiters_key,
+                    self.counter_key,
+                ],
+                args=[
+                    self.id,
+                    self.timeout,
+                    WAITER_TIMEOUT,
+                    self.policy["concurrency"],
+                ],
+            )
+            if acquired:
+                break
+
+            if time.monotonic() >= deadline:
+                self._leave()
+                self._record(
+                    histograms={"wait": time.monotonic() - start},
+                    counters=["timeouts"] + (["contended"] if contended else []),
+                )
+                message = "Failed to acquire a slot of '%s'"
+                logger.error(message, self.slots_key)
+                raise RuntimeError(message % self.slots_key)
+
+            contended = True
+            time.sleep(POLL_INTERVAL)
+
+        self.held = True
+        self.acquired_at = time.monotonic()
+        self._record(
+            histograms={"wait": self.acquired_at - start},
+            counters=["acquired"] + (["contended"] if contended else []),
+        )
+        logger.info("Acquired a slot of '%s'", self.slots_key)
+
+    def release(self):
+        """Give the concurrency slot back, if it is held."""
+        if not self.held:
+            return
+
+        self.held = False
+        try:
+            self.conn.zrem(self.slots_key, self.id)
+            logger.info("Released a slot of '%s'", self.slots_key)
+        except Exception:
+            logger.exception("Failed to release a slot of '%s'", self.slots_key)
+
+        self._record(histograms={"hold": time.monotonic() - self.acquired_at})
+
+    def throttle(self):
+        """Wait until the next request may be made."""
+        if not self.held:
+            return  # Media transfers are left to yt-dlp's sleeps.
+
+        self._renew(keys=[self.slots_key], args=[self.id, self.timeout])
+        wait = float(
+            self._take_token(
+                keys=[self.bucket_key],
+                args=[self.policy["rate"], self.policy["burst"]],
+            )
+        )
+        self._record(histograms={"token_wait": wait})
+        if wait > 0:
+            logger.debug("Waiting %.1fs for a token of '%s'", wait, self.bucket_key)
+            time.sleep(wait)
+
+    def _record(self, histograms=None, counters=()):
+        # Statistics are best effort, they must never fail a download.
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.sadd(STATS_KEY, self.stats_member)
+            for name, value in (histograms or {}).items():
+                key = f"{self.stats_prefix}:{name}"
+                pipe.hincrby(key, _get_bucket(value), 1)
+                pipe.hincrby(key, "count", 1)
+                pipe.hincrbyfloat(key, "sum", value)
+            for name in counters:
+                pipe.hincrby(self.stats_prefix + ":counters", name, 1)
+            pipe.execute()
+        except Exception:
+            logger.exception("Failed to record statistics of '%s'", self.slots_key)
+
+    def _leave(self):
+        try:
+            self.conn.zrem(self.queue_key, self.id)
+            self.conn.zrem(self.waiters_key, self.id)
+        except Exception:
+            logger.exception("Failed to leave the queue of '%s'", self.slots_key)
+
+
+class _RateLimitedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL that paces its requests with a RateLimiter."""
+
+    def __init__(self, params, limiter: RateLimiter, auto_init=True):
+        super().__init__(params, auto_init=auto_init)
+        self.limiter = limiter
+        self.add_progress_hook(self._release_on_download)
+
+    def urlopen(self, req):
+        self.limiter.throttle()
+        return super().urlopen(req)
+
+    def _release_on_download(self, d):
+        if d["status"] == "downloading":
+            self.limiter.release()
+
 
 @contextmanager
 def YoutubeDLRateLimited(
@@ -63,46 +335,84 @@ def YoutubeDLRateLimited(
     url: str,
     params: dict | None = None,
     auto_init=True,
-    timeout=DEFAULT_LOCK_TIMEOUT,
-    blocking_timeout=DEFAULT_LOCK_TIMEOUT,
+    timeout=DEFAULT_LEASE_TIMEOUT,
+    blocking_timeout=DEFAULT_WAIT_TIMEOUT,
 ):
     """Wrapper around yt_dlp.YoutubeDL that applies distributed rate limiting.
 
     This context manager wraps yt-dlp's YoutubeDL class and automatically
-    prevents multiple workers from downloading videos and metadata
-    simultaneously based on the URL. This effectively reduces the risk of us
-    being blocked by heavily rate-limited sites like YouTube.
+    limits how many workers may make requests to a heavily rate-limited site
+    like YouTube at the same time, and how fast they may make them together,
+    based on the URL. This effectively reduces the risk of us being blocked
+    by those sites while still downloading from them in parallel.
 
     In addition to the existing YoutubeDL parameters, this context manager also
     requires that a Redis connection, source, and URL be provided. The source
-    is the name of the app requesting a lock and is incorporated into the
-    lock's key name. This allows a different lock to be used for the frontend
-    than the backend workers.
+    is the name of the app making the requests and is incorporated into the
+    limiter's key names. This allows different limits to be used for the
+    frontend than the backend workers.
 
     The URL is needed to allow different groups of sites to be ratelimited
-    separately (or not at all). Currently, only YouTube is ratelimited.
+    separately (or not at all), with the limits in GROUP_POLICIES. Currently,
+    only YouTube is ratelimited.
 
-    timeout controls how long the lock exists in Redis before auto-expiring.
-    blocking_timeout controls how long to wait for the lock before giving up.
+    timeout controls how long a concurrency slot lasts in Redis without any
+    request being made before auto-expiring.
+    blocking_timeout controls how long to wait for a slot before giving up.
     """
     # Apply ratelimit parameters if the URL is from a ratelimited domain.
     group = _get_ratelimit_group(url)
     params = (SLEEP_PARAMS if group else {}) | (params or {})
 
-    # Acquire the distributed lock before starting the download to prevent
-    # multiple workers from downloading videos and metadata at the same time,
-    # which can potentially cause sites like YouTube to block us.
-    lock = None
-    if group:
-        lock = _acquire_lock(conn, source, group, timeout, blocking_timeout)
+    if not group:
+        with yt_dlp.YoutubeDL(params, auto_init=auto_init) as dl:
+            yield dl
+        return
+
+    # Take a concurrency slot before starting to prevent too many workers
+    # from requesting videos and metadata at the same time, which can
+    # potentially cause sites like YouTube to block us.
+    limiter = RateLimiter(conn, source, group, timeout, blocking_timeout)
+    limiter.acquire()
 
     try:
-        with yt_dlp.YoutubeDL(params, auto_init=auto_init) as dl:
+        with _RateLimitedYoutubeDL(params, limiter, auto_init=auto_init) as dl:
             yield dl
     finally:
-        # Always release the lock regardless of success or failure.
-        if lock:
-            _release_lock(lock)
+        # Always release the slot regardless of success or failure.
+        limiter.release()
+
+
+def get_limiter_stats(conn: Redis) -> dict:
+    """Return the wait and hold time statistics of every limiter.
+
+    The result maps each source and group to its counters and histograms.
+    Histograms have the count of each bucket by upper bound in seconds, their
+    total count and sum, and estimates of their median and 95th percentile.
+    """
+    result = {}
+
+    for member in sorted(conn.smembers(STATS_KEY)):
+        if isinstance(member, bytes):
+            member = member.decode()
+        source, group = member.split(":", 1)
+        prefix = f"{STATS_KEY}:{member}"
+
+        counters = _decode_hash(conn.hgetall(prefix + ":counters"))
+        stats = {name: int(counters.get(name, 0)) for name in COUNTERS}
+        for name in HISTOGRAMS:
+            stats[name] = _summarize_histogram(
+                _decode_hash(conn.hgetall(f"{prefix}:{name}"))
+            )
+
+        result.setdefault(source, {})[group] = stats
+
+    return result
+
+
+def is_ratelimited(url: str) -> bool:
+    """Return whether requests for a URL are subject to rate limiting."""
+    return _get_ratelimit_group(url) is not None
 
 
 def _get_ratelimit_group(url: str) -> str | None:
@@ -121,50 +431,52 @@ def _get_ratelimit_group(url: str) -> str | None:
 
 
 def _key(source: str, group: str):
-    """Generate a lock key for the given source and domain group."""
-    return f"{LOCK_KEY_PREFIX}:{source}:{group}"
+    """Generate a key prefix for the given source and domain group."""
+    return f"{KEY_PREFIX}:{source}:{group}"
 
 
-def _acquire_lock(
-    conn: Redis,
-    source: str,
-    group: str,
-    timeout=DEFAULT_LOCK_TIMEOUT,
-    blocking_timeout=DEFAULT_LOCK_TIMEOUT,
-) -> Lock:
-    """Acquire a distributed Redis lock."""
-    key = _key(source, group)
-
-    lock = conn.lock(
-        name=key,
-        timeout=timeout,
-        blocking_timeout=blocking_timeout,
-    )
-    try:
-        acquired = lock.acquire()
-    except LockError:
-        acquired = False
-
-    if not acquired:
-        message = "Failed to acquire lock '%s'"
-        logger.error(message, key)
-        raise RuntimeError(message % key)
+def _get_bucket(value: float) -> str:
+    """Return the histogram bucket field of a duration."""
+    for bound in HISTOGRAM_BUCKETS:
+        if value <= bound:
+            return _format_bound(bound)
 
-    logger.info("Acquired lock '%s'", key)
 
-    return lock
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else str(bound)
 
 
-def _release_lock(lock: Lock):
-    """Release a distributed Redis lock."""
-    try:
-        lock.release()
-        logger.info("Released lock '%s'", lock.name)
-    except LockNotOwnedError:
-        logger.warning(
-            "Lock '%s' expired before release (owned by another worker)",
-            lock.name,
+def _decode_hash(values: dict) -> dict:
+    return {
+        (k.decode() if isinstance(k, bytes) else k): (
+            v.decode() if isinstance(v, bytes) else v
         )
-    except LockError:
-        message = "Failed to release lock '%s'"
-        logger.error(message, lock.name)
+        for k, v in values.items()
+    }
+
+
+def _summarize_histogram(values: dict) -> dict:
+    """Summarize a histogram hash with its buckets and estimated percentiles."""
+    buckets = {
+        _format_bound(bound): int(values.get(_format_bound(bound), 0))
+        for bound in HISTOGRAM_BUCKETS
+    }
+    count = int(values.get("count", 0))
+
+    def estimate(q):
+        # Upper bound of the bucket holding the q-th percentile.
+        rank = max(1, math.ceil(q / 100 * count))
+        seen = 0
+        for bound, bucket_count in buckets.items():
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return None
+
+    return {
+        "buckets": buckets,
+        "count": count,
+        "sum": float(values.get("sum", 0)),
+        "p50": estimate(50) if count else None,
+        "p95": estimate(95) if count else None,
+    }
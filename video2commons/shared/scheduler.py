@@ -0,0 +1,184 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Fair-share scheduling of tasks between users."""
+
+import json
+import math
+import time
+
+# Tasks wait in per-user queues and are only released to the broker when a
+# queue has fewer than BROKER_BACKLOG tasks waiting in it. Keeping the broker
+# queues short is what lets the order of release decide the order of tasks.
+BROKER_BACKLOG = 2
+
+# Deficit round robin: on each round a user may release tasks worth QUANTUM
+# estimated CPU-seconds, scaled down by how much CPU time their tasks used
+# recently. A user that used USAGE_SCALE CPU-seconds gets half the share of a
+# user that didn't use any.
+QUANTUM = 3600
+USAGE_SCALE = 4 * 3600
+
+# Recent usage decays exponentially with this half-life in seconds.
+USAGE_HALF_LIFE = 6 * 3600
+
+# Estimated CPU-seconds of tasks whose cost couldn't be estimated.
+DEFAULT_TASK_COST = 1800
+
+PREFIX = "fairqueue:"
+USAGE_KEY = "fairshare:usage"
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _users_key(queue):
+    return PREFIX + queue + ":users"
+
+
+def _deficit_key(queue):
+    return PREFIX + queue + ":deficit"
+
+
+def _tasks_key(queue, user):
+    return PREFIX + queue + ":tasks:" + user
+
+
+def submit(conn, queue, user, task_id, params, cost=None):
+    """Add a task with a pre-assigned ID to the queue of its user."""
+    task = {"id": task_id, "params": params, "cost": cost or DEFAULT_TASK_COST}
+
+    pipe = conn.pipeline()
+    pipe.rpush(_tasks_key(queue, user), json.dumps(task))
+    # Users are only added once to the rotation; LPOS is not available on all
+    # Redis versions, so remove and append the user if they are not waiting.
+    pipe.lrem(_users_key(queue), 0, user)
+    pipe.rpush(_users_key(queue), user)
+    pipe.execute()
+
+
+def get_usage(conn, user, now=None):
+    """Get the decayed CPU-seconds recently used by the tasks of a user."""
+    usage = conn.hget(USAGE_KEY, user)
+    if not usage:
+        return 0
+
+    value, timestamp = json.loads(_decode(usage))
+    elapsed = max(0, (now or time.time()) - timestamp)
+    return value * 0.5 ** (elapsed / USAGE_HALF_LIFE)
+
+
+def record_usage(conn, user, cpu):
+    """Add the CPU-seconds used by a finished task to its user's usage."""
+    now = time.time()
+    usage = get_usage(conn, user, now) + cpu
+    conn.hset(USAGE_KEY, user, json.dumps([usage, now]))
+
+
+def get_quantum(conn, user):
+    """Get the CPU-seconds a user may release on each round."""
+    return QUANTUM / (1 + get_usage(conn, user) / USAGE_SCALE)
+
+
+def dispatch(conn, queue, send, broker_queue_length):
+    """
+    Release waiting tasks of a queue to the broker in fair-share order.
+
+    send(task_id, params, queue) submits a task to the broker, and
+    broker_queue_length() returns the number of tasks waiting there. Returns
+    the number of tasks released.
+    """
+    # Several frontends and workers may dispatch at once; only one at a time
+    # may touch the round robin state of a queue.
+    lock = conn.lock(PREFIX + queue + ":lock", timeout=30, blocking_timeout=10)
+    if not lock.acquire():
+        return 0
+
+    released = 0
+    try:
+        budget = BROKER_BACKLOG - broker_queue_length()
+
+        while budget > 0:
+            users = [_decode(u) for u in conn.lrange(_users_key(queue), 0, -1)]
+            if not users:
+                break
+
+            state = {}
+            for user in users:
+                head = conn.lindex(_tasks_key(queue, user), 0)
+                if head is None:
+                    conn.lrem(_users_key(queue), 0, user)
+                    conn.hdel(_deficit_key(queue), user)
+                    continue
+
+                state[user] = (
+                    json.loads(_decode(head))["cost"],
+                    float(conn.hget(_deficit_key(queue), user) or 0),
+                    get_quantum(conn, user),
+                )
+
+            if not state:
+                break
+
+            # Skip the rounds in which no user would have enough deficit to
+            # release their next task, so each round releases at least one.
+            skip = max(
+                0,
+                min(
+                    math.ceil((cost - deficit) / quantum)
+                    for cost, deficit, quantum in state.values()
+                )
+                - 1,
+            )
+
+            for user, (cost, deficit, quantum) in state.items():
+                deficit += quantum * (skip + 1)
+
+                while budget > 0 and cost <= deficit:
+                    task = json.loads(_decode(conn.lpop(_tasks_key(queue, user))))
+                    send(task["id"], task["params"], queue)
+                    deficit -= task["cost"]
+                    budget -= 1
+                    released += 1
+
+                    head = conn.lindex(_tasks_key(queue, user), 0)
+                    cost = json.loads(_decode(head))["cost"] if head else None
+                    if cost is None:
+                        break
+
+                # Move the user to the end of the rotation, or drop them and
+                # their deficit once they have nothing waiting anymore.
+                conn.lrem(_users_key(queue), 0, user)
+                if cost is None:
+                    conn.hdel(_deficit_key(queue), user)
+                else:
+                    conn.hset(_deficit_key(queue), user, deficit)
+                    conn.rpush(_users_key(queue), user)
+
+                if budget <= 0:
+                    break
+    finally:
+        lock.release()
+
+    return released
+
+
+def count_pending(conn, queues):
+    """Count the tasks waiting to be released to the broker."""
+    pipe = conn.pipeline()
+    for queue in queues:
+        for user in conn.lrange(_users_key(queue), 0, -1):
+            pipe.llen(_tasks_key(queue, _decode(user)))
+
+    return sum(pipe.execute())
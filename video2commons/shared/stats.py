@@ -3,6 +3,8 @@
 import json
 import time
 
+from video2commons.shared.scheduler import count_pending
+
 LOCK_KEY = "stats_lock"
 
 
@@ -44,8 +46,13 @@ def collect_worker_stats(conn, inspector):
 
 
 def get_queue_length(conn):
-    """Get the number of messages waiting in the broker queues."""
-    return conn.llen("celery") + conn.llen("heavy") + conn.hlen("unacked")
+    """Get the number of tasks waiting in the broker and fair-share queues."""
+    return (
+        conn.llen("celery")
+        + conn.llen("heavy")
+        + conn.hlen("unacked")
+        + count_pending(conn, ["celery", "heavy"])
+    )
 
 
 def update_task_stats(conn, task_id, remove=False):
@@ -71,12 +71,12 @@ def get_task_status(conn, task_id):
                 }
             )
         elif state == "PROGRESS":
-            task.update(
-                {
-                    "status": "progress",
-                    "text": res.result["text"],
-                    "progress": res.result["percent"],
-                }
+            task = get_progress_status(
+                task_id,
+                title,
+                task["hostname"],
+                res.result["text"],
+                res.result["percent"],
             )
         elif state == "SUCCESS":
             if isinstance(res.result, (list, tuple)):
@@ -134,6 +134,18 @@ def get_task_status(conn, task_id):
     return task
 
 
+def get_progress_status(task_id, title, hostname, text, percent):
+    """Build the status of a task in progress without querying Redis."""
+    return {
+        "id": task_id,
+        "title": title,
+        "hostname": hostname,
+        "status": "progress",
+        "text": text,
+        "progress": percent,
+    }
+
+
 def publish_notification(conn, ntype, data):
     """Publish a task change notification."""
     conn.publish("v2cnotif:" + ntype, json.dumps(data))
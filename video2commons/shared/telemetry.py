@@ -0,0 +1,135 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+"""Resource usage telemetry of finished tasks, aggregated per profile."""
+
+import json
+import math
+import resource
+import time
+from contextlib import contextmanager
+
+# Number of records kept for each convert key. Older records are discarded.
+MAX_RECORDS = 1000
+
+PROFILES_KEY = "telemetry:profiles"
+
+
+@contextmanager
+def measure_stage(record, stage):
+    """
+    Measure the wall time and resource usage of a stage of a task.
+
+    CPU time includes both this process (e.g. yt-dlp downloads) and waited
+    for child processes (e.g. ffmpeg). The peak memory isn't measured here,
+    since the kernel only tracks it for all children of the process over its
+    lifetime; encoders sample theirs instead. Nothing is recorded if the stage
+    raises or if record is None.
+    """
+    start = time.monotonic()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    yield
+
+    if record is None:
+        return
+
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = 0
+    for start_usage, end_usage in (
+        (start_self, end_self),
+        (start_children, end_children),
+    ):
+        cpu += end_usage.ru_utime - start_usage.ru_utime
+        cpu += end_usage.ru_stime - start_usage.ru_stime
+
+    record.setdefault("stages", {})[stage] = {
+        "wall": time.monotonic() - start,
+        "cpu": cpu,
+    }
+
+
+def record_telemetry(conn, convertkey, record):
+    """Store the telemetry of a finished task in a bounded per-profile list."""
+    key = "telemetry:" + convertkey
+    record = dict(record, convertkey=convertkey, time=int(time.time()))
+
+    pipe = conn.pipeline()
+    pipe.lpush(key, json.dumps(record))
+    pipe.ltrim(key, 0, MAX_RECORDS - 1)
+    pipe.sadd(PROFILES_KEY, convertkey)
+    pipe.execute()
+
+
+def percentile(values, q):
+    """Get the q-th percentile of a list of numbers (nearest rank)."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(values):
+    """Summarize a list of numbers with its median and 95th percentile."""
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+
+
+def get_telemetry_summary(conn):
+    """Get p50/p95 of the resource usage of each stage for every profile."""
+    summary = {}
+
+    for convertkey in sorted(conn.smembers(PROFILES_KEY)):
+        if isinstance(convertkey, bytes):
+            convertkey = convertkey.decode()
+
+        records = [
+            json.loads(record)
+            for record in conn.lrange("telemetry:" + convertkey, 0, -1)
+        ]
+        if not records:
+            continue
+
+        stages = {}
+        for record in records:
+            for stage, usage in record.get("stages", {}).items():
+                for metric, value in usage.items():
+                    stages.setdefault(stage, {}).setdefault(metric, []).append(value)
+
+        # How many seconds it takes to encode one second of video.
+        realtime = [
+            r["stages"]["encode"]["wall"] / r["duration"]
+            for r in records
+            if r.get("duration") and "encode" in r.get("stages", {})
+        ]
+        ratio = [r["bytes_out"] / r["bytes_in"] for r in records if r.get("bytes_in")]
+
+        summary[convertkey] = {
+            "count": len(records),
+            "stages": {
+                stage: {metric: summarize(values) for metric, values in usage.items()}
+                for stage, usage in stages.items()
+            },
+            "duration": summarize(
+                [r["duration"] for r in records if r.get("duration")]
+            ),
+            "maxrss": summarize([r["maxrss"] for r in records if r.get("maxrss")]),
+            "encode_realtime_factor": summarize(realtime),
+            "size_ratio": summarize(ratio),
+        }
+
+    return summary
@@ -13,10 +13,29 @@
 
 """Shared yt-dlp helpers used by both the worker app and the flask app."""
 
+import hashlib
+import json
 import os
+import time
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse, urlunparse
+
+from yt_dlp import YoutubeDL
 
 from video2commons.config import tooldir
 
+# Metadata extracted by the frontend is kept for EXTRACTION_CACHE_TTL seconds,
+# so that the backend doesn't have to request it again from the site when the
+# task is submitted, nor the frontend when the form is opened again.
+EXTRACTION_CACHE_TTL = 20 * 60
+EXTRACTION_CACHE_PREFIX = "extraction:"
+
+# Cached metadata is only used if its media URLs stay valid for at least
+# EXPIRY_MARGIN more seconds, which should be enough to complete a download.
+EXPIRY_MARGIN = 60 * 60
+
+# Bulky fields that neither the frontend nor the backend use.
+UNCACHED_FIELDS = ("automatic_captions", "heatmap", "thumbnails")
+
 
 def add_youtube_params(params):
     """Adds YouTube authentication parameters to yt-dlp request params."""
@@ -27,3 +46,122 @@ def add_youtube_params(params):
         params["cookiefile"] = cookies_path
 
     return params
+
+
+def normalize_url(url):
+    """Normalize a URL so trivially different spellings share a cache entry."""
+    parts = urlparse(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunparse(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/") or "/",
+            parts.params,
+            query,
+            "",
+        )
+    )
+
+
+def _extraction_key(url):
+    digest = hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+    return EXTRACTION_CACHE_PREFIX + digest
+
+
+def cache_extraction(conn, url, info):
+    """
+    Cache the metadata of a single video extracted with extract_info.
+
+    It is stored under both the requested URL and the URL of its page, which
+    is the one tasks are submitted with. Playlists aren't cached as a whole,
+    only their entries are.
+    """
+    if not info:
+        return
+
+    if info.get("_type", "video") != "video":
+        for entry in info.get("entries") or []:
+            if entry and entry.get("webpage_url"):
+                cache_extraction(conn, entry["webpage_url"], entry)
+        return
+
+    info = YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    for field in UNCACHED_FIELDS:
+        info.pop(field, None)
+    data = json.dumps(info)
+
+    urls = {url}
+    if info.get("webpage_url"):
+        urls.add(info["webpage_url"])
+
+    try:
+        pipe = conn.pipeline()
+        for key_url in urls:
+            pipe.setex(_extraction_key(key_url), EXTRACTION_CACHE_TTL, data)
+        pipe.execute()
+    except Exception as e:
+        print("Unable to cache extraction:", e)
+
+
+def get_cached_extraction(conn, url):
+    """
+    Get the cached metadata of a video, if its media URLs are still valid.
+
+    Media URLs bound to the IP address of the host that extracted them are
+    rejected, since the frontend and the workers don't share their address.
+
+    @return dict as returned by extract_info, or None
+    """
+    try:
+        data = conn.get(_extraction_key(url))
+    except Exception as e:
+        print("Unable to get cached extraction:", e)
+        return None
+
+    if not data:
+        return None
+
+    info = json.loads(data)
+    expiry = get_expiry(info)
+    if expiry is not None and expiry < time.time() + EXPIRY_MARGIN:
+        return None
+    if is_ip_bound(info):
+        return None
+
+    return info
+
+
+def _get_format_queries(info):
+    for format in info.get("formats") or [info]:
+        yield parse_qs(urlparse(format.get("url") or "").query)
+
+
+def is_ip_bound(info):
+    """
+    Check if the media URLs of a video are bound to an IP address.
+
+    Sites like YouTube sign their media URLs with the address of the client
+    that extracted them, and refuse to serve them to any other.
+    """
+    return any("ip" in query for query in _get_format_queries(info))
+
+
+def get_expiry(info):
+    """
+    Get when the earliest expiring media URL of a video stops working.
+
+    Sites like YouTube sign their media URLs with an expiry timestamp.
+
+    @return int UNIX timestamp, or None if the URLs don't expire
+    """
+    expiry = None
+    for query in _get_format_queries(info):
+        for value in query.get("expire", []):
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+            expiry = value if expiry is None else min(expiry, value)
+
+    return expiry